@@ -1,3 +1,21 @@
 from django.contrib import admin
+from .models import Job, JobFile
 
-# Register your models here.
+
+class JobFileInline(admin.TabularInline):
+    model = JobFile
+    fields = ("name", "status", "attempts", "delivered", "error", "finished_at")
+    readonly_fields = fields
+    extra = 0
+
+
+@admin.register(Job)
+class JobAdmin(admin.ModelAdmin):
+    list_display = ("id", "created_at", "status")
+    inlines = [JobFileInline]
+
+
+@admin.register(JobFile)
+class JobFileAdmin(admin.ModelAdmin):
+    list_display = ("name", "job", "status", "attempts", "delivered", "finished_at")
+    list_filter = ("status", "delivered")
@@ -1,6 +1,22 @@
+import os
+import sys
+
 from django.apps import AppConfig
 
 
+def serving():
+    """True in a web server process: a WSGI server, or runserver's child process (not its autoreloader)."""
+    if os.path.basename(sys.argv[0]) != "manage.py":
+        return True
+    return sys.argv[1:2] == ["runserver"] and ("--noreload" in sys.argv or os.environ.get("RUN_MAIN") == "true")
+
+
 class AppConfig(AppConfig):
     default_auto_field = "django.db.models.BigAutoField"
     name = "app"
+
+    def ready(self):
+        # Files left queued by a restart are picked up without waiting for the next upload
+        if serving():
+            from .jobs import ensure_workers
+            ensure_workers()
@@ -0,0 +1,205 @@
+"""
+Background processing of uploaded invoices.
+
+``JobFile`` rows are the queue: a worker thread claims the oldest queued row
+with a conditional UPDATE (only one worker can flip it from "queued" to
+"running"), processes the PDF and stores the result on the row. No broker is
+needed, the workers only talk to the database in ``settings.DATABASES``, so
+several web processes (or ``manage.py run_job_workers``) can share the queue.
+
+Rows left "running" by a worker that died are re-queued after
+``JOB_CLAIM_TIMEOUT`` seconds, up to ``JOB_MAX_ATTEMPTS`` attempts.
+"""
+import json
+import os
+import socket
+import threading
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import close_old_connections
+from django.db.models import F, Q
+from django.utils import timezone
+from invoice_core.cache import file_digest
+from invoice_core.metrics import Metrics
+from invoice_core.metrics import logger as metrics_logger
+from invoice_core.progress import stage
+from invoice_core.routing import routed_version
+
+from .models import JobFile
+from .utils.openai_helper import ROUTER, extract_data_with_openai
+from .utils.pdf_extractor import CACHE, extract_text_from_pdf
+from .utils.webhook_sender import send_to_webhook
+
+# Bump whenever the OpenAI prompt or model changes so cached responses are not reused
+PROMPT_VERSION = routed_version("web-gpt-4-v2", ROUTER)
+
+# Stage timings of this process's workers, served at /metrics and logged to "invoice_core.metrics"
+METRICS = Metrics(log=metrics_logger)
+
+
+def create_job(job, uploaded_files):
+    """
+    Store the uploads under MEDIA_ROOT and queue one JobFile per PDF.
+
+    Uploads whose SHA-256 (computed by HashingUploadHandler while they streamed
+    in) matches a file that is already queued or processed are not stored or
+    processed again: they point at the original through ``duplicate_of`` and
+    share its result.
+    """
+    for uploaded in uploaded_files:
+        name = os.path.basename(uploaded.name)
+        digest = getattr(uploaded, "digest", None) or file_digest(uploaded)
+        original = (
+            JobFile.objects.filter(sha256=digest, duplicate_of__isnull=True)
+            .exclude(status=JobFile.FAILED).order_by("created_at").first()
+        )
+        if original is not None:
+            JobFile.objects.create(job=job, name=name, sha256=digest, duplicate_of=original,
+                                   status=original.status, result=original.result,
+                                   delivered=original.delivered, finished_at=original.finished_at)
+            continue
+        JobFile.objects.create(job=job, file=uploaded, name=name, sha256=digest)
+    pool = ensure_workers()
+    if pool:
+        pool.notify()
+    return job
+
+
+def process_extracted_text(file, text, digest=None, progress=None):
+    """OpenAI extraction (cached per file) followed by webhook delivery. Returns (data, delivered)."""
+    if CACHE and digest is None:
+        digest = file_digest(file)
+    extracted_data = CACHE.get(digest, "llm", PROMPT_VERSION) if CACHE else None
+    if extracted_data is None:
+        with stage(progress, file, "llm") as measures:
+            measures["prompt_bytes"] = len(text.encode("utf-8"))
+            extracted_data = extract_data_with_openai(text, usage=measures)
+        if CACHE and extracted_data is not None:
+            CACHE.put(digest, "llm", PROMPT_VERSION, extracted_data)
+    if extracted_data is None:
+        return None, False
+    with stage(progress, file, "deliver") as measures:
+        measures["bytes"] = len(extracted_data.encode("utf-8"))
+        delivered = send_to_webhook(extracted_data)
+    return extracted_data, delivered
+
+
+def process_job_file(job_file):
+    path = job_file.file.path
+    digest = job_file.sha256 or None
+    text = extract_text_from_pdf(path, poppler_path=settings.POPPLER_PATH, digest=digest, progress=METRICS)
+    data, delivered = process_extracted_text(path, text, digest, progress=METRICS)
+    if data is None:
+        raise RuntimeError("OpenAI extraction failed")
+    try:
+        result = json.loads(data)
+    except (TypeError, ValueError):
+        result = data
+    return result, delivered
+
+
+def requeue_stale():
+    cutoff = timezone.now() - timedelta(seconds=settings.JOB_CLAIM_TIMEOUT)
+    stale = JobFile.objects.filter(status=JobFile.RUNNING, started_at__lt=cutoff)
+    stale.filter(attempts__lt=settings.JOB_MAX_ATTEMPTS).update(status=JobFile.QUEUED, worker="")
+    # Whatever is still running is out of attempts; its duplicates fail with it, as in run_one
+    failed = list(stale.values_list("pk", flat=True))
+    JobFile.objects.filter(Q(pk__in=failed) | Q(duplicate_of__in=failed)).update(
+        status=JobFile.FAILED, error="worker did not finish", finished_at=timezone.now()
+    )
+
+
+def claim_next(worker):
+    """Atomically move the oldest queued file to "running" for ``worker``."""
+    # Duplicates have no file of their own; they are completed along with their original
+    candidates = (
+        JobFile.objects.filter(status=JobFile.QUEUED, duplicate_of__isnull=True).values_list("pk", flat=True)[:10]
+    )
+    for pk in candidates:
+        claimed = JobFile.objects.filter(pk=pk, status=JobFile.QUEUED).update(
+            status=JobFile.RUNNING, worker=worker, started_at=timezone.now(), attempts=F("attempts") + 1,
+        )
+        if claimed:
+            return JobFile.objects.get(pk=pk)
+    return None
+
+
+def run_one(worker):
+    """Claim and process a single file. Returns False when the queue is empty."""
+    job_file = claim_next(worker)
+    if job_file is None:
+        return False
+    try:
+        result, delivered = process_job_file(job_file)
+    except Exception as e:
+        print(f"Job file {job_file.pk} ({job_file.name}) failed: {e}")
+        JobFile.objects.filter(pk=job_file.pk).update(
+            status=JobFile.FAILED, error=str(e), finished_at=timezone.now()
+        )
+        JobFile.objects.filter(duplicate_of=job_file.pk).update(
+            status=JobFile.FAILED, error=str(e), finished_at=timezone.now()
+        )
+    else:
+        # Undelivered payloads stay in the webhook outbox and are retried there
+        JobFile.objects.filter(Q(pk=job_file.pk) | Q(duplicate_of=job_file.pk)).update(
+            status=JobFile.DONE, result=result, delivered=delivered, error="", finished_at=timezone.now()
+        )
+    return True
+
+
+class JobWorkerPool:
+    def __init__(self, workers=None, poll_interval=None):
+        self.workers = workers or settings.JOB_WORKERS
+        self.poll_interval = poll_interval or settings.JOB_POLL_INTERVAL
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._threads = []
+
+    def start(self):
+        for number in range(self.workers):
+            name = f"{socket.gethostname()}:{os.getpid()}:{number}"
+            thread = threading.Thread(target=self._loop, args=(name,), name=f"job-worker-{number}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+        return self
+
+    def notify(self):
+        """Wake idle workers, e.g. right after a job was queued."""
+        self._wake.set()
+
+    def stop(self, wait=True):
+        self._stop.set()
+        self._wake.set()
+        if wait:
+            for thread in self._threads:
+                thread.join()
+
+    def _loop(self, name):
+        while not self._stop.is_set():
+            try:
+                requeue_stale()
+                busy = run_one(name)
+            except Exception as e:
+                print(f"Job worker {name} error: {e}")
+                busy = False
+            finally:
+                close_old_connections()
+            if not busy:
+                self._wake.wait(self.poll_interval)
+                self._wake.clear()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def ensure_workers():
+    """Start this process's worker pool once, unless workers run in a separate process."""
+    global _pool
+    if not settings.JOB_WORKERS_IN_PROCESS:
+        return None
+    with _pool_lock:
+        if _pool is None:
+            _pool = JobWorkerPool().start()
+    return _pool
@@ -0,0 +1,24 @@
+import signal
+import threading
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from app.jobs import JobWorkerPool
+
+
+class Command(BaseCommand):
+    help = "Process queued invoice jobs with a pool of worker threads until interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--workers", type=int, default=settings.JOB_WORKERS)
+
+    def handle(self, *args, **options):
+        pool = JobWorkerPool(workers=options["workers"]).start()
+        self.stdout.write(f"Processing jobs with {options['workers']} workers. Press Ctrl+C to stop.")
+        stopped = threading.Event()
+        signal.signal(signal.SIGTERM, lambda *_: stopped.set())
+        try:
+            stopped.wait()
+        except KeyboardInterrupt:
+            pass
+        self.stdout.write("Stopping after the files in progress...")
+        pool.stop()
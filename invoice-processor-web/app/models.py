@@ -1,3 +1,75 @@
+import uuid
+
 from django.db import models
 
-# Create your models here.
+
+class Job(models.Model):
+    """A batch of uploaded PDFs, processed in the background by the job workers."""
+
+    id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    def status(self):
+        counts = self.file_counts()
+        if counts[JobFile.QUEUED] == counts["total"]:
+            return "queued"
+        if counts[JobFile.QUEUED] or counts[JobFile.RUNNING]:
+            return "running"
+        return "failed" if counts[JobFile.FAILED] else "done"
+
+    def file_counts(self):
+        counts = dict.fromkeys((JobFile.QUEUED, JobFile.RUNNING, JobFile.DONE, JobFile.FAILED), 0)
+        for row in self.files.values("status").annotate(count=models.Count("id")):
+            counts[row["status"]] = row["count"]
+        counts["total"] = sum(counts.values())
+        return counts
+
+    def __str__(self):
+        return str(self.id)
+
+
+class JobFile(models.Model):
+    """One uploaded PDF of a job. The table doubles as the work queue."""
+
+    QUEUED = "queued"
+    RUNNING = "running"
+    DONE = "done"
+    FAILED = "failed"
+    STATUS_CHOICES = [(QUEUED, "Queued"), (RUNNING, "Running"), (DONE, "Done"), (FAILED, "Failed")]
+
+    job = models.ForeignKey(Job, related_name="files", on_delete=models.CASCADE)
+    file = models.FileField(upload_to="jobs/%Y/%m/%d/")
+    name = models.CharField(max_length=255)
+    # SHA-256 computed while the upload streamed in; identical PDFs are only processed once
+    sha256 = models.CharField(max_length=64, blank=True, db_index=True)
+    duplicate_of = models.ForeignKey("self", null=True, blank=True, related_name="duplicates", on_delete=models.SET_NULL)
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=QUEUED, db_index=True)
+    attempts = models.PositiveIntegerField(default=0)
+    worker = models.CharField(max_length=100, blank=True)
+    result = models.JSONField(null=True, blank=True)
+    delivered = models.BooleanField(default=False)
+    error = models.TextField(blank=True)
+    created_at = models.DateTimeField(auto_now_add=True)
+    started_at = models.DateTimeField(null=True, blank=True)
+    finished_at = models.DateTimeField(null=True, blank=True)
+
+    class Meta:
+        ordering = ["created_at", "id"]
+
+    def as_dict(self):
+        return {
+            "id": self.id,
+            "name": self.name,
+            "status": self.status,
+            "attempts": self.attempts,
+            "delivered": self.delivered,
+            "sha256": self.sha256,
+            "duplicate_of": self.duplicate_of_id,
+            "result": self.result,
+            "error": self.error,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+
+    def __str__(self):
+        return self.name
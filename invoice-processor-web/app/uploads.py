@@ -0,0 +1,60 @@
+"""
+Streaming upload handling.
+
+Django keeps uploads under 2.5 MB in memory and copies larger ones around
+before they reach the extraction stages. ``HashingUploadHandler`` replaces both
+default handlers: every upload, whatever its size, is written chunk by chunk to
+a spool file under ``UPLOAD_SPOOL_DIR`` while its SHA-256 is computed on the
+fly. The resulting ``SpooledUploadedFile`` has a real path on disk (moved, not
+copied, into MEDIA_ROOT when saved) and a ``digest`` used to skip duplicate
+uploads and as the extraction cache key, so the PDF is never read back just to
+hash it.
+"""
+import hashlib
+import os
+import tempfile
+
+from django.conf import settings
+from django.core.files.uploadedfile import TemporaryUploadedFile, UploadedFile
+from django.core.files.uploadhandler import FileUploadHandler
+
+
+class SpooledUploadedFile(TemporaryUploadedFile):
+    """A TemporaryUploadedFile in the spool directory that knows its SHA-256."""
+
+    def __init__(self, name, content_type, size, charset, content_type_extra=None):
+        os.makedirs(settings.UPLOAD_SPOOL_DIR, exist_ok=True)
+        _, ext = os.path.splitext(name)
+        file = tempfile.NamedTemporaryFile(suffix=".upload" + ext, dir=settings.UPLOAD_SPOOL_DIR)
+        UploadedFile.__init__(self, file, name, content_type, size, charset, content_type_extra)
+        self.sha256 = hashlib.sha256()
+        self.digest = None
+
+
+class HashingUploadHandler(FileUploadHandler):
+    """Spool every upload to disk in chunks, hashing as the bytes arrive."""
+
+    chunk_size = 1024 * 1024
+
+    def new_file(self, *args, **kwargs):
+        super().new_file(*args, **kwargs)
+        self.file = SpooledUploadedFile(self.file_name, self.content_type, 0, self.charset, self.content_type_extra)
+
+    def receive_data_chunk(self, raw_data, start):
+        self.file.write(raw_data)
+        self.file.sha256.update(raw_data)
+
+    def file_complete(self, file_size):
+        self.file.seek(0)
+        self.file.size = file_size
+        self.file.digest = self.file.sha256.hexdigest()
+        return self.file
+
+    def upload_interrupted(self):
+        if hasattr(self, "file"):
+            temp_location = self.file.temporary_file_path()
+            try:
+                self.file.close()
+                os.remove(temp_location)
+            except FileNotFoundError:
+                pass
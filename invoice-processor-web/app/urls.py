@@ -0,0 +1,11 @@
+from django.urls import path
+from . import views
+
+urlpatterns = [
+    path("", views.dashboard, name="dashboard"),
+    path("jobs/", views.job_create, name="job_create"),
+    path("jobs/<uuid:job_id>/", views.job_status, name="job_status"),
+    path("jobs/<uuid:job_id>/files/", views.job_files, name="job_files"),
+    path("jobs/<uuid:job_id>/files/<int:file_id>/", views.job_files, name="job_file"),
+    path("metrics", views.metrics, name="metrics"),
+]
@@ -1,17 +1,40 @@
-import openai
-import os
+import json
+
 from decouple import config
+from invoice_core.llm import get_gateway
+from invoice_core.routing import get_router, validate_invoice
+
+llm = get_gateway(api_key=config("OPENAI_API_KEY"))
+
+# With LLM_FAST_MODEL set, GPT-4 only gets the answers the cheaper model gets wrong
+ROUTER = get_router(llm, config("LLM_FAST_MODEL", default=None), config("LLM_FAST_BASE_URL", default=None))
+
+
+def _complete(client, prompt, usage):
+    return client.complete(
+        model="gpt-4",
+        messages=[{"role": "user", "content": prompt}],
+        max_tokens=1000,
+        usage=usage
+    )
+
+
+def validate_answer(text):
+    # The prompt is the bare invoice text, so no column is required; the ones given are checked
+    try:
+        data = json.loads(text)
+    except (TypeError, ValueError):
+        return ["the answer is not JSON"]
+    return validate_invoice(data, required=())
 
-openai.api_key = config("OPENAI_API_KEY")
 
-def extract_data_with_openai(prompt):
+def extract_data_with_openai(prompt, usage=None):
+    # usage: optional dict that gets the request's token counts, retries and escalations
     try:
-        response = openai.ChatCompletion.create(
-            model="gpt-4",
-            messages=[{"role": "user", "content": prompt}],
-            max_tokens=1000
-        )
-        return response["choices"][0]["message"]["content"]
+        if ROUTER is None:
+            return _complete(llm, prompt, usage)
+        return ROUTER.extract(lambda client, templates: _complete(client, prompt, usage), measures=usage,
+                              validate=validate_answer)
     except Exception as e:
         print(f"OpenAI API Error: {e}")
-        return None
\ No newline at end of file
+        return None
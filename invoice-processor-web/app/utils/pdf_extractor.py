@@ -1,16 +1,22 @@
+import logging
+
 import pdfplumber
-from pdf2image import convert_from_path
-import pytesseract
+from invoice_core.cache import default_cache
+from invoice_core.condense import condense_pages
+from invoice_core.page_router import extract_pages
 
-def extract_text_from_pdf(file_path, poppler_path):
-    with pdfplumber.open(file_path) as pdf:
-        text = "".join(page.extract_text() or "" for page in pdf.pages)
+CACHE = default_cache()
+logger = logging.getLogger(__name__)
 
+def extract_text_from_pdf(file_path, poppler_path, digest=None, progress=None):
     try:
-        images = convert_from_path(file_path, dpi=300, poppler_path=poppler_path)
-        image_text = "".join(pytesseract.image_to_string(image) for image in images)
+        pages = extract_pages(file_path, poppler_path=poppler_path, cache=CACHE, digest=digest, progress=progress)
     except Exception as e:
         print(f"Error processing images: {e}")
-        image_text = ""
+        with pdfplumber.open(file_path) as pdf:
+            text = "".join(page.extract_text() or "" for page in pdf.pages)
+        return text + "\n"
 
-    return text + "\n" + image_text
\ No newline at end of file
+    text, condense_report = condense_pages(pages)
+    logger.debug("Prompt text: %s tokens (%s saved)", condense_report["tokens_after"], condense_report["tokens_saved"])
+    return text
@@ -1,11 +1,23 @@
-import requests
+import threading
+
 from decouple import config
+from django.conf import settings
+from invoice_core.webhook import WebhookDelivery
+
+_delivery = None
+_delivery_lock = threading.Lock()
+
+def get_delivery():
+    # Created on the first send, so the views import without MAKE_WEBHOOK_URL
+    global _delivery
+    with _delivery_lock:
+        if _delivery is None:
+            _delivery = WebhookDelivery(config("MAKE_WEBHOOK_URL"), outbox_path=settings.WEBHOOK_OUTBOX)
+    return _delivery
 
 def send_to_webhook(data):
-    webhook_url = config("MAKE_WEBHOOK_URL")
     try:
-        response = requests.post(webhook_url, json=data)
-        return response.status_code == 200
+        return get_delivery().deliver(data)
     except Exception as e:
         print(f"Webhook Error: {e}")
-        return False
\ No newline at end of file
+        return False
@@ -1,21 +1,84 @@
-from django.shortcuts import render
+import hmac
+
+from django.conf import settings
+from django.db.models import Count
+from django.http import Http404, HttpResponse, JsonResponse
+from django.shortcuts import get_object_or_404, render
+from django.urls import reverse
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_GET, require_POST
 from .forms import PDFUploadForm
-from .utils.pdf_extractor import extract_text_from_pdf
-from .utils.openai_helper import extract_data_with_openai
-from .utils.webhook_sender import send_to_webhook
+from .jobs import METRICS, create_job
+from .utils.openai_helper import ROUTER
+from .models import Job, JobFile
+
+def job_summary(request, job):
+    return {
+        "id": str(job.id),
+        "status": job.status(),
+        "created_at": job.created_at,
+        "files": job.file_counts(),
+        "status_url": request.build_absolute_uri(reverse("job_status", args=[job.id])),
+        "results_url": request.build_absolute_uri(reverse("job_files", args=[job.id])),
+    }
 
 def dashboard(request):
+    job = None
     if request.method == 'POST':
         form = PDFUploadForm(request.POST, request.FILES)
         if form.is_valid():
-            files = request.FILES.getlist('files')
-            results = []
-            for file in files:
-                text = extract_text_from_pdf(file, "/opt/homebrew/bin")
-                extracted_data = extract_data_with_openai(text)
-                success = send_to_webhook(extracted_data)
-                results.append((file.name, success))
-            return render(request, 'results.html', {'results': results})
+            # Files are only stored and queued here; the job workers process them in the background
+            job = create_job(Job.objects.create(), request.FILES.getlist('files'))
+            form = PDFUploadForm()
     else:
         form = PDFUploadForm()
-    return render(request, 'dashboard.html', {'form': form})
\ No newline at end of file
+    return render(request, 'dashboard.html', {'form': form, 'job': job})
+
+def has_api_token(request):
+    token = settings.JOB_API_TOKEN
+    scheme, _, given = request.headers.get("Authorization", "").partition(" ")
+    return bool(token) and scheme.lower() == "bearer" and hmac.compare_digest(given.strip(), token)
+
+# No CSRF check: the API is authenticated by its token, which a browser never sends on its own
+@csrf_exempt
+@require_POST
+def job_create(request):
+    if not has_api_token(request):
+        return JsonResponse({"error": "Missing or wrong API token. Send it as 'Authorization: Bearer <JOB_API_TOKEN>'."},
+                            status=401)
+    files = request.FILES.getlist('files')
+    if not files:
+        return JsonResponse({"error": "No files uploaded. Send them as multipart field 'files'."}, status=400)
+    job = create_job(Job.objects.create(), files)
+    return JsonResponse(job_summary(request, job), status=202)
+
+@require_GET
+def job_status(request, job_id):
+    job = get_object_or_404(Job, pk=job_id)
+    return JsonResponse(job_summary(request, job))
+
+@require_GET
+def job_files(request, job_id, file_id=None):
+    job = get_object_or_404(Job, pk=job_id)
+    if file_id is not None:
+        job_file = job.files.filter(pk=file_id).first()
+        if job_file is None:
+            raise Http404("No such file in this job")
+        return JsonResponse(job_file.as_dict())
+    return JsonResponse({"id": str(job.id), "status": job.status(),
+                         "files": [job_file.as_dict() for job_file in job.files.all()]})
+
+@require_GET
+def metrics(request):
+    """
+    Prometheus text format: stage timings of this process, the job queue from the database
+    and, with model routing on, the requests and latency of each model tier.
+    """
+    counts = {status: 0 for status, _ in JobFile.STATUS_CHOICES}
+    for row in JobFile.objects.values("status").annotate(count=Count("id")):
+        counts[row["status"]] = row["count"]
+    extra = {"invoice_job_files": ("Uploaded files by status.", {(("status", status),): count
+                                                                 for status, count in counts.items()})}
+    if ROUTER is not None:
+        extra.update(ROUTER.gauges())
+    return HttpResponse(METRICS.prometheus(extra), content_type="text/plain; version=0.0.4; charset=utf-8")
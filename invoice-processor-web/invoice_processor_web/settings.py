@@ -1,4 +1,5 @@
 import os
+import sys
 from pathlib import Path
 from dotenv import load_dotenv
 
@@ -8,6 +9,9 @@ load_dotenv()
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
 BASE_DIR = Path(__file__).resolve().parent.parent
 
+# Shared extraction helpers (invoice_core/) live at the repository root
+sys.path.append(str(BASE_DIR.parent))
+
 # SECURITY WARNING: keep the secret key used in production secret!
 SECRET_KEY = os.getenv('DJANGO_SECRET_KEY', 'your-default-secret-key')
 
@@ -63,6 +67,8 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # The job workers share this database with the web requests; wait for locks instead of failing
+        'OPTIONS': {'timeout': 30},
     }
 }
 
@@ -97,6 +103,11 @@ STATICFILES_DIRS = [BASE_DIR / 'static']
 MEDIA_URL = '/media/'
 MEDIA_ROOT = BASE_DIR / 'media'
 
+# Uploads are streamed to disk in chunks and hashed as they arrive (app/uploads.py).
+# Keep the spool on the same filesystem as MEDIA_ROOT so saving an upload is a rename.
+FILE_UPLOAD_HANDLERS = ['app.uploads.HashingUploadHandler']
+UPLOAD_SPOOL_DIR = os.getenv('UPLOAD_SPOOL_DIR', str(MEDIA_ROOT / 'spool'))
+
 # Default primary key field type
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
@@ -109,6 +120,19 @@ OPENAI_API_KEY = os.getenv('OPENAI_API_KEY', '')
 # Webhook URL for processing data
 WEBHOOK_URL = os.getenv('MAKE_WEBHOOK_URL', '')
 
+# SQLite outbox holding webhook payloads until they are delivered
+WEBHOOK_OUTBOX = os.getenv('WEBHOOK_OUTBOX', str(BASE_DIR / 'webhook_outbox.sqlite3'))
+
+# Background jobs: uploads are queued in the database and processed by worker threads.
+# With JOB_WORKERS_IN_PROCESS=False run them separately with `python manage.py run_job_workers`.
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '4'))
+JOB_WORKERS_IN_PROCESS = os.getenv('JOB_WORKERS_IN_PROCESS', 'True') == 'True'
+JOB_POLL_INTERVAL = float(os.getenv('JOB_POLL_INTERVAL', '2'))
+JOB_CLAIM_TIMEOUT = int(os.getenv('JOB_CLAIM_TIMEOUT', '1800'))  # seconds before a running file is re-queued
+JOB_MAX_ATTEMPTS = int(os.getenv('JOB_MAX_ATTEMPTS', '3'))
+# Bearer token the job API (POST /jobs/) requires; the API is off while it is empty
+JOB_API_TOKEN = os.getenv('JOB_API_TOKEN', '')
+
 # Additional settings for deployment
 if not DEBUG:
     STATIC_ROOT = BASE_DIR / 'staticfiles'
@@ -133,6 +157,14 @@ LOGGING = {
             'class': 'logging.FileHandler',
             'filename': BASE_DIR / 'debug.log',
         },
+        # One JSON line per finished pipeline stage (wall/CPU seconds, pages, bytes, tokens, retries)
+        'metrics': {
+            'class': 'logging.StreamHandler',
+            'formatter': 'message',
+        },
+    },
+    'formatters': {
+        'message': {'format': '%(message)s'},
     },
     'loggers': {
         'django': {
@@ -140,5 +172,10 @@ LOGGING = {
             'level': 'DEBUG',
             'propagate': True,
         },
+        'invoice_core.metrics': {
+            'handlers': ['metrics'],
+            'level': os.getenv('METRICS_LOG_LEVEL', 'INFO'),
+            'propagate': False,
+        },
     },
 }
\ No newline at end of file
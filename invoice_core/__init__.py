@@ -0,0 +1,7 @@
+"""
+Extraction helpers shared by the desktop scripts (pdf-to-csv, pdf-to-json-webhook)
+and the Django app (invoice-processor-web).
+
+The front ends add the repository root to ``sys.path`` and import from here, so
+this package only depends on what their requirements.txt files already install.
+"""
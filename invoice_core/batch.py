@@ -0,0 +1,172 @@
+"""
+Headless batch engine for the per-file extraction pipeline.
+
+Each file goes through two stages:
+
+1. ``extract_fn(path)`` - CPU bound (pdfplumber, rasterization, Tesseract). Runs in a
+   process pool so OCR uses every core instead of one.
+2. ``process_fn(path, extracted)`` - I/O bound (LLM request, webhook delivery). Runs in a
+   separate, bounded thread pool so slow network calls never block the OCR workers.
+
+``BatchEngine.run`` is a generator of result dicts, yielded either in input order
+or as soon as each file finishes. The GUI, the Django view and any command-line
+driver consume the same generator.
+
+With ``keep_pools=True`` the worker processes outlive a single ``run``, so state
+they hold for the job (such as memoized page renders) is reused when the same
+files are retried later in the session. Call ``close()`` when done.
+
+``run`` also takes ``threading.Event`` objects to pause (no new files are started
+while set) and cancel (queued files are dropped and reported as cancelled; files
+already in a stage finish normally).
+
+For long-running services ``run(follow=queue)`` keeps taking new files from a
+``queue.Queue`` as they are put, until ``cancel`` is set.
+"""
+import os
+import queue
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+DEFAULT_CPU_WORKERS = int(os.getenv("INVOICE_CPU_WORKERS", os.cpu_count() or 1))
+DEFAULT_IO_WORKERS = int(os.getenv("INVOICE_IO_WORKERS", "4"))
+PAUSE_POLL_SECONDS = 0.2
+CANCELLED = "cancelled"
+
+
+def _make_result(index, path, ok, result=None, error=None):
+    return {"index": index, "file": path, "ok": ok, "result": result, "error": error}
+
+
+class BatchEngine:
+    def __init__(self, extract_fn, process_fn, cpu_workers=None, io_workers=None, ordered=True,
+                 max_pending=None, keep_pools=False):
+        """
+        ``extract_fn`` must be picklable (a module-level function or functools.partial of
+        one) when ``cpu_workers`` > 0. With ``cpu_workers=0`` extraction runs in the I/O
+        thread pool instead, for inputs that cannot cross a process boundary.
+        """
+        self.extract_fn = extract_fn
+        self.process_fn = process_fn
+        self.cpu_workers = DEFAULT_CPU_WORKERS if cpu_workers is None else cpu_workers
+        self.io_workers = io_workers or DEFAULT_IO_WORKERS
+        self.ordered = ordered
+        # Bound the number of files held in memory between the two stages
+        self.max_pending = max_pending or 2 * (max(self.cpu_workers, 1) + self.io_workers)
+        self.keep_pools = keep_pools
+        self._cpu_pool = None
+        self._io_pool = None
+
+    def _pools(self):
+        if self._cpu_pool is None:
+            if self.cpu_workers > 0:
+                self._cpu_pool = ProcessPoolExecutor(max_workers=self.cpu_workers)
+            else:
+                self._cpu_pool = ThreadPoolExecutor(max_workers=self.io_workers)
+            self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers)
+        return self._cpu_pool, self._io_pool
+
+    def close(self):
+        """Shut the worker pools down."""
+        if self._cpu_pool is not None:
+            self._cpu_pool.shutdown()
+            self._io_pool.shutdown()
+            self._cpu_pool = self._io_pool = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def run(self, files, pause=None, cancel=None, follow=None):
+        """Process ``files`` (and, with ``follow``, files put on that queue) and yield one result dict per file."""
+        if follow is not None and cancel is None:
+            raise ValueError("run(follow=...) needs a cancel event to stop")
+        files = list(files)
+        queued = deque(enumerate(files))
+        extracting = {}
+        processing = {}
+        finished = {}
+        next_index = 0
+
+        cpu_pool, io_pool = self._pools()
+        try:
+            def fill():
+                while follow is not None and not cancel.is_set():
+                    try:
+                        path = follow.get_nowait()
+                    except queue.Empty:
+                        break
+                    files.append(path)
+                    queued.append((len(files) - 1, path))
+                if cancel is not None and cancel.is_set():
+                    # Drop queued files and extractions that have not started yet
+                    while queued:
+                        index, path = queued.popleft()
+                        finished[index] = _make_result(index, path, False, error=CANCELLED)
+                    for future in [future for future in extracting if future.cancel()]:
+                        index = extracting.pop(future)
+                        finished[index] = _make_result(index, files[index], False, error=CANCELLED)
+                    return
+                if pause is not None and pause.is_set():
+                    return
+                while queued and len(extracting) + len(processing) < self.max_pending:
+                    index, path = queued.popleft()
+                    extracting[cpu_pool.submit(self.extract_fn, path)] = index
+
+            fill()
+            while extracting or processing or queued or (follow is not None and not cancel.is_set()):
+                in_flight = list(extracting) + list(processing)
+                if in_flight:
+                    # While following a queue, wake up regularly to check for new work
+                    done, _ = wait(in_flight, timeout=PAUSE_POLL_SECONDS if follow is not None else None,
+                                   return_when=FIRST_COMPLETED)
+                else:
+                    # Paused or idle with nothing to wait for: wait() on no futures returns at once
+                    done = ()
+                    if follow is not None and not (pause is not None and pause.is_set()):
+                        try:
+                            path = follow.get(timeout=PAUSE_POLL_SECONDS)
+                        except queue.Empty:
+                            pass
+                        else:
+                            files.append(path)
+                            queued.append((len(files) - 1, path))
+                    elif cancel is not None:
+                        cancel.wait(PAUSE_POLL_SECONDS)
+                    else:
+                        time.sleep(PAUSE_POLL_SECONDS)
+                for future in done:
+                    if future in extracting:
+                        index = extracting.pop(future)
+                        try:
+                            extracted = future.result()
+                        except Exception as e:
+                            finished[index] = _make_result(index, files[index], False, error=str(e))
+                        else:
+                            processing[io_pool.submit(self.process_fn, files[index], extracted)] = index
+                    else:
+                        index = processing.pop(future)
+                        try:
+                            result = future.result()
+                        except Exception as e:
+                            finished[index] = _make_result(index, files[index], False, error=str(e))
+                        else:
+                            finished[index] = _make_result(index, files[index], bool(result), result=result)
+                fill()
+
+                if self.ordered:
+                    while next_index in finished:
+                        yield finished.pop(next_index)
+                        next_index += 1
+                else:
+                    for index in sorted(finished):
+                        yield finished.pop(index)
+            # Files cancelled after the last completion
+            for index in sorted(finished):
+                yield finished.pop(index)
+        finally:
+            if not self.keep_pools:
+                self.close()
@@ -0,0 +1,592 @@
+"""
+Offline benchmark of the extraction pipeline on a synthetic invoice corpus.
+
+::
+
+    python -m invoice_core.bench generate corpus/ --count 5
+    python -m invoice_core.bench run --corpus corpus/ --save-baseline bench-baseline.json
+    python -m invoice_core.bench run --corpus corpus/ --baseline bench-baseline.json
+
+``generate`` writes deterministic PDFs (same ``--seed``, same bytes) of four kinds:
+
+- ``digital``: one born-digital page with a short product table,
+- ``scanned``: the same layout rasterized with skew and noise (needs OCR),
+- ``multipage``: a three-page table with the header repeated on every page,
+- ``many_items``: 150 line items.
+
+``run`` drives the real functions (``page_router.extract_pages``,
+``invoices.extract_json``/``extract_csv_row``, ``WebhookDelivery``) file by
+file with the extraction cache and templates off. GPT and the Make webhook are
+replaced by local stub servers, so the suite needs no network or API key. It
+reports pages/sec, p50/p95 seconds per stage (per file, summed over the stage's
+runs), peak RSS and tokens per invoice. A saved baseline is compared with
+``--tolerance`` (default 20%), and the exit status is 1 on a regression.
+``--structured`` requests the fields as a function call; with ``--error-rate``
+the stub GPT malforms a share of its answers, to compare failed invoices and
+structured-output repairs. ``--stream`` streams the answers and reports the time
+to the first header field. ``--pack --workers 4`` sends short invoices four to a
+request (``invoice_core.packing``), to compare tokens per invoice, requests and
+invoices/sec with ``--workers 4`` alone.
+
+The stub GPT caches prompt prefixes the way OpenAI does: the longest prefix
+(tools, then the messages in order) shared with an earlier request counts as
+cached once it reaches 1024 tokens, in 128-token steps. The report's
+``cached_tokens_per_invoice`` and ``input_cost_per_invoice`` (prompt tokens with
+cached ones at half price) show what the static-first prompts (``prompts.py``)
+save; the cached share of the prompt is also taken off the stub's first-token
+wait (``PREFILL_SHARE`` of ``--llm-latency``).
+
+``--fast-model gpt-4o-mini`` routes every extraction through that model first
+(``invoice_core.routing``); the stub answers it in ``--fast-latency`` seconds and
+misreads ``--fast-error-rate`` of its answers (a total off by a factor of ten or
+an impossible date). The report's ``routing`` has each tier's p50/p95 latency and
+escalation rate.
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from functools import partial
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .invoices import extract_csv_row, extract_json
+from .llm import LLMGateway, OpenAIBackend, estimate_tokens
+from .metrics import Metrics
+from .packing import InvoicePacker
+from .page_router import extract_pages
+from .progress import stage
+from .prompts import MODEL
+from .routing import ModelRouter, ModelTier
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+KINDS = ("digital", "scanned", "multipage", "many_items")
+DEFAULT_TOLERANCE = 0.2
+PAGE_WIDTH, PAGE_HEIGHT = 595, 842
+ROWS_PER_PAGE = 45
+CACHE_MIN_TOKENS = 1024
+CACHE_STEP_TOKENS = 128
+CACHED_PRICE = 0.5    # of an uncached prompt token
+PREFILL_SHARE = 0.1   # of the stub's latency spent reading the prompt, before the first token
+
+
+# ---------------------------------------------------------------- corpus
+
+
+def _escape(text):
+    return text.replace("\\", "\\\\").replace("(", "\\(").replace(")", "\\)")
+
+
+def write_text_pdf(pages, path):
+    """Minimal born-digital PDF: ``pages`` is a list of ``[(x, y from the top, text)]`` in Helvetica 9pt."""
+    objects = ["<< /Type /Catalog /Pages 2 0 R >>", None, "<< /Type /Font /Subtype /Type1 /BaseFont /Helvetica >>"]
+    kids = []
+    for items in pages:
+        content = " ".join(f"BT /F1 9 Tf {x} {PAGE_HEIGHT - y} Td ({_escape(text)}) Tj ET" for x, y, text in items)
+        objects.append(f"<< /Length {len(content)} >>\nstream\n{content}\nendstream")
+        objects.append(
+            f"<< /Type /Page /Parent 2 0 R /MediaBox [0 0 {PAGE_WIDTH} {PAGE_HEIGHT}] "
+            f"/Contents {len(objects)} 0 R /Resources << /Font << /F1 3 0 R >> >> >>"
+        )
+        kids.append(len(objects))
+    objects[1] = f"<< /Type /Pages /Kids [{' '.join(f'{kid} 0 R' for kid in kids)}] /Count {len(kids)} >>"
+    out = "%PDF-1.4\n"
+    offsets = []
+    for number, body in enumerate(objects, start=1):
+        offsets.append(len(out))
+        out += f"{number} 0 obj\n{body}\nendobj\n"
+    xref = len(out)
+    out += f"xref\n0 {len(objects) + 1}\n0000000000 65535 f \n" + "".join(f"{offset:010d} 00000 n \n" for offset in offsets)
+    out += f"trailer\n<< /Size {len(objects) + 1} /Root 1 0 R >>\nstartxref\n{xref}\n%%EOF\n"
+    with open(path, "w", encoding="latin-1") as handle:
+        handle.write(out)
+
+
+def write_scanned_pdf(pages, path, rng, dpi=150):
+    """The same layout rasterized like a scan: slight skew, speckle noise, no text layer."""
+    from PIL import Image, ImageDraw, ImageFont
+
+    scale = dpi / 72.0
+    try:
+        font = ImageFont.truetype("DejaVuSans.ttf", int(9 * scale))
+    except OSError:
+        font = ImageFont.load_default()
+    images = []
+    for items in pages:
+        image = Image.new("L", (int(PAGE_WIDTH * scale), int(PAGE_HEIGHT * scale)), 255)
+        draw = ImageDraw.Draw(image)
+        for x, y, text in items:
+            draw.text((x * scale, (y - 8) * scale), text, fill=0, font=font)
+        for _ in range(image.width * image.height // 2000):
+            draw.point((rng.randrange(image.width), rng.randrange(image.height)), fill=rng.randrange(90, 200))
+        image = image.rotate(rng.uniform(-0.8, 0.8), fillcolor=255, expand=False)
+        images.append(image.convert("RGB"))
+    # Fixed dates keep the file byte-identical for the same seed
+    fixed = time.strptime("20240101", "%Y%m%d")
+    images[0].save(path, "PDF", resolution=dpi, save_all=True, append_images=images[1:],
+                   creationDate=fixed, modDate=fixed)
+
+
+def invoice_layout(rng, number, items, repeat_header=True):
+    """Positioned text of an invoice with ``items`` line items, split over as many pages as needed."""
+    supplier = rng.choice(["Duck Island Limited", "Nisbets Plc", "Catering Direct Ltd", "Bunzl Catering"])
+    issued = date(2024, 1, 1) + timedelta(days=rng.randrange(365))
+    lines = []
+    for index in range(items):
+        quantity = rng.randint(1, 12)
+        unit = rng.randint(50, 20000) / 100
+        lines.append((f"C/HW{rng.randint(1000, 9999)}({index % 4})", f"Classic Hand Wash {index + 1} 5L",
+                      quantity, unit))
+    net = sum(quantity * unit for _, _, quantity, unit in lines)
+
+    pages = []
+    remaining = list(lines)
+    while True:
+        page_number = len(pages) + 1
+        page = [(50, 40, supplier.upper()), (450, 40, f"Page {page_number}"),
+                (50, 54, f"accounts@{supplier.split()[0].lower()}.co.uk")]
+        y = 80
+        if page_number == 1:
+            page += [(50, 80, f"Invoice No: {number:08d}"), (50, 94, f"Invoice Date: {issued:%d/%m/%Y}"),
+                     (50, 108, "Payment terms: 30 days"), (300, 80, "Ship To:"), (300, 94, "The Townhouse"),
+                     (300, 108, "High Street"), (300, 122, "Sutton Coldfield"), (300, 136, "B72 1UD"),
+                     (50, 136, f"Order Ref: H{rng.randint(100000, 999999)}")]
+            y = 170
+        if page_number == 1 or repeat_header:
+            page += [(50, y, "Item Code"), (130, y, "Description"), (330, y, "Qty"), (390, y, "Unit Price"),
+                     (470, y, "Line Total")]
+        y += 18
+        for code, description, quantity, unit in remaining[:ROWS_PER_PAGE]:
+            page += [(50, y, code), (130, y, description), (335, y, str(quantity)), (395, y, f"{unit:.2f}"),
+                     (475, y, f"{quantity * unit:,.2f}")]
+            y += 12
+        remaining = remaining[ROWS_PER_PAGE:]
+        if not remaining:
+            y += 12
+            page += [(390, y, "Sub Total"), (475, y, f"{net:,.2f}"), (390, y + 12, "VAT 20%"),
+                     (475, y + 12, f"{net * 0.2:,.2f}"), (390, y + 24, "Total"), (475, y + 24, f"{net * 1.2:,.2f}")]
+        page.append((180, 800, "Registered in England No. 01234567. Goods remain the property of the seller."))
+        pages.append(page)
+        if not remaining:
+            return pages
+
+
+def generate_corpus(directory, count=3, seed=1):
+    """Write ``count`` invoices of every kind to ``directory``; returns their paths."""
+    rng = random.Random(seed)
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    number = 1000
+    for kind in KINDS:
+        for index in range(count):
+            number += 1
+            path = os.path.join(directory, f"{kind}-{index + 1:03d}.pdf")
+            if kind == "digital":
+                write_text_pdf(invoice_layout(rng, number, rng.randint(2, 8)), path)
+            elif kind == "scanned":
+                write_scanned_pdf(invoice_layout(rng, number, rng.randint(2, 8)), path, rng)
+            elif kind == "multipage":
+                write_text_pdf(invoice_layout(rng, number, 2 * ROWS_PER_PAGE + 10), path)
+            else:
+                write_text_pdf(invoice_layout(rng, number, 150, repeat_header=False), path)
+            paths.append(path)
+    return paths
+
+
+# ---------------------------------------------------------------- stub servers
+
+
+STUB_FIELDS = {
+    "*ContactName": "Duck Island Limited", "EmailAddress": "accounts@duck.co.uk", "POAddressLine1": "The Townhouse",
+    "POAddressLine2": "High Street", "POAddressLine3": "", "POAddressLine4": "", "POCity": "Sutton Coldfield",
+    "PORegion": "", "POPostalCode": "B72 1UD", "POCountry": "", "*InvoiceNumber": "00001001",
+    "*InvoiceDate": "12/11/2024", "*DueDate": "12/12/2024", "Total": "55.82", "*AccountCode": "540",
+    "*TaxType": "20% (VAT on Expenses)", "TaxAmount": "9.30", "TrackingName1": "Order Reference",
+    "TrackingOption1": "Hotel Buyer", "TrackingName2": "", "TrackingOption2": "", "Currency": "GBP",
+}
+
+
+def stub_fields(text):
+    """STUB_FIELDS with the number, dates, tax and total read off a synthetic invoice's ``text``."""
+    fields = dict(STUB_FIELDS)
+    for name, pattern in (("*InvoiceNumber", r"Invoice No: (\d+)"), ("*InvoiceDate", r"Invoice Date: ([\d/]+)"),
+                          ("TaxAmount", r"VAT 20% ([\d,.]+)"), ("Total", r"^Total ([\d,.]+)")):
+        match = re.search(pattern, text, re.MULTILINE)
+        if match:
+            fields[name] = match.group(1).replace(",", "")
+    issued = re.search(r"Invoice Date: (\d\d)/(\d\d)/(\d{4})", text)
+    if issued:
+        due = date(int(issued.group(3)), int(issued.group(2)), int(issued.group(1))) + timedelta(days=30)
+        fields["*DueDate"] = f"{due:%d/%m/%Y}"
+    return fields
+
+
+def misread(fields, rng):
+    """A plausible mistake of a small model: a total off by a factor of ten, or a date that does not exist."""
+    fields = dict(fields)
+    if rng.random() < 0.5 and fields["Total"]:
+        fields["Total"] = f"{float(fields['Total']) * 10:.2f}"
+    else:
+        fields["*InvoiceDate"] = "31/02/2024"
+    return fields
+
+
+class _StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    error_rate = 0.0  # share of first answers that come back malformed
+    fast_latency = 0.0  # for models other than GPT-4
+    fast_error_rate = 0.0  # share of their answers with a misread value
+    rng = random.Random(0)
+    prefixes = []     # prompts seen so far, for the prefix cache
+    lock = threading.Lock()
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body):
+        payload = json.dumps(body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))) or b"null")
+        if not self.path.endswith("/chat/completions"):
+            self._reply(200, {"ok": True})  # webhook
+            return
+        prompt = "\n".join(message["content"] for message in request["messages"])
+        # Tool definitions are billed as prompt tokens too
+        billed = prompt + json.dumps(request.get("tools") or "")
+        malformed = "An earlier extraction" not in prompt and self.rng.random() < self.error_rate
+        fast = request["model"] != MODEL
+        wrong = fast and "An earlier extraction" not in prompt and self.rng.random() < self.fast_error_rate
+        answer = misread(stub_fields(prompt), self.rng) if wrong else stub_fields(prompt)
+        message = {"role": "assistant", "content": None}
+        if request.get("tools"):
+            # Function call with exactly the requested properties (structured.py)
+            fields = {name.lstrip("*"): value for name, value in answer.items()}
+            properties = request["tools"][0]["function"]["parameters"]["properties"]
+            arguments = {name: fields.get(name, "" if schema["type"] == "string" else [])
+                         for name, schema in properties.items()}
+            if malformed and "InvoiceDate" in arguments:
+                arguments["InvoiceDate"] = "the twelfth"
+            content = json.dumps(arguments)
+            message["tool_calls"] = [{"id": "call_bench", "type": "function",
+                                      "function": {"name": request["tools"][0]["function"]["name"],
+                                                   "arguments": content}}]
+        elif re.search(r"### Document d\d+", prompt):
+            documents = re.findall(r"### Document (d\d+)", prompt)
+            if malformed:
+                documents = documents[:-1]  # an answer that leaves a document out
+            texts = dict(re.findall(r"### Document (d\d+)\n(.*?)(?=### Document|\Z)", prompt, re.DOTALL))
+            content = json.dumps([dict({"document_id": document}, **stub_fields(texts.get(document, "")))
+                                  for document in documents])
+            message["content"] = content
+        elif "valid JSON" in prompt:
+            content = json.dumps(answer) + ("\nLet me know if you need anything else." if malformed else "")
+            message["content"] = content
+        else:
+            content = "\n".join(f"{name}: {value}" for name, value in answer.items())
+            message["content"] = content
+        usage = {"prompt_tokens": estimate_tokens(billed), "completion_tokens": estimate_tokens(content),
+                 "total_tokens": estimate_tokens(billed) + estimate_tokens(content)}
+        cached = self._cached_tokens(request)
+        usage["prompt_tokens_details"] = {"cached_tokens": min(cached, usage["prompt_tokens"])}
+        latency = self.fast_latency if fast else self.latency
+        prefill = latency * PREFILL_SHARE * (1 - usage["prompt_tokens_details"]["cached_tokens"]
+                                             / max(1, usage["prompt_tokens"]))
+        if request.get("stream"):
+            self._stream(request, message, content, usage, prefill, latency)
+            return
+        time.sleep(prefill + latency * (1 - PREFILL_SHARE))
+        self._reply(200, {
+            "id": "bench", "object": "chat.completion", "created": int(time.time()), "model": request["model"],
+            "choices": [{"index": 0, "finish_reason": "tool_calls" if request.get("tools") else "stop",
+                         "message": message}],
+            "usage": usage,
+        })
+
+    def _cached_tokens(self, request):
+        """Tokens of the longest prefix shared with an earlier prompt, as a provider prefix cache counts them."""
+        text = json.dumps(request.get("tools") or "") + "".join(
+            message["role"] + message["content"] for message in request["messages"]
+        )
+        with self.lock:
+            shared = max((len(os.path.commonprefix([text, seen])) for seen in self.prefixes), default=0)
+            self.prefixes.append(text)
+            del self.prefixes[:-64]
+        tokens = estimate_tokens(text[:shared]) if shared else 0
+        return tokens // CACHE_STEP_TOKENS * CACHE_STEP_TOKENS if tokens >= CACHE_MIN_TOKENS else 0
+
+    def _stream(self, request, message, content, usage, prefill, latency):
+        """Server-sent chunks of ~4 tokens; the rest of the latency is spread over the answer after the prefill."""
+        pieces = [content[index:index + 16] for index in range(0, len(content), 16)] or [""]
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.end_headers()
+
+        def send(choices, chunk_usage=None):
+            chunk = {"id": "bench", "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": request["model"], "choices": choices, "usage": chunk_usage}
+            self.wfile.write(b"data: " + json.dumps(chunk).encode("utf-8") + b"\n\n")
+            self.wfile.flush()
+
+        try:
+            time.sleep(prefill)
+            for index, piece in enumerate(pieces):
+                if message.get("tool_calls"):
+                    call = {"index": 0, "function": {"arguments": piece}}
+                    if index == 0:
+                        call.update(id="call_bench", type="function")
+                        call["function"]["name"] = message["tool_calls"][0]["function"]["name"]
+                    delta = {"tool_calls": [call]}
+                else:
+                    delta = {"content": piece}
+                if index == 0:
+                    delta["role"] = "assistant"
+                send([{"index": 0, "delta": delta, "finish_reason": None}])
+                time.sleep(latency * (1 - PREFILL_SHARE) / len(pieces))
+            send([{"index": 0, "delta": {}, "finish_reason": "tool_calls" if message.get("tool_calls") else "stop"}])
+            send([], usage)
+            self.wfile.write(b"data: [DONE]\n\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # the client cancelled the request
+
+
+def start_stub_server(latency=0.0, error_rate=0.0, seed=0, fast_latency=0.0, fast_error_rate=0.0):
+    """
+    OpenAI-compatible chat completions at ``<url>/v1``, anything else acts as the webhook.
+    ``error_rate`` of the answers (follow-up requests excepted) are malformed: trailing
+    prose after the JSON, an unparseable date in a function call, or a packed answer
+    that leaves out its last document. Models other than GPT-4 answer in ``fast_latency``
+    seconds and misread a value in ``fast_error_rate`` of their answers.
+    """
+    handler = type("StubHandler", (_StubHandler,), {"latency": latency, "error_rate": error_rate,
+                                                    "fast_latency": fast_latency, "fast_error_rate": fast_error_rate,
+                                                    "rng": random.Random(seed), "prefixes": [],
+                                                    "lock": threading.Lock()})
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, name="bench-stub", daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_address[1]}"
+
+
+# ---------------------------------------------------------------- run
+
+
+def peak_rss_mb():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def percentile(values, share):
+    if not values:
+        return None
+    ordered = sorted(values)
+    position = min(len(ordered) - 1, max(0, round(share * (len(ordered) - 1))))
+    return ordered[position]
+
+
+def run_benchmark(paths, flow="json", llm_latency=0.0, poppler_path=None, structured=False, error_rate=0.0,
+                  stream=False, workers=1, pack=False, fast_model=None, fast_latency=None, fast_error_rate=0.0):
+    from .webhook import WebhookDelivery
+
+    if fast_latency is None:
+        fast_latency = llm_latency / 3
+    server, url = start_stub_server(llm_latency, error_rate, fast_latency=fast_latency,
+                                    fast_error_rate=fast_error_rate)
+    workdir = tempfile.mkdtemp(prefix="invoice-bench-")
+    llm = LLMGateway(backend=OpenAIBackend(api_key="bench", base_url=url + "/v1"), max_retries=0)
+    webhook = WebhookDelivery(url + "/hook", outbox_path=os.path.join(workdir, "outbox.sqlite3"))
+    packer = InvoicePacker(llm) if pack else None
+    router = ModelRouter([ModelTier(fast_model, llm, fast_model), ModelTier(MODEL, llm, MODEL)]) if fast_model else None
+    metrics = Metrics()
+    page_counts = []
+    failures = {}
+
+    def process(path):
+        try:
+            pages = extract_pages(path, poppler_path=poppler_path, progress=metrics)
+            page_counts.append(len(pages))
+            with stage(metrics, path, "llm") as measures:
+                if flow == "csv":
+                    extract = partial(extract_csv_row, pages, measures=measures, structured=structured)
+                else:
+                    extract = partial(extract_json, pages, measures=measures, structured=structured, stream=stream)
+                if packer is not None:
+                    data = packer.extract(pages, measures=measures)
+                elif router is not None:
+                    data = router.extract(extract, measures=measures)
+                else:
+                    data = extract(llm)
+            if flow == "json":
+                with stage(metrics, path, "deliver") as measures:
+                    measures["bytes"] = len(json.dumps(data).encode("utf-8"))
+                    webhook.deliver(data)
+        except Exception as e:
+            failures[os.path.basename(path)] = str(e).splitlines()[0][:200] if str(e) else repr(e)
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+            list(pool.map(process, paths))
+        elapsed = time.perf_counter() - started
+    finally:
+        webhook.stop(flush=False)
+        server.shutdown()
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    stages = {}
+    for file_stages in metrics.files.values():
+        for name, values in file_stages.items():
+            stages.setdefault(name, []).append(values["seconds"])
+    first_fields = [file_stages["llm"]["first_field_seconds"] for file_stages in metrics.files.values()
+                    if "first_field_seconds" in file_stages.get("llm", {})]
+    llm_stages = [file_stages["llm"] for file_stages in metrics.files.values() if "llm" in file_stages]
+    tokens = [values.get("prompt_tokens", 0) + values.get("completion_tokens", 0) for values in llm_stages]
+    cached = [values.get("cached_tokens", 0) for values in llm_stages]
+    input_cost = [values.get("prompt_tokens", 0) - (1 - CACHED_PRICE) * values.get("cached_tokens", 0)
+                  for values in llm_stages]
+    return {
+        "files": len(paths),
+        "failed": len(failures),
+        "failures": failures,
+        "pages": sum(page_counts),
+        "seconds": round(elapsed, 3),
+        "pages_per_sec": round(sum(page_counts) / elapsed, 2) if elapsed else None,
+        "invoices_per_sec": round(len(paths) / elapsed, 2) if elapsed else None,
+        "llm_requests": llm.stats["requests"],
+        "peak_rss_mb": peak_rss_mb(),
+        "tokens_per_invoice": round(sum(tokens) / len(tokens), 1) if tokens else None,
+        "cached_tokens_per_invoice": round(sum(cached) / len(cached), 1) if cached else None,
+        "input_cost_per_invoice": round(sum(input_cost) / len(input_cost), 1) if input_cost else None,
+        "repairs": metrics.stages.get("llm", {}).get("repairs", 0),
+        "packing": dict(packer.stats) if packer is not None else None,
+        "routing": router.summary() if router is not None else None,
+        "first_field": {"p50": percentile(first_fields, 0.5), "p95": percentile(first_fields, 0.95)}
+        if first_fields else None,
+        "stages": {
+            name: {"runs": len(values), "p50": round(percentile(values, 0.5), 4), "p95": round(percentile(values, 0.95), 4)}
+            for name, values in stages.items()
+        },
+    }
+
+
+# ---------------------------------------------------------------- baselines
+
+
+def environment():
+    return {"python": platform.python_version(), "platform": platform.platform(), "cpus": os.cpu_count()}
+
+
+def compare(report, baseline, tolerance=DEFAULT_TOLERANCE):
+    """Regressions of ``report`` against ``baseline`` beyond ``tolerance`` (a share, 0.2 = 20%)."""
+    checks = [("pages_per_sec", report.get("pages_per_sec"), baseline.get("pages_per_sec"), False),
+              ("peak_rss_mb", report.get("peak_rss_mb"), baseline.get("peak_rss_mb"), True),
+              ("tokens_per_invoice", report.get("tokens_per_invoice"), baseline.get("tokens_per_invoice"), True),
+              ("input_cost_per_invoice", report.get("input_cost_per_invoice"), baseline.get("input_cost_per_invoice"),
+               True)]
+    for name, values in baseline.get("stages", {}).items():
+        current = report["stages"].get(name, {})
+        for key in ("p50", "p95"):
+            checks.append((f"{name}.{key}", current.get(key), values.get(key), True))
+    regressions = []
+    for name, current, previous, higher_is_worse in checks:
+        if current is None or not previous:
+            continue
+        change = (current - previous) / previous
+        if (change > tolerance) if higher_is_worse else (change < -tolerance):
+            regressions.append({"metric": name, "baseline": previous, "current": current,
+                                "change": f"{change:+.0%}"})
+    if report["failed"] > baseline.get("failed", 0):
+        regressions.append({"metric": "failed", "baseline": baseline.get("failed", 0), "current": report["failed"]})
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the extraction pipeline on synthetic invoices.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    generate_parser = commands.add_parser("generate", help="write the synthetic corpus")
+    generate_parser.add_argument("directory")
+    generate_parser.add_argument("--count", type=int, default=3, help="invoices of each kind")
+    generate_parser.add_argument("--seed", type=int, default=1)
+    run_parser = commands.add_parser("run", help="benchmark the pipeline with stub GPT and webhook servers")
+    run_parser.add_argument("--corpus", help="directory of PDFs (default: a fresh synthetic corpus)")
+    run_parser.add_argument("--count", type=int, default=3, help="invoices of each kind for a fresh corpus")
+    run_parser.add_argument("--seed", type=int, default=1)
+    run_parser.add_argument("--kinds", nargs="+", choices=KINDS, help="only these kinds of the synthetic corpus")
+    run_parser.add_argument("--flow", choices=("json", "csv"), default="json")
+    run_parser.add_argument("--llm-latency", type=float, default=0.0, help="seconds the stub GPT takes per request")
+    run_parser.add_argument("--structured", action="store_true", help="request the fields as a function call")
+    run_parser.add_argument("--stream", action="store_true", help="stream the answers (JSON flow), timing the first field")
+    run_parser.add_argument("--pack", action="store_true", help="send several short invoices per request (JSON flow)")
+    run_parser.add_argument("--workers", type=int, default=1, help="files processed at the same time")
+    run_parser.add_argument("--error-rate", type=float, default=0.0, help="share of malformed stub GPT answers")
+    run_parser.add_argument("--fast-model", help="route through this cheaper model first, escalating to GPT-4")
+    run_parser.add_argument("--fast-latency", type=float, help="seconds the stub takes for --fast-model (default: a third)")
+    run_parser.add_argument("--fast-error-rate", type=float, default=0.0, help="share of --fast-model answers misread")
+    run_parser.add_argument("--poppler-path")
+    run_parser.add_argument("--baseline", help="compare with this baseline; exit 1 on a regression")
+    run_parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    run_parser.add_argument("--save-baseline", help="write the report as the new baseline")
+    args = parser.parse_args(argv)
+
+    if args.command == "generate":
+        paths = generate_corpus(args.directory, args.count, args.seed)
+        print(f"Wrote {len(paths)} invoices to {args.directory}", file=sys.stderr)
+        return 0
+
+    corpus = args.corpus or tempfile.mkdtemp(prefix="invoice-corpus-")
+    try:
+        paths = generate_corpus(corpus, args.count, args.seed) if not args.corpus else sorted(
+            os.path.join(corpus, name) for name in os.listdir(corpus) if name.lower().endswith(".pdf")
+        )
+        if args.kinds:
+            paths = [path for path in paths if os.path.basename(path).rsplit("-", 1)[0] in args.kinds]
+        report = run_benchmark(paths, flow=args.flow, llm_latency=args.llm_latency, poppler_path=args.poppler_path,
+                               structured=args.structured, error_rate=args.error_rate, stream=args.stream,
+                               workers=args.workers, pack=args.pack, fast_model=args.fast_model,
+                               fast_latency=args.fast_latency, fast_error_rate=args.fast_error_rate)
+    finally:
+        if not args.corpus:
+            shutil.rmtree(corpus, ignore_errors=True)
+    report["environment"] = environment()
+    report["settings"] = {"flow": args.flow, "llm_latency": args.llm_latency, "corpus": args.corpus,
+                          "count": args.count, "seed": args.seed, "kinds": args.kinds,
+                          "structured": args.structured, "error_rate": args.error_rate, "stream": args.stream,
+                          "workers": args.workers, "pack": args.pack, "fast_model": args.fast_model,
+                          "fast_latency": args.fast_latency, "fast_error_rate": args.fast_error_rate}
+
+    status = 0
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as handle:
+            baseline = json.load(handle)
+        if baseline.get("settings") != report["settings"]:
+            print("Warning: the baseline was recorded with different settings", file=sys.stderr)
+        report["regressions"] = compare(report, baseline, args.tolerance)
+        status = 1 if report["regressions"] else 0
+    print(json.dumps(report, indent=2))
+    if args.save_baseline:
+        with open(args.save_baseline, "w", encoding="utf-8") as handle:
+            json.dump(report, handle, indent=2)
+    return status
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,237 @@
+"""
+Content-addressed extraction cache.
+
+Entries are keyed by the SHA-256 of the PDF bytes plus a layer name and that
+layer's version string, so each stage can be invalidated on its own:
+
+- ``text``: the raw pdfplumber text layer and routing decision per page,
+- ``ocr``: the per-page OCR text,
+- ``llm``: the parsed LLM output (versioned by the prompt/model).
+
+Bumping a prompt version therefore only misses the ``llm`` layer; the OCR work
+for a re-dropped PDF is still reused. Everything lives in a single SQLite file,
+bounded in size with least-recently-used eviction.
+
+Inspect or purge it from the command line::
+
+    python -m invoice_core.cache stats
+    python -m invoice_core.cache list --layer llm
+    python -m invoice_core.cache purge --layer ocr
+"""
+import argparse
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_CACHE_DIR = os.getenv(
+    "INVOICE_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "ocr-ai-extract")
+)
+DEFAULT_MAX_BYTES = int(os.getenv("INVOICE_CACHE_MAX_MB", "512")) * 1024 * 1024
+
+LAYERS = ("text", "ocr", "llm")
+
+
+def file_digest(file, chunk_size=1024 * 1024):
+    """SHA-256 of a path or a seekable file-like object (rewound afterwards)."""
+    sha = hashlib.sha256()
+    if isinstance(file, (str, os.PathLike)):
+        with open(file, "rb") as handle:
+            for chunk in iter(lambda: handle.read(chunk_size), b""):
+                sha.update(chunk)
+    else:
+        file.seek(0)
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            sha.update(chunk)
+        file.seek(0)
+    return sha.hexdigest()
+
+
+def default_cache():
+    """The shared on-disk cache, or None when disabled with INVOICE_CACHE=0."""
+    if os.getenv("INVOICE_CACHE", "1") == "0":
+        return None
+    return ExtractionCache()
+
+
+class ExtractionCache:
+    def __init__(self, directory=DEFAULT_CACHE_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self._conn = None
+        # One connection is shared by the I/O threads; sqlite3 connections are not safe to use concurrently
+        self._lock = threading.RLock()
+
+    # The connection is opened lazily so the cache can be handed to pool workers
+    def __getstate__(self):
+        return {"directory": self.directory, "max_bytes": self.max_bytes}
+
+    def __setstate__(self, state):
+        self.__init__(state["directory"], state["max_bytes"])
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, "cache.sqlite3")
+
+    def _connect(self):
+        # Callers hold self._lock
+        if self._conn is None:
+            os.makedirs(self.directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS entries (
+                    digest TEXT NOT NULL,
+                    layer TEXT NOT NULL,
+                    version TEXT NOT NULL,
+                    payload BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    created_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL,
+                    PRIMARY KEY (digest, layer, version)
+                )
+                """
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS entries_lru ON entries (accessed_at)")
+            self._conn.commit()
+        return self._conn
+
+    def get(self, digest, layer, version):
+        """Return the cached value or None, marking the entry as recently used."""
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT payload FROM entries WHERE digest = ? AND layer = ? AND version = ?",
+                (digest, layer, version),
+            ).fetchone()
+            if row is None:
+                return None
+            with conn:
+                conn.execute(
+                    "UPDATE entries SET accessed_at = ? WHERE digest = ? AND layer = ? AND version = ?",
+                    (time.time(), digest, layer, version),
+                )
+            return json.loads(row[0])
+
+    def put(self, digest, layer, version, value):
+        if layer not in LAYERS:
+            raise ValueError(f"Unknown cache layer: {layer}")
+        payload = json.dumps(value).encode("utf-8")
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO entries VALUES (?, ?, ?, ?, ?, ?, ?)",
+                    (digest, layer, version, payload, len(payload), now, now),
+                )
+            self.evict()
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits in ``max_bytes``."""
+        with self._lock:
+            conn = self._connect()
+            total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            if total <= self.max_bytes:
+                return 0
+            removed = 0
+            with conn:
+                rows = conn.execute(
+                    "SELECT digest, layer, version, size FROM entries ORDER BY accessed_at"
+                ).fetchall()
+                for digest, layer, version, size in rows:
+                    if total <= self.max_bytes:
+                        break
+                    conn.execute(
+                        "DELETE FROM entries WHERE digest = ? AND layer = ? AND version = ?",
+                        (digest, layer, version),
+                    )
+                    total -= size
+                    removed += 1
+            return removed
+
+    def entries(self, layer=None, digest=None):
+        with self._lock:
+            query = "SELECT digest, layer, version, size, created_at, accessed_at FROM entries WHERE 1 = 1"
+            params = []
+            if layer:
+                query += " AND layer = ?"
+                params.append(layer)
+            if digest:
+                query += " AND digest LIKE ?"
+                params.append(digest + "%")
+            query += " ORDER BY accessed_at DESC"
+            keys = ("digest", "layer", "version", "size", "created_at", "accessed_at")
+            return [dict(zip(keys, row)) for row in self._connect().execute(query, params)]
+
+    def stats(self):
+        with self._lock:
+            rows = self._connect().execute(
+                "SELECT layer, COUNT(*), COALESCE(SUM(size), 0) FROM entries GROUP BY layer"
+            ).fetchall()
+            layers = {layer: {"entries": count, "bytes": size} for layer, count, size in rows}
+            return {
+                "path": self.path,
+                "max_bytes": self.max_bytes,
+                "bytes": sum(layer["bytes"] for layer in layers.values()),
+                "layers": layers,
+            }
+
+    def purge(self, layer=None, digest=None, older_than=None):
+        """Delete matching entries; with no filters the whole cache is cleared."""
+        with self._lock:
+            query = "DELETE FROM entries WHERE 1 = 1"
+            params = []
+            if layer:
+                query += " AND layer = ?"
+                params.append(layer)
+            if digest:
+                query += " AND digest LIKE ?"
+                params.append(digest + "%")
+            if older_than is not None:
+                query += " AND accessed_at < ?"
+                params.append(time.time() - older_than)
+            conn = self._connect()
+            with conn:
+                removed = conn.execute(query, params).rowcount
+            conn.execute("VACUUM")
+            return removed
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect or purge the invoice extraction cache.")
+    parser.add_argument("--dir", default=DEFAULT_CACHE_DIR, help="cache directory")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("stats", help="show entry counts and size per layer")
+
+    list_parser = commands.add_parser("list", help="list cached entries, most recently used first")
+    list_parser.add_argument("--layer", choices=LAYERS)
+    list_parser.add_argument("--digest", help="SHA-256 prefix of the PDF")
+
+    purge_parser = commands.add_parser("purge", help="delete cached entries")
+    purge_parser.add_argument("--layer", choices=LAYERS)
+    purge_parser.add_argument("--digest", help="SHA-256 prefix of the PDF")
+    purge_parser.add_argument("--older-than", type=float, metavar="DAYS",
+                              help="only entries not used in the last DAYS days")
+
+    args = parser.parse_args(argv)
+    cache = ExtractionCache(args.dir)
+
+    if args.command == "stats":
+        print(json.dumps(cache.stats(), indent=2))
+    elif args.command == "list":
+        for entry in cache.entries(layer=args.layer, digest=args.digest):
+            used = time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["accessed_at"]))
+            print(f"{entry['digest'][:16]}  {entry['layer']:<4}  {entry['version']:<24}  {entry['size']:>9}  {used}")
+    elif args.command == "purge":
+        older_than = args.older_than * 86400 if args.older_than is not None else None
+        removed = cache.purge(layer=args.layer, digest=args.digest, older_than=older_than)
+        print(f"Removed {removed} entries.")
+
+
+if __name__ == "__main__":
+    main()
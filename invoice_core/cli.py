@@ -0,0 +1,352 @@
+"""
+Headless batch runner for servers and watched folders.
+
+Runs the same extraction as the desktop tools over directories or globs::
+
+    python -m invoice_core.cli invoices/ --output csv --out invoices.csv
+    python -m invoice_core.cli "inbox/**/*.pdf" --output jsonl --out invoices.jsonl --workers 8
+    python -m invoice_core.cli inbox/ --output webhook --checkpoint inbox.checkpoint
+
+``csv`` writes the rows of ``pdf-to-csv``; ``jsonl`` and ``webhook`` produce the
+JSON payload of ``pdf-to-json-webhook`` (one JSON object per line, or posted to
+``MAKE_WEBHOOK_URL`` through the durable outbox). ``parquet`` appends the JSON
+payloads to typed header/line-item datasets under the ``--out`` directory
+(``invoice_core.columnar``, needs ``pyarrow``).
+
+Records are appended and flushed as each file finishes (``invoice_core.sink``);
+``--out x.csv.gz`` compresses and ``--rotate-rows``/``--rotate-mb`` roll the
+output over into atomically renamed segments.
+
+Every finished file is appended to the checkpoint file (fsync-ed) after its
+output is written, so an interrupted run started again with the same
+``--checkpoint`` skips the files that are done. A file is only skipped while its
+size and modification time are unchanged. Output goes to the same file in
+append mode; a file interrupted between writing its output and its checkpoint
+line is processed again on resume.
+
+The JSON summary printed at the end has wall/CPU seconds, pages, bytes, tokens
+and retries per stage (``invoice_core.metrics``); ``--metrics-log`` also writes
+them per file and stage as JSON lines. Prompts and GPT answers are only printed
+with ``--verbose``. ``--structured`` asks GPT for a schema-checked function call
+instead of free text (``invoice_core.structured``). ``--stream`` reads the JSON
+answer as it is generated and stops it as soon as the header shows a duplicate
+invoice or a document that is not an invoice (``invoice_core.streaming``).
+``--pack`` sends several short invoices in one request (``invoice_core.packing``).
+``--fast-model`` tries a cheaper model (or ``--fast-base-url``, a local
+OpenAI-compatible server) first and sends only the answers that fail validation
+to GPT-4 (``invoice_core.routing``); the summary has each tier's latency and
+escalation rate.
+"""
+import argparse
+import csv
+import glob
+import json
+import logging
+import multiprocessing
+import os
+import sys
+import time
+from functools import partial
+
+from .batch import BatchEngine
+from .cache import default_cache, file_digest
+from .invoices import (CSV_COLUMNS, CSV_PROMPT_VERSION, JSON_PROMPT_VERSION, extract_csv_row, extract_json,
+                       prompt_version)
+from .llm import StreamCancelled, get_gateway
+from .metrics import Metrics
+from .metrics import logger as metrics_logger
+from .packing import PACKED_PROMPT_VERSION, InvoicePacker
+from .page_router import extract_pages
+from .progress import stage
+from .routing import get_router, routed_version
+from .sink import RecordSink
+from .streaming import DuplicateGuard, reject_early
+from .templates import TemplateStore
+
+OUTPUTS = ("csv", "jsonl", "webhook", "parquet")
+
+
+def find_pdfs(inputs):
+    """PDF paths from directories (searched recursively), globs and plain paths, sorted."""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            for folder, _, names in os.walk(item):
+                paths.update(os.path.join(folder, name) for name in names if name.lower().endswith(".pdf"))
+        else:
+            paths.update(path for path in glob.glob(item, recursive=True) if path.lower().endswith(".pdf"))
+    return sorted(os.path.abspath(path) for path in paths)
+
+
+class Checkpoint:
+    """Append-only JSON-lines record of finished files."""
+
+    def __init__(self, path):
+        self.path = path
+        self.records = {}
+        if path and os.path.exists(path):
+            with open(path, encoding="utf-8") as handle:
+                for line in handle:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # a line cut short by the interruption
+                    self.records[record["key"]] = record
+        self._handle = open(path, "a", encoding="utf-8") if path else None
+
+    @staticmethod
+    def key(path):
+        stat = os.stat(path)
+        return f"{os.path.abspath(path)}|{stat.st_size}|{stat.st_mtime_ns}"
+
+    def is_done(self, path, retry_failed=True):
+        record = self.records.get(self.key(path))
+        return record is not None and (record["ok"] or not retry_failed)
+
+    def record(self, path, ok, error=None):
+        if self._handle is None:
+            return
+        record = {"key": self.key(path), "file": path, "ok": ok, "error": error, "time": time.time()}
+        self.records[record["key"]] = record
+        self._handle.write(json.dumps(record) + "\n")
+        self._handle.flush()
+        os.fsync(self._handle.fileno())
+
+    def close(self):
+        if self._handle is not None:
+            self._handle.close()
+
+
+class Runner:
+    """The I/O stage for one output kind; runs in the batch engine's thread pool."""
+
+    def __init__(self, output, llm, cache=None, templates=None, webhook=None, verbose=False, progress=None,
+                 structured=False, stream=False, packer=None, router=None):
+        self.output = output
+        self.structured = structured
+        self.packer = packer
+        self.router = router
+        # Streamed JSON answers are checked field by field and dropped early for repeats and non-invoices
+        self.guard = DuplicateGuard() if stream else None
+        self.progress = progress
+        self.llm = llm
+        self.cache = cache
+        self.templates = templates
+        self.webhook = webhook
+        self.verbose = verbose
+
+    def __call__(self, file_path, pages):
+        options = {"debug": self.verbose, "structured": self.structured}
+        if self.output == "csv":
+            version = routed_version(prompt_version(CSV_PROMPT_VERSION, self.structured), self.router)
+            data = self._cached(file_path, version, self._routed(partial(extract_csv_row, pages, **options)))
+            return {"data": data}
+        if self.guard is not None:
+            options.update(stream=True, on_field=reject_early(file_path, self.guard))
+        version = routed_version(prompt_version(JSON_PROMPT_VERSION, self.structured), self.router)
+        # A fast model's rejected answer may have claimed a misread invoice number
+        release = partial(self.guard.release, file_path) if self.guard is not None else None
+        extract = self._routed(partial(extract_json, pages, **options), release)
+        if self.packer is not None:
+            version = PACKED_PROMPT_VERSION
+            extract = partial(self.packer.extract, pages, self.templates)
+        try:
+            data = self._cached(file_path, version, lambda measures: extract(measures=measures))
+        except StreamCancelled as e:
+            return {"data": None, "rejected": e.reason}
+        except Exception:
+            if self.guard is not None:
+                self.guard.release(file_path)
+            raise
+        if self.output == "webhook":
+            # Undelivered payloads stay in the outbox and are retried in the background
+            with stage(self.progress, file_path, "deliver") as measures:
+                measures["bytes"] = len(json.dumps(data).encode("utf-8"))
+                delivered = self.webhook.deliver(data)
+            return {"data": data, "delivered": delivered}
+        return {"data": data}
+
+    def _routed(self, extract, on_escalate=None):
+        """``extract(llm, templates, measures=...)`` as a function of the measures, through the router if any."""
+        if self.router is None:
+            return lambda measures: extract(self.llm, self.templates, measures=measures)
+        return lambda measures: self.router.extract(
+            lambda llm, templates: extract(llm, templates, measures=measures), self.templates, measures,
+            on_escalate=on_escalate)
+
+    def _cached(self, file_path, version, extract):
+        digest = file_digest(file_path) if self.cache else None
+        data = self.cache.get(digest, "llm", version) if self.cache else None
+        if data is None:
+            with stage(self.progress, file_path, "llm") as measures:
+                data = extract(measures)
+            if self.cache:
+                self.cache.put(digest, "llm", version, data)
+        return data
+
+
+class OutputWriter:
+    """csv/jsonl records to stdout or an incremental ``RecordSink``, parquet datasets; nothing for webhook output."""
+
+    def __init__(self, output, path, rotate_rows=0, rotate_bytes=0):
+        self.output = output
+        self._sink = None
+        self._csv = None
+        self._parquet = None
+        if output == "webhook":
+            return
+        if output == "parquet":
+            if path in (None, "-"):
+                raise ValueError("parquet output needs --out <directory>")
+            from .columnar import ParquetExporter
+            self._parquet = ParquetExporter(path)
+            return
+        if path not in (None, "-"):
+            self._sink = RecordSink(path, fmt=output, columns=CSV_COLUMNS if output == "csv" else None,
+                                    rotate_rows=rotate_rows, rotate_bytes=rotate_bytes)
+        elif output == "csv":
+            self._csv = csv.DictWriter(sys.stdout, fieldnames=CSV_COLUMNS)
+            self._csv.writeheader()
+
+    def write(self, file_path, result):
+        if self.output == "webhook":
+            return
+        if self._parquet is not None:
+            self._parquet.write(result["data"], source=file_path)
+            return
+        record = result["data"] if self.output == "csv" else {"file": file_path, "data": result["data"]}
+        if self._sink is not None:
+            self._sink.write(record)
+        elif self._csv is not None:
+            self._csv.writerow(record)
+            sys.stdout.flush()
+        else:
+            print(json.dumps(record), flush=True)
+
+    def close(self):
+        if self._sink is not None:
+            self._sink.close()
+        if self._parquet is not None:
+            self._parquet.close()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Extract invoice data from PDFs without the GUI.")
+    parser.add_argument("inputs", nargs="+", help="directories (searched recursively), globs or PDF files")
+    parser.add_argument("--output", choices=OUTPUTS, default="csv")
+    parser.add_argument("--out", help="output file for csv/jsonl, .gz to compress (appended to; default stdout); directory for parquet")
+    parser.add_argument("--rotate-rows", type=int, default=0, help="start a new output file every N records")
+    parser.add_argument("--rotate-mb", type=float, default=0, help="start a new output file every N megabytes")
+    parser.add_argument("--checkpoint", help="checkpoint file; finished files are skipped when it is reused")
+    parser.add_argument("--no-retry-failed", action="store_true", help="also skip files that failed in a previous run")
+    parser.add_argument("--workers", type=int, help="extraction/OCR processes (default: CPU count)")
+    parser.add_argument("--poppler-path")
+    parser.add_argument("--webhook-url", help="default: MAKE_WEBHOOK_URL")
+    parser.add_argument("--verbose", action="store_true", help="print prompts and GPT answers")
+    parser.add_argument("--structured", action="store_true",
+                        help="ask for the fields as a JSON-schema function call; only invalid fields are re-requested")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream GPT answers; stop early for duplicate invoices and non-invoices (JSON outputs)")
+    parser.add_argument("--pack", action="store_true",
+                        help="send several short invoices in one GPT request (JSON outputs, not with --structured/--stream)")
+    parser.add_argument("--fast-model", default=os.getenv("LLM_FAST_MODEL"),
+                        help="try this cheaper model first; only answers that fail validation go to GPT-4")
+    parser.add_argument("--fast-base-url", default=os.getenv("LLM_FAST_BASE_URL"),
+                        help="OpenAI-compatible endpoint serving --fast-model, e.g. a local server")
+    parser.add_argument("--metrics-log", help="append one JSON line per finished stage of every file to this file")
+    args = parser.parse_args(argv)
+    if args.output == "parquet" and args.out in (None, "-"):
+        parser.error("--output parquet needs --out <directory>")
+    if (args.stream or args.pack) and args.output == "csv":
+        parser.error("--stream and --pack apply to the JSON outputs (jsonl, webhook, parquet)")
+    if args.pack and (args.structured or args.stream or args.fast_model):
+        parser.error("--pack cannot be combined with --structured, --stream or --fast-model")
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    checkpoint = Checkpoint(args.checkpoint)
+    files = find_pdfs(args.inputs)
+    pending = [path for path in files if not checkpoint.is_done(path, retry_failed=not args.no_retry_failed)]
+    print(f"{len(files)} PDFs found, {len(files) - len(pending)} already done, {len(pending)} to process",
+          file=sys.stderr)
+
+    webhook = None
+    if args.output == "webhook":
+        from .webhook import WebhookDelivery
+        webhook = WebhookDelivery(args.webhook_url or os.getenv("MAKE_WEBHOOK_URL"))
+
+    if args.metrics_log:
+        handler = logging.FileHandler(args.metrics_log)
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        metrics_logger.addHandler(handler)
+        metrics_logger.setLevel(logging.INFO)
+        metrics_logger.propagate = False
+    metrics = Metrics(log=metrics_logger if args.metrics_log else None)
+    manager = listener = None
+    progress = metrics
+    if args.workers != 0:
+        # Extraction runs in worker processes; their stage events come back through a managed queue
+        manager = multiprocessing.Manager()
+        events = manager.Queue()
+        listener = metrics.listen(events)
+        progress = events.put
+
+    cache = default_cache()
+    llm = get_gateway(api_key=os.getenv("OPENAI_API_KEY"))
+    runner = Runner(args.output, llm, cache=cache, templates=TemplateStore(), webhook=webhook, verbose=args.verbose,
+                    progress=progress, structured=args.structured, stream=args.stream,
+                    packer=InvoicePacker(llm, debug=args.verbose) if args.pack else None,
+                    router=get_router(llm, args.fast_model, args.fast_base_url, debug=args.verbose))
+    engine = BatchEngine(partial(extract_pages, poppler_path=args.poppler_path, cache=cache, progress=progress), runner,
+                         cpu_workers=args.workers, io_workers=llm.max_in_flight, ordered=False)
+    writer = OutputWriter(args.output, args.out, args.rotate_rows, int(args.rotate_mb * 1024 * 1024))
+
+    summary = {"found": len(files), "skipped": len(files) - len(pending), "ok": 0, "failed": 0, "undelivered": 0,
+               "rejected": 0}
+    started = time.perf_counter()
+    try:
+        for result in engine.run(pending):
+            path = result["file"]
+            if result["ok"] and result["result"].get("rejected"):
+                print(f"Skipped {path}: {result['result']['rejected']}", file=sys.stderr)
+                summary["rejected"] += 1
+                checkpoint.record(path, True, result["result"]["rejected"])
+                continue
+            if result["ok"]:
+                writer.write(path, result["result"])
+                summary["ok"] += 1
+                summary["undelivered"] += int(result["result"].get("delivered") is False)
+            else:
+                print(f"Error processing {path}: {result['error']}", file=sys.stderr)
+                summary["failed"] += 1
+            checkpoint.record(path, result["ok"], result["error"])
+    except KeyboardInterrupt:
+        print("Interrupted; run again with the same --checkpoint to resume.", file=sys.stderr)
+        summary["interrupted"] = True
+    finally:
+        writer.close()
+        checkpoint.close()
+        if webhook is not None:
+            webhook.stop()
+        if listener is not None:
+            events.put(None)
+            listener.join()
+            manager.shutdown()
+
+    summary["seconds"] = round(time.perf_counter() - started, 2)
+    summary["stages"] = metrics.summary()["stages"]
+    summary["llm"] = dict(llm.stats)
+    if runner.packer is not None:
+        summary["packing"] = dict(runner.packer.stats)
+    if runner.router is not None:
+        summary["routing"] = runner.router.summary()
+    print(json.dumps(summary), file=sys.stderr)
+    return 1 if summary["failed"] or summary.get("interrupted") else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,373 @@
+"""
+Typed columnar export of extracted invoices for analytics.
+
+``ParquetExporter`` writes two Parquet datasets under one root::
+
+    <root>/headers/invoice_month=2024-11/part-....parquet
+    <root>/lines/invoice_month=2024-11/part-....parquet
+
+- ``headers``: one row per invoice, amounts as ``decimal128`` and dates as
+  ``date32`` (unparseable values become nulls rather than strings).
+- ``lines``: one row per line item, exploded from the list-valued
+  ``InventoryItemCode`` / ``Description`` / ``*Quantity`` / ``*UnitAmount`` of
+  the JSON flow (a CSV row gives a single line), joined on ``invoice_id``.
+
+Both are partitioned by invoice month (``unknown`` when the date is missing).
+Every flush adds new uniquely named files, so exporting into an existing root
+appends to the datasets without touching what is there.
+
+Needs the optional ``pyarrow`` package. ``python -m invoice_core.columnar``
+converts existing CSV/JSONL exports and benchmarks against the CSV path::
+
+    python -m invoice_core.columnar convert invoices.csv warehouse/
+    python -m invoice_core.columnar bench --rows 50000
+"""
+import argparse
+import csv
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+import tempfile
+import time
+import uuid
+from datetime import date, datetime, timezone
+from decimal import ROUND_HALF_UP, Decimal, InvalidOperation
+
+from .invoices import CSV_COLUMNS, default_row
+from .sink import RecordSink
+
+try:
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+except ImportError:
+    pa = ds = None
+
+BATCH_ROWS = 1000
+DATE_FORMATS = ("%d/%m/%Y", "%Y-%m-%d", "%d-%b-%y")
+UNKNOWN_MONTH = "unknown"
+
+# Source field -> (column, type)
+HEADER_FIELDS = [
+    ("*ContactName", "contact_name", "string"),
+    ("EmailAddress", "email_address", "string"),
+    ("POAddressLine1", "po_address_line1", "string"),
+    ("POAddressLine2", "po_address_line2", "string"),
+    ("POAddressLine3", "po_address_line3", "string"),
+    ("POAddressLine4", "po_address_line4", "string"),
+    ("POCity", "po_city", "string"),
+    ("PORegion", "po_region", "string"),
+    ("POPostalCode", "po_postal_code", "string"),
+    ("POCountry", "po_country", "string"),
+    ("*InvoiceNumber", "invoice_number", "string"),
+    ("*InvoiceDate", "invoice_date", "date"),
+    ("*DueDate", "due_date", "date"),
+    ("Total", "total", "money"),
+    ("*AccountCode", "account_code", "string"),
+    ("*TaxType", "tax_type", "string"),
+    ("TaxAmount", "tax_amount", "money"),
+    ("TrackingName1", "tracking_name1", "string"),
+    ("TrackingOption1", "tracking_option1", "string"),
+    ("TrackingName2", "tracking_name2", "string"),
+    ("TrackingOption2", "tracking_option2", "string"),
+    ("Currency", "currency", "string"),
+]
+LINE_FIELDS = [
+    ("InventoryItemCode", "item_code", "string"),
+    ("Description", "description", "string"),
+    ("*Quantity", "quantity", "quantity"),
+    ("*UnitAmount", "unit_amount", "unit"),
+]
+SCALES = {"money": 2, "quantity": 4, "unit": 4}
+
+
+def _require_pyarrow():
+    if pa is None:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+
+
+def _arrow_type(kind):
+    if kind == "date":
+        return pa.date32()
+    if kind in SCALES:
+        return pa.decimal128(18, SCALES[kind])
+    return pa.string()
+
+
+def header_schema():
+    _require_pyarrow()
+    return pa.schema(
+        [("invoice_id", pa.string()), ("source", pa.string())]
+        + [(column, _arrow_type(kind)) for _, column, kind in HEADER_FIELDS]
+        + [("line_count", pa.int32()), ("exported_at", pa.timestamp("ms", tz="UTC")), ("invoice_month", pa.string())]
+    )
+
+
+def line_schema():
+    _require_pyarrow()
+    return pa.schema(
+        [("invoice_id", pa.string()), ("line_number", pa.int32())]
+        + [(column, _arrow_type(kind)) for _, column, kind in LINE_FIELDS]
+        + [("invoice_month", pa.string())]
+    )
+
+
+def to_decimal(value, scale=2):
+    """Decimal for amounts such as "£1,234.50"; None when there is no number."""
+    if value is None or value == "":
+        return None
+    cleaned = re.sub(r"[^\d.\-]", "", str(value))
+    try:
+        return Decimal(cleaned).quantize(Decimal(1).scaleb(-scale), rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        return None
+
+
+def to_date(value):
+    if not value:
+        return None
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(str(value).strip(), fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _convert(value, kind):
+    if isinstance(value, list):
+        value = ", ".join(str(item) for item in value)
+    if kind == "date":
+        return to_date(value)
+    if kind in SCALES:
+        return to_decimal(value, SCALES[kind])
+    return "" if value is None else str(value)
+
+
+def _as_list(value):
+    if isinstance(value, list):
+        return value
+    return [] if value in (None, "") else [value]
+
+
+def invoice_id(record, source=None):
+    """Stable key joining a header to its lines: the file when known, else supplier and number."""
+    basis = source or f"{record.get('*ContactName', '')}|{record.get('*InvoiceNumber', '')}"
+    return hashlib.sha1(basis.encode("utf-8")).hexdigest()
+
+
+def split_invoice(record, source=None, exported_at=None):
+    """(header row, line rows) for a CSV row or JSON payload."""
+    key = invoice_id(record, source)
+    header = {"invoice_id": key, "source": source or ""}
+    for field, column, kind in HEADER_FIELDS:
+        header[column] = _convert(record.get(field), kind)
+    month = header["invoice_date"].strftime("%Y-%m") if header["invoice_date"] else UNKNOWN_MONTH
+
+    values = {column: _as_list(record.get(field)) for field, column, _ in LINE_FIELDS}
+    # Quantity alone ("1" is the CSV default) does not make a line
+    count = max(len(values[column]) for column in ("item_code", "description", "unit_amount"))
+    lines = []
+    for index in range(count):
+        line = {"invoice_id": key, "line_number": index + 1}
+        for _, column, kind in LINE_FIELDS:
+            items = values[column]
+            line[column] = _convert(items[index] if index < len(items) else None, kind)
+        line["invoice_month"] = month
+        lines.append(line)
+
+    header["line_count"] = len(lines)
+    header["exported_at"] = exported_at or datetime.now(timezone.utc)
+    header["invoice_month"] = month
+    return header, lines
+
+
+class ParquetExporter:
+    """Buffers invoices and appends them to the partitioned header and line datasets."""
+
+    def __init__(self, root, batch_rows=BATCH_ROWS, compression="zstd"):
+        _require_pyarrow()
+        self.root = root
+        self.batch_rows = batch_rows
+        self.compression = compression
+        self.rows = 0
+        self.files = []
+        self._headers = []
+        self._lines = []
+        self._header_schema = header_schema()
+        self._line_schema = line_schema()
+        os.makedirs(root, exist_ok=True)
+
+    def write(self, record, source=None):
+        header, lines = split_invoice(record, source)
+        self._headers.append(header)
+        self._lines.extend(lines)
+        self.rows += 1
+        if len(self._headers) >= self.batch_rows:
+            self.flush()
+
+    def flush(self):
+        if not self._headers:
+            return
+        batch = f"{time.strftime('%Y%m%d-%H%M%S')}-{uuid.uuid4().hex[:8]}"
+        self._write("headers", pa.Table.from_pylist(self._headers, schema=self._header_schema), batch)
+        if self._lines:
+            self._write("lines", pa.Table.from_pylist(self._lines, schema=self._line_schema), batch)
+        self._headers, self._lines = [], []
+
+    def _write(self, name, table, batch):
+        partitioning = ds.partitioning(pa.schema([("invoice_month", pa.string())]), flavor="hive")
+        ds.write_dataset(
+            table, os.path.join(self.root, name), format="parquet", partitioning=partitioning,
+            basename_template=f"part-{batch}-{{i}}.parquet", existing_data_behavior="overwrite_or_ignore",
+            file_options=ds.ParquetFileFormat().make_write_options(compression=self.compression),
+            file_visitor=lambda written: self.files.append(written.path),
+        )
+
+    def close(self):
+        self.flush()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+def read_dataset(root, name="headers"):
+    """The ``headers`` or ``lines`` dataset under ``root`` as a pyarrow Table."""
+    _require_pyarrow()
+    return ds.dataset(os.path.join(root, name), format="parquet", partitioning="hive").to_table()
+
+
+def _open_text(path):
+    return gzip.open(path, "rt", encoding="utf-8", newline="") if path.endswith(".gz") else \
+        open(path, encoding="utf-8", newline="")
+
+
+def read_records(path):
+    """(record, source) pairs from a CSV or JSONL export."""
+    with _open_text(path) as handle:
+        if ".csv" in os.path.basename(path):
+            for row in csv.DictReader(handle):
+                yield row, None
+        else:
+            for line in handle:
+                if line.strip():
+                    record = json.loads(line)
+                    if "data" in record:  # invoice_core.cli jsonl: {"file": ..., "data": ...}
+                        yield record["data"], record.get("file")
+                    else:
+                        yield record, None
+
+
+def convert(paths, root, batch_rows=BATCH_ROWS):
+    with ParquetExporter(root, batch_rows=batch_rows) as exporter:
+        for path in paths:
+            for record, source in read_records(path):
+                exporter.write(record, source=source)
+    return exporter.rows
+
+
+def synthetic_records(count, lines_per_invoice=4):
+    """JSON-flow style payloads with list-valued line items, for benchmarking."""
+    records = []
+    for number in range(count):
+        record = default_row()
+        day = date(2024, 1 + number % 12, 1 + number % 28)
+        record.update({
+            "*ContactName": f"Supplier {number % 50}",
+            "EmailAddress": f"accounts{number % 50}@example.com",
+            "POCity": "Sutton Coldfield",
+            "POPostalCode": "B72 1UD",
+            "*InvoiceNumber": f"INV{number:08d}",
+            "*InvoiceDate": day.strftime("%d/%m/%Y"),
+            "*DueDate": day.strftime("%d/%m/%Y"),
+            "Total": f"{(number % 997) * 1.37 + 10:.2f}",
+            "TaxAmount": f"{(number % 997) * 0.23 + 1:.2f}",
+            "InventoryItemCode": [f"C/HW{number % 300}({line})" for line in range(lines_per_invoice)],
+            "Description": [f"Classic Hand Wash 5L packed in {line + 1}" for line in range(lines_per_invoice)],
+            "*Quantity": [str(line + 1) for line in range(lines_per_invoice)],
+            "*UnitAmount": [f"{12.95 + line:.2f}" for line in range(lines_per_invoice)],
+        })
+        records.append(record)
+    return records
+
+
+def _csv_row(record):
+    """The CSV path's flattening: list values joined into one cell."""
+    return {key: ", ".join(value) if isinstance(value, list) else value for key, value in record.items()}
+
+
+def benchmark(rows, workdir, lines_per_invoice=4):
+    """Write and read times of the CSV sink and the Parquet datasets for ``rows`` invoices."""
+    records = synthetic_records(rows, lines_per_invoice)
+    csv_path = os.path.join(workdir, "invoices.csv")
+    root = os.path.join(workdir, "parquet")
+    timings = {"rows": rows, "lines_per_invoice": lines_per_invoice}
+
+    started = time.perf_counter()
+    with RecordSink(csv_path, columns=CSV_COLUMNS, append=False) as sink:
+        for record in records:
+            sink.write(_csv_row(record))
+    timings["csv_write_s"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    # A typed load has to re-parse every string and split the joined line-item cells
+    loaded = 0
+    with open(csv_path, encoding="utf-8", newline="") as handle:
+        for row in csv.DictReader(handle):
+            to_decimal(row["Total"])
+            to_date(row["*InvoiceDate"])
+            loaded += len(row["*UnitAmount"].split(", "))
+    timings["csv_read_s"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ParquetExporter(root, batch_rows=max(rows, 1)) as exporter:
+        for record in records:
+            exporter.write(record)
+    timings["parquet_write_s"] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    headers = read_dataset(root, "headers")
+    lines = read_dataset(root, "lines")
+    timings["parquet_read_s"] = time.perf_counter() - started
+
+    timings["csv_bytes"] = os.path.getsize(csv_path)
+    timings["parquet_bytes"] = sum(os.path.getsize(path) for path in exporter.files)
+    timings["parquet_headers"] = headers.num_rows
+    timings["parquet_lines"] = lines.num_rows
+    timings["csv_lines"] = loaded
+    return {key: round(value, 4) if isinstance(value, float) else value for key, value in timings.items()}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Parquet export of extracted invoices.")
+    commands = parser.add_subparsers(dest="command", required=True)
+    convert_parser = commands.add_parser("convert", help="append CSV/JSONL exports to a Parquet dataset root")
+    convert_parser.add_argument("inputs", nargs="+", help=".csv/.jsonl files, optionally .gz")
+    convert_parser.add_argument("root")
+    convert_parser.add_argument("--batch-rows", type=int, default=BATCH_ROWS)
+    bench_parser = commands.add_parser("bench", help="compare write/read time with the CSV path")
+    bench_parser.add_argument("--rows", type=int, default=20000)
+    bench_parser.add_argument("--lines", type=int, default=4, help="line items per invoice")
+    args = parser.parse_args(argv)
+
+    _require_pyarrow()
+    if args.command == "convert":
+        rows = convert(args.inputs, args.root, batch_rows=args.batch_rows)
+        print(f"Appended {rows} invoices to {args.root}", file=sys.stderr)
+        return 0
+    workdir = tempfile.mkdtemp(prefix="invoice-bench-")
+    try:
+        print(json.dumps(benchmark(args.rows, workdir, args.lines), indent=2))
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,145 @@
+"""
+Shrink extracted invoice text before it is sent to the LLM.
+
+``condense_pages`` drops OCR lines that repeat the text layer, headers/footers
+repeated at the edge of consecutive pages and boilerplate without invoice
+fields, then trims low-value lines until the text fits the token budget. It
+returns the text and a report with the tokens saved.
+"""
+import difflib
+import os
+import re
+
+from .llm import estimate_tokens
+
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "3000"))
+
+BOILERPLATE_PATTERNS = [
+    r"terms\s*(and|&)\s*conditions",
+    r"registered (office|in england|in scotland|in wales)",
+    r"company (registration|reg\.?) (no|number)",
+    r"retention of title",
+    r"remain(s)? the property of",
+    r"thank you for your (business|order|custom)",
+    r"please (retain|keep) this",
+    r"e\s*&\s*o\s*e",
+    r"goods (must|should) be (checked|inspected)",
+    r"claims? for (shortage|damage)",
+    r"interest (will|may) be charged",
+    r"late payment of commercial debts",
+    r"privacy (policy|notice)",
+]
+BOILERPLATE_RE = re.compile("|".join(BOILERPLATE_PATTERNS), re.IGNORECASE)
+# A T&C heading starts a block that runs to the end of the page
+BOILERPLATE_HEADING_RE = re.compile(r"^\s*(standard\s+)?terms\s*(and|&)\s*conditions", re.IGNORECASE)
+
+FIELD_PATTERNS = [
+    r"invoice", r"\bdate\b", r"\bdue\b", r"total", r"\bvat\b", r"\btax\b", r"ship", r"deliver",
+    r"bill", r"\bqty\b", r"quantity", r"price", r"amount", r"order", r"account", r"ref",
+    r"[£$€]\s*\d", r"\d+\.\d{2}\b", r"@", r"\b[A-Z]{1,2}\d[A-Z\d]?\s*\d[A-Z]{2}\b",
+    r"\b\d{1,2}[/.-]\d{1,2}[/.-]\d{2,4}\b",
+]
+FIELD_RE = re.compile("|".join(FIELD_PATTERNS), re.IGNORECASE)
+
+FUZZY_DUPLICATE_RATIO = 0.9
+EDGE_LINES = 3  # lines at the top and at the bottom of a page that can be a header/footer
+PAGE_NUMBER_RE = re.compile(r"\bpage\s*\d+(\s*(of|/)\s*\d+)?\b|^\d+\s*(of|/)\s*\d+$")
+
+
+def normalize_line(line):
+    return re.sub(r"[^a-z0-9@.]+", " ", line.lower()).strip()
+
+
+def _footer_key(line):
+    # "Page 2 of 5" and "Page 3 of 5" are the same footer; other numbers must match
+    return PAGE_NUMBER_RE.sub("page #", normalize_line(line))
+
+
+def _edge(lines):
+    """Positions of the lines in the top and bottom band of a page."""
+    return set(range(min(EDGE_LINES, len(lines)))) | set(range(max(0, len(lines) - EDGE_LINES), len(lines)))
+
+
+def _field_score(line):
+    return len(FIELD_RE.findall(line))
+
+
+def _page_lines(page):
+    """Text-layer lines plus the OCR lines that add something new."""
+    layer_lines = [line for line in page["text"].splitlines() if line.strip()]
+    seen = {normalize_line(line) for line in layer_lines}
+    lines = list(layer_lines)
+    duplicates = 0
+    for line in page.get("ocr_text", "").splitlines():
+        if not line.strip():
+            continue
+        normalized = normalize_line(line)
+        if normalized in seen or (
+            layer_lines and difflib.get_close_matches(normalized, seen, n=1, cutoff=FUZZY_DUPLICATE_RATIO)
+        ):
+            duplicates += 1
+            continue
+        seen.add(normalized)
+        lines.append(line)
+    return lines, duplicates
+
+
+def condense_pages(pages, token_budget=PROMPT_TOKEN_BUDGET):
+    """Return ``(condensed_text, report)`` for pages produced by ``extract_pages``."""
+    original = "".join(page["text"] for page in pages) + "\n" + "".join(page.get("ocr_text", "") for page in pages)
+    dropped = {"duplicate": 0, "repeated": 0, "boilerplate": 0, "budget": 0}
+
+    page_lines = []
+    for page in pages:
+        lines, duplicates = _page_lines(page)
+        dropped["duplicate"] += duplicates
+        page_lines.append(lines)
+
+    # Headers/footers: edge lines repeated from the edge of the previous page
+    edge_keys = [{_footer_key(lines[position]) for position in _edge(lines)} - {""} for lines in page_lines]
+    for index in range(1, len(page_lines)):
+        lines = page_lines[index]
+        edge = _edge(lines)
+        kept = []
+        for position, line in enumerate(lines):
+            if position in edge and _footer_key(line) in edge_keys[index - 1]:
+                dropped["repeated"] += 1
+                continue
+            kept.append(line)
+        page_lines[index] = kept
+
+    # Boilerplate, keeping any line that still looks like it carries a field
+    for index, lines in enumerate(page_lines):
+        kept = []
+        in_terms_block = False
+        for line in lines:
+            if BOILERPLATE_HEADING_RE.match(line):
+                in_terms_block = True
+            if (BOILERPLATE_RE.search(line) or in_terms_block) and _field_score(line) < 2:
+                dropped["boilerplate"] += 1
+                continue
+            kept.append(line)
+        page_lines[index] = kept
+
+    # Token budget: drop non-field lines from the last page backwards, then field lines
+    total = sum(estimate_tokens(line) + 1 for lines in page_lines for line in lines)
+    if token_budget and total > token_budget:
+        for min_score in (1, None):
+            for lines in reversed(page_lines):
+                for position in range(len(lines) - 1, -1, -1):
+                    if total <= token_budget:
+                        break
+                    if min_score is None or _field_score(lines[position]) < min_score:
+                        total -= estimate_tokens(lines.pop(position)) + 1
+                        dropped["budget"] += 1
+
+    condensed = "\n".join(line for lines in page_lines for line in lines)
+    tokens_before = estimate_tokens(original)
+    tokens_after = estimate_tokens(condensed)
+    report = {
+        "tokens_before": tokens_before,
+        "tokens_after": tokens_after,
+        "tokens_saved": tokens_before - tokens_after,
+        "lines_dropped": dropped,
+    }
+    return condensed, report
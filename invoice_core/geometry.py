@@ -0,0 +1,16 @@
+"""
+Positioned words of the text layer (``page["words"]``: ``[text, x0, top, x1, bottom]``
+in PDF points) grouped into lines, for the layout-based extractors.
+"""
+LINE_TOLERANCE = 3.0  # points between the tops of words on the same line
+
+
+def group_lines(words):
+    """Group words into lines sorted top-to-bottom, left-to-right."""
+    lines = []
+    for word in sorted(words, key=lambda w: (w[2], w[1])):
+        if lines and abs(lines[-1][0][2] - word[2]) <= LINE_TOLERANCE:
+            lines[-1].append(word)
+        else:
+            lines.append([word])
+    return [sorted(line, key=lambda w: w[1]) for line in lines]
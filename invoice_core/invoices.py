@@ -0,0 +1,499 @@
+"""
+Invoice field extraction shared by the desktop tools and the command-line runner.
+
+Two output shapes exist:
+
+- the Xero-style CSV row of ``pdf-to-csv`` (``extract_csv_row``): header fields
+  parsed from a "Field: value" GPT answer, read straight off the layout for
+  suppliers with a learned template, plus regex fallbacks;
+- the JSON payload of ``pdf-to-json-webhook`` (``extract_json``), including the
+  line-item lists, sent to the Make webhook.
+
+When the product table can be read off the page geometry (``tables.py``) its
+lines are left out of the prompt and the JSON flow fills the line-item lists
+itself, so GPT only extracts the header fields.
+
+With ``structured=True`` either flow asks for its fields as a ``record_invoice``
+function call with a JSON schema instead (``structured.py``), and only fields that
+come back invalid are requested again.
+
+Both take the routed pages from ``page_router.extract_pages`` and a GPT client
+from ``llm.get_gateway``. Prompts are built static part first (prompts.py): the
+instructions go in the system message, the invoice text in the user message
+after it, so the provider can cache the shared prefix. Cached answers are keyed
+on ``prompt_version``, which hashes the static parts; bump the matching
+``*_PROMPT_VERSION`` when the model or the parsing changes
+(``STRUCTURED_VERSION`` for the function-call mode).
+"""
+import calendar
+import json
+import re
+import time
+from datetime import datetime
+
+from .condense import condense_pages
+from .page_router import split_text
+from .prompts import MODEL, build_messages, prompt_key
+from .streaming import EarlyFields
+from .structured import (LIST_FIELDS, MAX_REPAIRS, REPAIR_INSTRUCTIONS, TOOL_NAME, parse_fields, repair_prompt,
+                         tool_arguments)
+from .tables import find_line_items, line_item_fields, without_table_lines
+
+CSV_PROMPT_VERSION = "csv-gpt-4-v4"
+JSON_PROMPT_VERSION = "json-gpt-4-v4"
+STRUCTURED_VERSION = "fn-v1"
+
+CSV_COLUMNS = [
+    "*ContactName", "EmailAddress", "POAddressLine1", "POAddressLine2", "POAddressLine3",
+    "POAddressLine4", "POCity", "PORegion", "POPostalCode", "POCountry", "*InvoiceNumber",
+    "*InvoiceDate", "*DueDate", "Total", "InventoryItemCode", "Description", "*Quantity",
+    "*UnitAmount", "*AccountCode", "*TaxType", "TaxAmount", "TrackingName1",
+    "TrackingOption1", "TrackingName2", "TrackingOption2", "Currency"
+]
+
+# Fields parsed from the CSV prompt's answer
+CSV_AI_FIELDS = ("*ContactName", "*InvoiceNumber", "*InvoiceDate", "*DueDate", "Total", "TrackingOption1")
+# Layout templates fill these; *DueDate is left out: GPT derives it from payment terms,
+# the template path uses calculate_due_date.
+CSV_TEMPLATE_FIELDS = ["*ContactName", "EmailAddress", "*InvoiceNumber", "*InvoiceDate", "Total", "TrackingOption1"]
+
+
+def default_row():
+    return {
+        "*ContactName": "",
+        "EmailAddress": "",
+        "POAddressLine1": "", "POAddressLine2": "", "POAddressLine3": "", "POAddressLine4": "",
+        "POCity": "", "PORegion": "", "POPostalCode": "", "POCountry": "",
+        "*InvoiceNumber": "",
+        "*InvoiceDate": "",
+        "*DueDate": "",
+        "Total": "",
+        "InventoryItemCode": "",
+        "Description": "",
+        "*Quantity": "1",
+        "*UnitAmount": "",
+        "*AccountCode": "540",
+        "*TaxType": "20% (VAT on Expenses)",
+        "TaxAmount": "",
+        "TrackingName1": "Website",
+        "TrackingOption1": "",
+        "TrackingName2": "",
+        "TrackingOption2": "",
+        "Currency": "GBP"
+    }
+
+
+def format_date(date_str):
+    date_formats = ["%d-%b-%y", "%d/%m/%Y", "%Y-%m-%d"]
+    for fmt in date_formats:
+        try:
+            return datetime.strptime(date_str, fmt).strftime("%d/%m/%Y")
+        except ValueError:
+            continue
+    print(f"Warning: Unable to format date '{date_str}'")
+    return "Invalid Date"
+
+
+def calculate_due_date(invoice_date_str):
+    """Last day of the month after the invoice date."""
+    try:
+        invoice_date = datetime.strptime(invoice_date_str, "%d/%m/%Y")
+        next_month = invoice_date.month % 12 + 1
+        year = invoice_date.year + (1 if next_month == 1 else 0)
+        return datetime(year, next_month, calendar.monthrange(year, next_month)[1]).strftime("%d/%m/%Y")
+    except ValueError:
+        return ""
+
+
+def set_field(row, name, value):
+    if name == "*InvoiceDate":
+        row[name] = format_date(value)
+    elif name == "Total":
+        clean_total = re.sub(r"[^\d.]", "", value)
+        row["Total"] = f"{float(clean_total):.2f}"
+
+        # Calculate *UnitAmount and TaxAmount assuming VAT rate is 20%
+        row["*UnitAmount"] = f"{float(clean_total) / 1.2:.2f}"
+        row["TaxAmount"] = f"{float(clean_total) - float(row['*UnitAmount']):.2f}"
+    else:
+        row[name] = value
+
+
+def apply_fallbacks(row, text, image_text):
+    """Fill fields GPT (or the template) left empty from the raw text, or with placeholders."""
+    if not row["*ContactName"]:
+        supplier_match = re.search(r"(Supplier|From):\s*([\w\s]+)", text, re.IGNORECASE)
+        if supplier_match:
+            row["*ContactName"] = supplier_match.group(2).strip()
+    if not row["EmailAddress"]:
+        email_match = re.search(r"[a-zA-Z0-9._%+-]+@[a-zA-Z0-9.-]+\.[a-zA-Z]{2,}", text + "\n" + image_text)
+        if email_match:
+            row["EmailAddress"] = email_match.group(0).strip()
+    if not row["*InvoiceNumber"]:
+        row["*InvoiceNumber"] = "Unknown Invoice Number"
+    if not row["*InvoiceDate"]:
+        row["*InvoiceDate"] = "Invalid Date"
+        row["*DueDate"] = "Invalid Due Date"
+    if not row["Total"]:
+        row["Total"] = "0.00"
+        row["*UnitAmount"] = "0.00"
+        row["TaxAmount"] = "0.00"
+
+
+def _prompt_text(pages, debug):
+    combined_text, condense_report = condense_pages(pages)
+    if debug:
+        print(f"Prompt text: {condense_report['tokens_after']} tokens "
+              f"({condense_report['tokens_saved']} saved of {condense_report['tokens_before']})")
+        print("Extracted Text from PDF and Images:\n", combined_text)
+    return combined_text
+
+
+def _complete(llm, instructions, text, measures=None, max_tokens=1000, **kwargs):
+    """GPT's answer to the static ``instructions`` followed by the document ``text``."""
+    messages = build_messages(instructions, text)
+    if measures is not None:
+        size = sum(len(message["content"].encode("utf-8")) for message in messages)
+        measures["prompt_bytes"] = measures.get("prompt_bytes", 0) + size
+    return llm.complete(
+        usage=measures,
+        model=MODEL,
+        messages=messages,
+        max_tokens=max_tokens,
+        **kwargs
+    ).strip()
+
+
+def _request_fields(llm, instructions, prompt_text, fields, measures=None, debug=False, on_text=None):
+    """
+    ``fields`` of the invoice from a ``record_invoice`` function call (structured.py).
+    Fields that come back missing or invalid are asked for again on their own, up to
+    ``MAX_REPAIRS`` times; any still unusable are left out of the result. ``on_text``
+    streams the first answer.
+    """
+    ai_response = _complete(llm, instructions, prompt_text, measures, on_text=on_text, **tool_arguments(fields))
+    if debug:
+        print("AI Response arguments:\n", ai_response)
+    values, problems = parse_fields(ai_response, fields)
+    for _ in range(MAX_REPAIRS):
+        if not problems:
+            break
+        if debug:
+            print("Asking again for:", problems)
+        if measures is not None:
+            measures["repairs"] = measures.get("repairs", 0) + 1
+        ai_response = _complete(llm, REPAIR_INSTRUCTIONS, repair_prompt(prompt_text, problems), measures,
+                                **tool_arguments(list(problems)))
+        repaired, problems = parse_fields(ai_response, list(problems))
+        values.update(repaired)
+    if problems:
+        print(f"Warning: leaving invalid fields empty: {problems}")
+    return values
+
+
+CSV_ANSWER_FORMAT = """\
+Provide the results in this exact format:
+        *ContactName: [Company Name]
+        EmailAddress: [Email Address]
+        POAddressLine1: [Address Line 1]
+        POAddressLine2: [Address Line 2]
+        POAddressLine3: [Address Line 3]
+        POAddressLine4: [Address Line 4]
+        POCity: [City]
+        PORegion: [Region]
+        POPostalCode: [Postal Code]
+        POCountry: [Country]
+        *InvoiceNumber: [Invoice Number]
+        *InvoiceDate: [Invoice Date]
+        *DueDate: [Due Date]
+        Total: [Invoice Total]
+        InventoryItemCode: [Item Code]
+        Description: [Product Description]
+        *Quantity: [Quantity]
+        *UnitAmount: [Unit Price]
+        *AccountCode: [Account Code]
+        *TaxType: [Tax Type]
+        TaxAmount: [Tax Amount]
+        TrackingName1: [Tracking Name]
+        TrackingOption1: [Tracking Option]
+        TrackingName2: [Additional Tracking Name]
+        TrackingOption2: [Additional Tracking Option]
+        Currency: [Currency]"""
+# Replaces the answer format when the fields are requested as a function call (structured.py)
+STRUCTURED_ANSWER = f"Record the results by calling the {TOOL_NAME} function. Leave fields that are not on the invoice empty."
+
+
+def csv_instructions(structured=False):
+    """The CSV prompt; the invoice text follows it in its own message."""
+    answer = STRUCTURED_ANSWER if structured else CSV_ANSWER_FORMAT
+    return f"""
+        You are a helpful assistant for extracting structured details from invoices. The invoice text is in the next message.
+
+        Your task is to extract the following details:
+        1. *ContactName: Extract the company name based on branding text in the invoice (e.g., DUCK ISLAND). Avoid using supplier names like "Catercall Ltd". Ignore logos, URLs, or IP addresses.
+        2. EmailAddress: Extract the email address (e.g., custserv@nisbets.co.uk).
+        3. POAddressLine1-4: Extract up to 4 lines of the address. Use "Ship To:" or similar contextual clues.
+        4. POCity: Extract the city from the address.
+        5. PORegion: Extract the region (e.g., county/state) from the address.
+        6. POPostalCode: Extract the postal code (e.g., SM4 4LU).
+        7. POCountry: Extract the country (if present).
+        8. *InvoiceNumber: Extract the invoice number (e.g., 30114156).
+        9. *InvoiceDate: Extract the invoice date and format it as DD/MM/YYYY.
+        10. *DueDate: Calculate the due date based on the payment terms (e.g., net 30 days from the invoice date).
+        11. Total: Extract the total invoice value (e.g., 11.38 GBP).
+        12. InventoryItemCode, Description, and *Quantity: Extract these fields from the product description table, if present.
+        13. *UnitAmount: Extract the unit price of items, if present.
+        14. *AccountCode: Set to "540" by default unless another account code is explicitly mentioned.
+        15. *TaxType: Extract or default to "20% (VAT on Expenses)".
+        16. TaxAmount: Extract the tax value (e.g., 1.89 GBP).
+        17. TrackingName1: Extract any tracking names or descriptions (e.g., Despatch No).
+        18. TrackingOption1: Extract tracking options, such as order references (e.g., 32596160).
+        19. TrackingName2, TrackingOption2: Extract any additional tracking details, if present.
+        20. Currency: Extract or default to "GBP".
+
+        {answer}
+        """
+
+def parse_csv_response(ai_response):
+    """Raw values of the CSV_AI_FIELDS from a "Field: value" answer."""
+    ai_fields = {}
+    for line in ai_response.split("\n"):
+        line = line.strip()
+        for name in CSV_AI_FIELDS:
+            if name in line:
+                ai_fields[name] = line.split(":", 1)[1].strip()
+                break
+    return ai_fields
+
+
+def extract_csv_row(pages, llm, templates=None, debug=False, measures=None, structured=False):
+    """
+    One CSV row for a document. With a ``TemplateStore`` known suppliers are read
+    off the layout without GPT, and every GPT answer is learned from. ``measures``
+    (a ``progress.stage`` dict) gets the request's tokens and retries. ``structured``
+    asks for the fields as a function call instead of "Field: value" lines.
+    """
+    row = default_row()
+    text, image_text = split_text(pages)
+
+    template_result = templates.extract(pages, fields=CSV_TEMPLATE_FIELDS) if templates else None
+    if template_result:
+        if debug:
+            print(f"Template hit for {template_result['supplier']} (confidence {template_result['confidence']})")
+        for name, value in template_result["fields"].items():
+            set_field(row, name, value)
+        row["*DueDate"] = calculate_due_date(row["*InvoiceDate"])
+    else:
+        started = time.perf_counter()
+        try:
+            # The CSV row does not use the line items; their table only costs prompt tokens
+            prompt_pages = without_table_lines(pages, find_line_items(pages))
+            prompt_text = _prompt_text(prompt_pages, debug)
+            if structured:
+                ai_fields = _request_fields(llm, csv_instructions(structured=True), prompt_text, CSV_AI_FIELDS,
+                                            measures, debug)
+            else:
+                ai_response = _complete(llm, csv_instructions(), prompt_text, measures)
+                ai_fields = parse_csv_response(ai_response)
+                if debug:
+                    print("\nParsed AI Extracted Data:\n", ai_response.split("\n"))
+            for name, value in ai_fields.items():
+                if value or not structured:
+                    set_field(row, name, value)
+        except Exception as e:
+            print("Error with OpenAI API:", e)
+            raise RuntimeError(f"Could not process the invoice data using AI. Error: {e}") from e
+        if templates:
+            templates.learn(pages, ai_fields)
+            templates.record("llm", time.perf_counter() - started)
+
+    apply_fallbacks(row, text, image_text)
+    return row
+
+
+# The JSON prompt's per-field instructions, in order; the line-item ones are left out when
+# the product table was read off the page (tables.py)
+JSON_FIELD_RULES = [
+    "**ContactName**: Extract the **company name** based on prominent branding, header, or logo text. (e.g., DUCK ISLAND). Avoid using names like \"Catercall Ltd,\" \"CATERCALL LTD,\" or \"Catercall LTD\". Avoid using supplier names or addresses found in \"Ship To\" or \"Billing Address\" unless the invoice explicitly identifies them as the issuing company.",
+    "**EmailAddress**: Extract the first valid email address (e.g., custserv@nisbets.co.uk). If no email is present, leave it as an empty string.",
+    "**POAddressLine1-4**: Extract up to 4 address lines under the \"Ship To\" or \"Delivery Address\" section. Avoid addresses associated with the issuer (e.g., Catercall Ltd) unless explicitly indicated as the shipping address. Ensure the lines are in the correct order. If there are fewer than 4 lines, leave the remaining lines as empty strings.",
+    "**POCity**: Extract the city from the shipping address.",
+    "**PORegion**: Extract the region, county, or state from the shipping address, if provided. Leave blank if missing.",
+    "**POPostalCode**: Extract the postal code from the shipping address. Ensure correct formatting (e.g., SM4 4LU).",
+    "**POCountry**: Extract the country from the shipping address, if explicitly mentioned. Leave blank if missing.",
+    "**InvoiceNumber**: Extract the invoice number (e.g., 30114156) from headings like \"Invoice No\" or \"Invoice Number.\"",
+    "**InvoiceDate**: Extract the invoice date (e.g., 13/11/2024) and ensure it is in DD/MM/YYYY format.",
+    "**DueDate**: Calculate the due date based on payment terms (e.g., \"30 days from the invoice date\") and display it in DD/MM/YYYY format. If payment terms are missing, assume a default of 30 days.",
+    "**Total**: Extract the total invoice amount (e.g., 55.82) without the currency symbol. If the currency is explicitly mentioned, add it as a separate \"Currency\" field, defaulting to \"GBP\" if absent.",
+    "**InventoryItemCode**: Extract all item codes (e.g., \"C/HW5000(2)\") listed in the product table.",
+    "**Description**: Extract all product descriptions (e.g., \"Classic Hand Wash 5L packed in 2\") listed in the product table.",
+    "**Quantity**: Extract all quantities (e.g., \"1\") from the product table.",
+    "**UnitAmount**: Extract all unit prices (e.g., \"33.57\") for items in the product table.",
+    "**AccountCode**: Default to \"540\" unless another account code is explicitly mentioned.",
+    "**TaxType**: Extract the tax type (e.g., \"20% (VAT on Expenses)\"). Default to \"20% (VAT on Expenses)\" if not specified.",
+    "**TaxAmount**: Extract the total tax amount (e.g., 9.30) without the currency symbol.",
+    "**TrackingName1**: Extract any tracking names or labels (e.g., \"Order Reference\").",
+    (
+        "**TrackingOption1**: Extract any tracking option values (e.g., \"H150690\") and infer its associated tracking category based on the following rules:\n"
+        "    - If the value starts with \"C\", label it as **\"Caterspeed\"**.\n"
+        "    - If the value starts with \"H\", label it as **\"Hotel Buyer\"**.\n"
+        "    - If the value starts with \"R\", label it as **\"Restaurant Supply Store\"**.\n"
+        "    - For all other cases, default the label to **\"The Restaurant Store\"**."
+    ),
+    "**TrackingName2** and **TrackingOption2**: Extract any additional tracking details, if available. Leave blank if none exist.",
+    "**Currency**: Extract the currency (e.g., GBP). Default to \"GBP\" if not explicitly mentioned.",
+]
+JSON_LINE_ITEM_RULES = range(11, 15)
+JSON_LINE_ITEM_FIELDS = LIST_FIELDS
+JSON_EXAMPLE = """
+"*ContactName": "Duck Island Limited",
+"EmailAddress": "sales@duckisland.co.uk",
+"POAddressLine1": "The Townhouse",
+"POAddressLine2": "High Street",
+"POAddressLine3": "Sutton Coldfield",
+"POAddressLine4": "Suburban Inns Operations Ltd",
+"POCity": "Sutton Coldfield",
+"PORegion": "",
+"POPostalCode": "B72 1UD",
+"POCountry": "",
+"*InvoiceNumber": "0000027558",
+"*InvoiceDate": "12/11/2024",
+"*DueDate": "12/12/2024",
+"Total": "55.82",
+"InventoryItemCode": ["C/HW5000(2)", "Car"],
+"Description": ["Classic Hand Wash 5L packed in 2", "Carriage as"],
+"*Quantity": ["1", "1"],
+"*UnitAmount": ["33.57", "12.95"],
+"*AccountCode": "540",
+"*TaxType": "20% (VAT on Expenses)",
+"TaxAmount": "9.30",
+"TrackingName1": "Order Reference",
+"TrackingOption1": "Hotel Buyer",
+"TrackingName2": "",
+"TrackingOption2": "",
+"Currency": "GBP"
+"""
+
+
+def json_field_rules(line_items=True):
+    """The numbered field instructions of the JSON prompt."""
+    rules = [rule for index, rule in enumerate(JSON_FIELD_RULES) if line_items or index not in JSON_LINE_ITEM_RULES]
+    return "\n        ".join(
+        f"{number}. {rule}".replace("\n", "\n        ") for number, rule in enumerate(rules, start=1)
+    )
+
+
+def json_example(line_items=True, indent="            "):
+    """The example answer's ``"field": value`` lines, joined for a prompt indented by ``indent``."""
+    return ("\n" + indent).join(
+        line for line in JSON_EXAMPLE.strip().splitlines()
+        if line_items or not line.startswith(tuple(f'"{field}"' for field in JSON_LINE_ITEM_FIELDS))
+    )
+
+
+JSON_NOTES = """### Important Notes:
+        - Ensure all extracted data matches the context and structure of the invoice.
+        - Avoid using "Catercall Ltd," "CATERCALL LTD," "Catercall LTD," or similar variations for **ContactName**.
+        - For **POAddressLine1-4**, avoid using addresses associated with Catercall Ltd or its variations unless explicitly indicated as the "Ship To" address.
+        - Format your response as valid JSON with proper key-value pairs for all fields. Missing or unavailable fields should have an empty string ("") as their value.
+        - Apply the rules for **TrackingOption1** to provide meaningful labels based on the given tracking option value.
+        - Format all numerical values (e.g., Total, TaxAmount, UnitAmount) as pure numbers without currency symbols.
+        - If data for certain fields exists in multiple places (e.g., addresses), prioritize the most relevant section (e.g., "Ship To" for shipping details)."""
+
+
+def json_instructions(line_items=True, structured=False):
+    """The JSON prompt; the invoice text follows it in its own message."""
+    answer = STRUCTURED_ANSWER if structured else f"""### Example JSON Output:
+        {{
+            {json_example(line_items)}
+        }}
+
+        Please ensure your response is in valid JSON format with no additional explanations or text."""
+    return f"""
+        You are an intelligent assistant designed to extract structured data from invoices. The invoice text is in the next message.
+
+        Your task:
+        - Extract key details from the invoice text and return the data in a **valid JSON** format.
+        - Use context from the invoice (e.g., headings, labels, and patterns) to identify each field correctly.
+        - Follow these instructions for each field:
+
+        {json_field_rules(line_items)}
+
+        {JSON_NOTES}
+
+        {answer}
+        """
+
+
+def _json_fields(line_items=True):
+    return [field for field in CSV_COLUMNS if line_items or field not in JSON_LINE_ITEM_FIELDS]
+
+
+def prompt_version(version, structured=False):
+    """
+    Cache version of a flow's answers: its ``*_PROMPT_VERSION`` with a hash of every
+    static part the flow can send (instructions and, for function calls, the tool
+    schemas), so an edited prompt never reuses old answers. Function-call answers
+    are cached apart from free text.
+    """
+    if version == CSV_PROMPT_VERSION:
+        statics = [csv_instructions(structured)]
+        fields = [list(CSV_AI_FIELDS)]
+    else:
+        statics = [json_instructions(line_items, structured) for line_items in (True, False)]
+        fields = [_json_fields(line_items) for line_items in (True, False)]
+    if structured:
+        statics += [tool_arguments(field_list) for field_list in fields] + [REPAIR_INSTRUCTIONS]
+        version = f"{version}-{STRUCTURED_VERSION}"
+    return prompt_key(version, statics)
+
+
+def extract_json(pages, llm, templates=None, debug=False, measures=None, structured=False, stream=False,
+                 on_field=None):
+    """
+    The webhook payload for a document. Raises on GPT errors or invalid JSON; with
+    ``structured`` only the invalid fields are asked for again (structured.py).
+
+    ``stream`` reads the answer as it is generated and calls ``on_field(field, value,
+    values)`` for each header field as soon as it is complete (streaming.py); a reason
+    returned by ``on_field`` cancels the request with ``llm.StreamCancelled``. The
+    time to the first field goes to ``measures["first_field_seconds"]``.
+    """
+    started = time.perf_counter()
+    table, prompt_text = prepare_json(pages, debug)
+    instructions = json_instructions(line_items=table is None, structured=structured)
+    fields = _json_fields(line_items=table is None)
+    early = EarlyFields(fields, on_field) if stream else None
+    try:
+        if structured:
+            extracted_data = {field: [] if field in JSON_LINE_ITEM_FIELDS else "" for field in fields}
+            extracted_data.update(_request_fields(llm, instructions, prompt_text, fields, measures, debug, on_text=early))
+        else:
+            ai_response = _complete(llm, instructions, prompt_text, measures, on_text=early)
+            if debug:
+                print("AI Response JSON:\n", ai_response)
+            extracted_data = json.loads(ai_response)
+    finally:
+        if early is not None and early.first_field_seconds is not None and measures is not None:
+            measures["first_field_seconds"] = early.first_field_seconds
+    return finish_json(pages, extracted_data, table, templates, started)
+
+
+def prepare_json(pages, debug=False):
+    """The product table read off the pages (or None) and the prompt text without its lines."""
+    table = find_line_items(pages)
+    if debug and table:
+        print(f"Read {len(table['items'])} line items from the page layout")
+    return table, _prompt_text(without_table_lines(pages, table), debug)
+
+
+def finish_json(pages, extracted_data, table, templates=None, started=None):
+    """GPT's answer completed with the table's line items; templates learn from it."""
+    if table:
+        extracted_data.update(line_item_fields(table["items"]))
+    if templates:
+        # Templates do not cover the line-item lists, so the JSON flow only learns
+        if started is not None:
+            templates.record("llm", time.perf_counter() - started)
+        templates.learn(pages, extracted_data)
+    return extracted_data
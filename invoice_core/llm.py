@@ -0,0 +1,273 @@
+"""
+Asyncio LLM gateway shared by the desktop scripts and the Django app.
+
+``LLMGateway`` caps the requests in flight, rate limits on requests and tokens
+per minute and retries 429/5xx/connection errors with backoff. An ``on_text``
+callback gets the streamed answer and can stop it with ``StreamCancelled``.
+Synchronous callers use ``complete``, which runs on a private event loop thread.
+"""
+import asyncio
+import os
+import random
+import threading
+import time
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504}
+
+
+class LLMError(Exception):
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status in RETRYABLE_STATUS
+
+
+class StreamCancelled(Exception):
+    """Raised by an ``on_text`` callback to stop a streamed request; never retried."""
+
+    def __init__(self, reason):
+        super().__init__(reason)
+        self.reason = reason
+
+
+def parse_retry_after(value):
+    """Seconds to wait from a Retry-After header (delta-seconds or an HTTP date); None when unusable."""
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def estimate_tokens(text):
+    """Rough token count (~4 characters per token) used for rate limiting."""
+    return max(1, len(text) // 4)
+
+
+class TokenBucket:
+    """Continuous-refill token bucket holding at most ``per_minute`` tokens."""
+
+    def __init__(self, per_minute):
+        self.capacity = float(per_minute)
+        self.tokens = float(per_minute)
+        self.rate = per_minute / 60.0
+        self.updated = time.monotonic()
+        self._lock = None
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, amount=1):
+        if self._lock is None:
+            self._lock = asyncio.Lock()
+        # A single request larger than the bucket would otherwise wait forever
+        amount = min(amount, self.capacity)
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    return
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+
+class OpenAIBackend:
+    """
+    Backend for OpenAI or any OpenAI-compatible server.
+
+    A backend is any object with ``async create(model, messages, max_tokens, **kwargs)``
+    returning ``{"content": str, "usage": {...}}`` and raising ``LLMError`` on failure.
+    When the model answers with a function call (``tools``), ``content`` is its
+    arguments. With ``on_text`` the answer is streamed and every piece of it passed
+    to ``on_text`` as it arrives.
+    """
+
+    def __init__(self, api_key=None, base_url=None, timeout=120):
+        from openai import AsyncOpenAI
+
+        self.client = AsyncOpenAI(
+            api_key=api_key or os.getenv("OPENAI_API_KEY"),
+            base_url=base_url or os.getenv("OPENAI_BASE_URL") or None,
+            timeout=timeout,
+            max_retries=0,  # retries are handled by the gateway
+        )
+
+    async def create(self, model, messages, max_tokens, on_text=None, **kwargs):
+        import openai
+
+        try:
+            if on_text is not None:
+                return await self._stream(model, messages, max_tokens, on_text, **kwargs)
+            response = await self.client.chat.completions.create(
+                model=model, messages=messages, max_tokens=max_tokens, **kwargs
+            )
+        except openai.APIStatusError as e:
+            raise LLMError(str(e), status=e.status_code,
+                           retry_after=parse_retry_after(e.response.headers.get("retry-after"))) from e
+        except (openai.APIConnectionError, openai.APITimeoutError) as e:
+            raise LLMError(str(e)) from e
+
+        usage = response.usage.model_dump() if response.usage else {}
+        message = response.choices[0].message
+        if message.tool_calls:
+            return {"content": message.tool_calls[0].function.arguments or "", "usage": usage}
+        return {"content": message.content or "", "usage": usage}
+
+    async def _stream(self, model, messages, max_tokens, on_text, **kwargs):
+        parts = []
+        usage = {}
+        stream = await self.client.chat.completions.create(
+            model=model, messages=messages, max_tokens=max_tokens, stream=True,
+            stream_options={"include_usage": True}, **kwargs
+        )
+        # Leaving the block (also through StreamCancelled) closes the connection
+        async with stream:
+            async for chunk in stream:
+                if chunk.usage:
+                    usage = chunk.usage.model_dump()
+                if not chunk.choices:
+                    continue
+                delta = chunk.choices[0].delta
+                text = delta.content or ""
+                if delta.tool_calls:
+                    text = "".join(call.function.arguments or "" for call in delta.tool_calls if call.function)
+                if text:
+                    parts.append(text)
+                    on_text(text)
+        return {"content": "".join(parts), "usage": usage}
+
+
+class LLMGateway:
+    def __init__(self, backend=None, max_in_flight=8, requests_per_minute=500,
+                 tokens_per_minute=150000, max_retries=5, base_delay=1.0, max_delay=60.0):
+        self.backend = backend or OpenAIBackend()
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.request_bucket = TokenBucket(requests_per_minute)
+        self.token_bucket = TokenBucket(tokens_per_minute)
+        self.stats = {"requests": 0, "retries": 0, "failures": 0, "cancelled": 0, "prompt_tokens": 0,
+                      "cached_tokens": 0, "completion_tokens": 0}
+        self._semaphore = None
+        self._loop = None
+        self._loop_lock = threading.Lock()
+
+    def _backoff(self, attempt, error):
+        if error.retry_after:
+            return min(self.max_delay, error.retry_after)
+        # "Full jitter": spread retries from many workers across the whole window
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    async def acomplete(self, messages, model="gpt-4", max_tokens=1000, usage=None, on_text=None, **kwargs):
+        """
+        Send one chat completion and return the response text. A ``usage`` dict gets
+        this request's ``prompt_tokens``, ``cached_tokens`` (the part of the prompt the
+        provider served from its prefix cache), ``completion_tokens`` and ``retries`` added.
+        ``on_text`` streams the answer to a callback (see ``OpenAIBackend``).
+        """
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(self.max_in_flight)
+        cost = sum(estimate_tokens(message["content"]) for message in messages) + max_tokens
+        streamed = []
+        if on_text is not None:
+            def forward(text):
+                streamed.append(text)
+                on_text(text)
+
+            kwargs["on_text"] = forward
+
+        attempt = 0
+        while True:
+            await self.request_bucket.acquire(1)
+            await self.token_bucket.acquire(cost)
+            try:
+                async with self._semaphore:
+                    self.stats["requests"] += 1
+                    result = await self.backend.create(model, messages, max_tokens, **kwargs)
+            except StreamCancelled:
+                self.stats["cancelled"] += 1
+                raise
+            except LLMError as e:
+                # A retry would replay text the callback has already seen
+                if not e.retryable or attempt >= self.max_retries or streamed:
+                    self.stats["failures"] += 1
+                    raise
+                self.stats["retries"] += 1
+                if usage is not None:
+                    usage["retries"] = usage.get("retries", 0) + 1
+                await asyncio.sleep(self._backoff(attempt, e))
+                attempt += 1
+                continue
+
+            counts = dict(result.get("usage") or {})
+            counts["cached_tokens"] = (counts.get("prompt_tokens_details") or {}).get("cached_tokens")
+            for name in ("prompt_tokens", "cached_tokens", "completion_tokens"):
+                count = counts.get(name) or 0
+                self.stats[name] += count
+                if usage is not None:
+                    usage[name] = usage.get(name, 0) + count
+            return result["content"]
+
+    async def acomplete_many(self, requests):
+        """Run many requests concurrently; failures are returned as exceptions in place."""
+        return await asyncio.gather(
+            *(self.acomplete(**request) for request in requests), return_exceptions=True
+        )
+
+    def _ensure_loop(self):
+        with self._loop_lock:
+            if self._loop is None:
+                self._loop = asyncio.new_event_loop()
+                thread = threading.Thread(target=self._loop.run_forever, name="llm-gateway", daemon=True)
+                thread.start()
+        return self._loop
+
+    def complete(self, messages, model="gpt-4", max_tokens=1000, usage=None, **kwargs):
+        """
+        Blocking wrapper around ``acomplete`` that is safe to call from any thread. An
+        ``on_text`` callback runs on the gateway's event loop thread and must not block.
+        """
+        future = asyncio.run_coroutine_threadsafe(
+            self.acomplete(messages, model=model, max_tokens=max_tokens, usage=usage, **kwargs), self._ensure_loop()
+        )
+        return future.result()
+
+    def complete_many(self, requests):
+        """Blocking wrapper around ``acomplete_many``."""
+        return asyncio.run_coroutine_threadsafe(self.acomplete_many(requests), self._ensure_loop()).result()
+
+
+_default_gateway = None
+_default_lock = threading.Lock()
+
+
+def get_gateway(api_key=None):
+    """Process-wide gateway configured from the LLM_* environment variables."""
+    global _default_gateway
+    with _default_lock:
+        if _default_gateway is None:
+            _default_gateway = LLMGateway(
+                backend=OpenAIBackend(api_key=api_key),
+                max_in_flight=int(os.getenv("LLM_MAX_IN_FLIGHT", "8")),
+                requests_per_minute=int(os.getenv("LLM_REQUESTS_PER_MINUTE", "500")),
+                tokens_per_minute=int(os.getenv("LLM_TOKENS_PER_MINUTE", "150000")),
+                max_retries=int(os.getenv("LLM_MAX_RETRIES", "5")),
+            )
+        return _default_gateway
@@ -0,0 +1,142 @@
+"""
+Per-stage and per-file instrumentation.
+
+``Metrics`` is a ``progress`` callable (see progress.py): every finished stage
+event adds its wall time, CPU time and measures (pages, bytes, tokens,
+prompt tokens served from the provider's prefix cache, retries,
+structured-output repairs, time to the first streamed field, invoices answered
+in a packed request, answers escalated to a bigger model) to per-stage totals
+and to the file's own record. The totals come out as
+
+- ``summary()``: a JSON-friendly dict, printed by the command-line runner,
+- ``prometheus()``: Prometheus text exposition, served by the Django app at
+  ``/metrics``,
+- structured logs: with a ``logger``, one JSON line per finished stage.
+
+Events from worker processes arrive through a multiprocessing queue; ``listen``
+drains one on a background thread.
+"""
+import json
+import logging
+import threading
+
+MEASURES = ("pages", "bytes", "prompt_bytes", "prompt_tokens", "cached_tokens", "completion_tokens", "retries",
+            "repairs", "first_field_seconds", "packed", "escalations")
+BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+MAX_FILES = 1000  # per-file records kept, oldest dropped first
+
+logger = logging.getLogger("invoice_core.metrics")
+
+
+def _stage_totals():
+    totals = {"runs": 0, "failed": 0, "seconds": 0.0, "cpu_seconds": 0.0}
+    totals.update(dict.fromkeys(MEASURES, 0))
+    totals["buckets"] = [0] * len(BUCKETS)
+    return totals
+
+
+class Metrics:
+    def __init__(self, log=None):
+        """``log``: a ``logging.Logger`` for structured per-stage lines (None: no logs)."""
+        self.log = log
+        self.stages = {}
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def __call__(self, event):
+        self.record(event)
+
+    def record(self, event):
+        if event.get("status") == "start" or event.get("seconds") is None:
+            return
+        with self._lock:
+            totals = self.stages.setdefault(event["stage"], _stage_totals())
+            totals["runs"] += 1
+            totals["failed"] += event["status"] == "failed"
+            totals["seconds"] += event["seconds"]
+            totals["cpu_seconds"] += event.get("cpu_seconds") or 0.0
+            for name in MEASURES:
+                totals[name] += event.get(name) or 0
+            for index, bound in enumerate(BUCKETS):
+                if event["seconds"] <= bound:
+                    totals["buckets"][index] += 1
+
+            stages = self.files.pop(event["file"], {})  # re-inserted last: most recent file
+            file_stage = stages.setdefault(event["stage"], {"seconds": 0.0, "cpu_seconds": 0.0})
+            file_stage["seconds"] += event["seconds"]
+            file_stage["cpu_seconds"] += event.get("cpu_seconds") or 0.0
+            for name in MEASURES:
+                if event.get(name):
+                    file_stage[name] = file_stage.get(name, 0) + event[name]
+            self.files[event["file"]] = stages
+            while len(self.files) > MAX_FILES:
+                self.files.pop(next(iter(self.files)))
+        if self.log is not None:
+            self.log.info(json.dumps(event, default=str))
+
+    def listen(self, events):
+        """Record events from ``events`` (a queue) on a daemon thread until ``None`` is put."""
+        def drain():
+            for event in iter(events.get, None):
+                self.record(event)
+
+        thread = threading.Thread(target=drain, name="metrics", daemon=True)
+        thread.start()
+        return thread
+
+    def summary(self):
+        with self._lock:
+            stages = {}
+            for name, totals in self.stages.items():
+                stages[name] = {key: round(value, 3) if isinstance(value, float) else value
+                                for key, value in totals.items() if key != "buckets" and value}
+                stages[name].setdefault("runs", 0)
+            return {"files": len(self.files), "stages": stages}
+
+    def file_summary(self, file):
+        with self._lock:
+            return {stage: dict(values) for stage, values in self.files.get(file, {}).items()}
+
+    def prometheus(self, extra=None):
+        """
+        Prometheus text format. ``extra`` adds gauges: ``{name: (help, {labels tuple: value})}``
+        with labels as ``(("status", "queued"),)``.
+        """
+        lines = []
+
+        def family(name, kind, help_text):
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        def sample(name, value, **labels):
+            label_text = ",".join(f'{key}="{value}"' for key, value in labels.items())
+            lines.append(f"{name}{{{label_text}}} {value:g}" if label_text else f"{name} {value:g}")
+
+        with self._lock:
+            stages = {name: dict(totals, buckets=list(totals["buckets"])) for name, totals in self.stages.items()}
+
+        family("invoice_stage_runs_total", "counter", "Finished pipeline stages.")
+        for name, totals in stages.items():
+            sample("invoice_stage_runs_total", totals["runs"] - totals["failed"], stage=name, status="done")
+            sample("invoice_stage_runs_total", totals["failed"], stage=name, status="failed")
+        family("invoice_stage_cpu_seconds_total", "counter", "CPU time spent in pipeline stages.")
+        for name, totals in stages.items():
+            sample("invoice_stage_cpu_seconds_total", totals["cpu_seconds"], stage=name)
+        family("invoice_stage_seconds", "histogram", "Wall time of pipeline stages.")
+        for name, totals in stages.items():
+            for bound, count in zip(BUCKETS, totals["buckets"]):
+                sample("invoice_stage_seconds_bucket", count, stage=name, le=f"{bound:g}")
+            sample("invoice_stage_seconds_bucket", totals["runs"], stage=name, le="+Inf")
+            sample("invoice_stage_seconds_sum", totals["seconds"], stage=name)
+            sample("invoice_stage_seconds_count", totals["runs"], stage=name)
+        for measure in MEASURES:
+            name = f"invoice_stage_{measure}_total"
+            family(name, "counter", f"{measure.replace('_', ' ').capitalize()} counted by pipeline stages.")
+            for stage, totals in stages.items():
+                if totals[measure]:
+                    sample(name, totals[measure], stage=stage)
+        for name, (help_text, values) in (extra or {}).items():
+            family(name, "gauge", help_text)
+            for labels, value in values.items():
+                sample(name, value, **dict(labels))
+        return "\n".join(lines) + "\n"
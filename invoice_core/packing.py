@@ -0,0 +1,212 @@
+"""
+Several short invoices in one GPT request.
+
+For a one-page invoice the JSON prompt's instruction block is longer than the
+invoice text, and every invoice pays a full round trip. ``InvoicePacker`` sits
+in front of ``invoices.extract_json``: worker threads hand it their documents,
+and documents whose prompt text is short (``max_document_tokens``) are held for
+up to ``max_wait`` seconds and sent together once ``max_documents`` are waiting
+or their text would exceed ``budget_tokens``. The packed request has the
+instructions once, in a system message that is the same for every pack (so the
+provider can cache it, prompts.py), and each invoice under a ``### Document <id>``
+line in the user message. GPT answers
+with a JSON array of one object per document, each with its ``document_id``.
+
+The answer is split back into per-file payloads. A document missing from the
+answer or with an incomplete object (a cut-off answer keeps the objects that
+are complete) is extracted again on its own, as is every document of a pack
+whose request failed. The pack's tokens are shared among its documents in
+proportion to their text, so per-file measures still add up to the real usage.
+
+Only the free-text JSON flow is packed; structured and streamed requests stay
+one invoice per call.
+"""
+import json
+import threading
+import time
+from concurrent.futures import Future
+
+from .invoices import (CSV_COLUMNS, JSON_LINE_ITEM_FIELDS, JSON_NOTES, _complete, extract_json, finish_json,
+                       json_example, json_field_rules, prepare_json)
+from .llm import estimate_tokens
+from .prompts import prompt_key
+
+BUDGET_TOKENS = 3000         # invoice text per packed request
+MAX_DOCUMENTS = 4
+MAX_DOCUMENT_TOKENS = 800    # longer invoices are sent on their own
+MAX_WAIT_SECONDS = 0.5       # how long a document waits for others to share its request
+ANSWER_TOKENS_PER_DOCUMENT = 600
+# Header fields a packed answer must have for a document to count as extracted
+REQUIRED_FIELDS = [field for field in CSV_COLUMNS if field.startswith("*") and field not in JSON_LINE_ITEM_FIELDS]
+
+
+def packed_json_documents(documents):
+    """The packed request's message for ``[(document_id, prompt_text), ...]``."""
+    return "\n\n".join(f"### Document {document_id}\n{text}" for document_id, text in documents)
+
+
+def packed_json_instructions():
+    """The packed JSON prompt; the documents follow it in their own message."""
+    return f"""
+        You are an intelligent assistant designed to extract structured data from invoices. The next message holds several separate invoices, each starting with a "### Document <id>" line.
+
+        Your task:
+        - Extract key details from each invoice on its own and return the data as a **valid JSON** array with one object per document, in the order given.
+        - Start every object with a "document_id" field holding the document's id. Never mix details from different documents.
+        - Use context from the invoice (e.g., headings, labels, and patterns) to identify each field correctly.
+        - Follow these instructions for each field:
+
+        {json_field_rules()}
+
+        {JSON_NOTES}
+
+        ### Example JSON Output:
+        [
+            {{
+                "document_id": "d1",
+                {json_example(indent="                ")}
+            }}
+        ]
+
+        Please ensure your response is a valid JSON array with no additional explanations or text.
+        """
+
+
+PACKED_PROMPT_VERSION = prompt_key("json-gpt-4-packed-v2", [packed_json_instructions()])
+
+
+def split_answer(text):
+    """
+    The objects of a JSON array answer by ``document_id``. Objects are decoded one at
+    a time, so those before a cut-off or broken one are kept.
+    """
+    decoder = json.JSONDecoder()
+    records = {}
+    index = text.find("[")
+    if index < 0:
+        return records
+    index += 1
+    while True:
+        while index < len(text) and text[index] in " \t\r\n,":
+            index += 1
+        if index >= len(text) or text[index] == "]":
+            break
+        try:
+            record, index = decoder.raw_decode(text, index)
+        except ValueError:
+            break
+        if isinstance(record, dict) and "document_id" in record:
+            records[str(record.pop("document_id"))] = record
+    return records
+
+
+class _Document:
+    def __init__(self, pages, debug):
+        self.pages = pages
+        self.table, self.text = prepare_json(pages, debug)
+        self.tokens = estimate_tokens(self.text)
+        self.future = Future()
+
+
+class InvoicePacker:
+    def __init__(self, llm, budget_tokens=BUDGET_TOKENS, max_documents=MAX_DOCUMENTS,
+                 max_document_tokens=MAX_DOCUMENT_TOKENS, max_wait=MAX_WAIT_SECONDS, debug=False):
+        self.llm = llm
+        self.budget_tokens = budget_tokens
+        self.max_documents = max_documents
+        self.max_document_tokens = max_document_tokens
+        self.max_wait = max_wait
+        self.debug = debug
+        self.stats = {"packs": 0, "packed": 0, "single": 0, "fallbacks": 0}
+        self._pending = []
+        self._timer = None
+        self._lock = threading.Lock()
+
+    def extract(self, pages, templates=None, measures=None):
+        """The webhook payload for one document; blocks until its pack (or its own request) is answered."""
+        started = time.perf_counter()
+        document = _Document(pages, self.debug)
+        if document.tokens > self.max_document_tokens:
+            self._count("single")
+            return extract_json(pages, self.llm, templates, debug=self.debug, measures=measures)
+
+        with self._lock:
+            if self._pending and sum(item.tokens for item in self._pending) + document.tokens > self.budget_tokens:
+                full = self._take()
+            else:
+                full = None
+            self._pending.append(document)
+            if len(self._pending) >= self.max_documents:
+                ready = self._take()
+            else:
+                ready = None
+                if self._timer is None:
+                    self._timer = threading.Timer(self.max_wait, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+        for pack in (full, ready):
+            if pack:
+                self._send(pack)
+
+        try:
+            record, share, problem = document.future.result()
+        except Exception as e:
+            record, share, problem = None, {}, f"the packed request failed: {e}"
+        if measures is not None:
+            for name, value in share.items():
+                measures[name] = measures.get(name, 0) + value
+        if record is None:
+            self._count("fallbacks" if problem else "single")
+            if problem and self.debug:
+                print(f"Extracting the invoice on its own: {problem}")
+            return extract_json(pages, self.llm, templates, debug=self.debug, measures=measures)
+        return finish_json(pages, record, document.table, templates, started)
+
+    def flush(self):
+        """Send the documents still waiting."""
+        with self._lock:
+            pack = self._take()
+        if pack:
+            self._send(pack)
+
+    def _take(self):
+        pack, self._pending = self._pending, []
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        return pack
+
+    def _count(self, name):
+        with self._lock:
+            self.stats[name] += 1
+
+    def _send(self, pack):
+        if len(pack) == 1:
+            # Nothing to share the instructions with: the single-invoice prompt is shorter
+            pack[0].future.set_result((None, {}, None))
+            return
+        documents = [(f"d{number}", document.text) for number, document in enumerate(pack, start=1)]
+        usage = {}
+        try:
+            answer = _complete(self.llm, packed_json_instructions(), packed_json_documents(documents), usage,
+                               max_tokens=ANSWER_TOKENS_PER_DOCUMENT * len(pack))
+        except Exception as e:
+            for document in pack:
+                document.future.set_exception(e)
+            return
+        if self.debug:
+            print("AI Response JSON (packed):\n", answer)
+        records = split_answer(answer)
+        self._count("packs")
+        total_tokens = sum(document.tokens for document in pack)
+        for (document_id, _), document in zip(documents, pack):
+            # Every document carries its part of the pack's usage, also when it has to be sent again
+            weight = document.tokens / total_tokens
+            share = {name: round(value * weight) for name, value in usage.items() if name != "retries"}
+            record = records.get(document_id)
+            if record is None or any(field not in record for field in REQUIRED_FIELDS):
+                document.future.set_result((None, share, f"document {document_id} is missing from the answer"))
+                continue
+            self._count("packed")
+            share["packed"] = 1
+            document.future.set_result((record, share, None))
@@ -0,0 +1,185 @@
+"""
+Per-page routing between the pdfplumber text layer and Tesseract OCR.
+
+A page is OCR-ed in full only when its text layer is missing or unusable (too
+sparse, undecoded "(cid:NN)" glyphs) or a single image covers most of it; other
+pages only get their embedded image regions OCR-ed.
+"""
+import os
+
+import pdfplumber
+from .cache import file_digest
+from .ocr import CONFIDENCE_THRESHOLD, DPI_TIERS, ocr_page_adaptive
+from .progress import stage
+
+# Bump when routing thresholds or OCR settings change so cached layers are rebuilt
+TEXT_LAYER_VERSION = "router-2"
+OCR_LAYER_VERSION = "ocr-2"
+
+# Pages below these thresholds are treated as having no usable text layer
+MIN_PAGE_CHARS = 20
+MIN_TEXT_DENSITY = 0.5  # characters per square inch
+MIN_GLYPH_COVERAGE = 0.9
+
+# Images covering at least this share of the page are treated as a scan
+FULL_PAGE_IMAGE_COVERAGE = 0.5
+# Smaller images (logos, stamps) are OCR-ed on their own if they are big enough
+MIN_IMAGE_REGION_COVERAGE = 0.02
+# Past this many regions a single full-page OCR is cheaper than cropping
+MAX_IMAGE_REGIONS = 6
+
+ROUTE_TEXT = "text"
+ROUTE_OCR = "ocr"
+ROUTE_TEXT_AND_REGIONS = "text+regions"
+
+
+def _is_usable_glyph(char_text):
+    if not char_text or char_text == "�" or char_text.startswith("(cid:"):
+        return False
+    return char_text.isprintable()
+
+
+def _image_regions(page):
+    """Return the page's embedded images as clipped (x0, top, x1, bottom) boxes."""
+    regions = []
+    for image in page.images:
+        x0 = max(image["x0"], 0)
+        top = max(image["top"], 0)
+        x1 = min(image["x1"], page.width)
+        bottom = min(image["bottom"], page.height)
+        if x1 > x0 and bottom > top:
+            regions.append((x0, top, x1, bottom))
+    return regions
+
+
+def analyze_page(page):
+    """Score a pdfplumber page and decide how its text should be obtained."""
+    page_area = float(page.width * page.height) or 1.0
+    chars = [char.get("text", "") for char in page.chars if not char.get("text", "").isspace()]
+    usable = sum(1 for char in chars if _is_usable_glyph(char))
+
+    text_density = len(chars) / (page_area / (72 * 72))
+    glyph_coverage = usable / len(chars) if chars else 0.0
+
+    regions = _image_regions(page)
+    region_areas = [(x1 - x0) * (bottom - top) / page_area for x0, top, x1, bottom in regions]
+    image_coverage = min(sum(region_areas), 1.0)
+    text_regions = [
+        region for region, area in zip(regions, region_areas)
+        if area >= MIN_IMAGE_REGION_COVERAGE
+    ]
+
+    has_text_layer = (
+        usable >= MIN_PAGE_CHARS
+        and text_density >= MIN_TEXT_DENSITY
+        and glyph_coverage >= MIN_GLYPH_COVERAGE
+    )
+    if not has_text_layer or max(region_areas, default=0) >= FULL_PAGE_IMAGE_COVERAGE:
+        route = ROUTE_OCR
+    elif len(text_regions) > MAX_IMAGE_REGIONS:
+        route = ROUTE_OCR
+    elif text_regions:
+        route = ROUTE_TEXT_AND_REGIONS
+    else:
+        route = ROUTE_TEXT
+
+    return {
+        "route": route,
+        "text_density": round(text_density, 2),
+        "glyph_coverage": round(glyph_coverage, 3),
+        "image_coverage": round(image_coverage, 3),
+        "image_regions": len(regions),
+        "ocr_regions": text_regions if route == ROUTE_TEXT_AND_REGIONS else [],
+    }
+
+
+def read_text_layer(file_path):
+    """Text layer and routing decision for every page, without rasterizing anything."""
+    pages = []
+    with pdfplumber.open(file_path) as pdf:
+        for number, page in enumerate(pdf.pages, start=1):
+            decision = analyze_page(page)
+            words = [
+                [word["text"], round(word["x0"], 1), round(word["top"], 1), round(word["x1"], 1), round(word["bottom"], 1)]
+                for word in page.extract_words()
+            ]
+            pages.append({
+                "page": number,
+                "route": decision["route"],
+                "text": page.extract_text() or "",
+                "words": words,  # [text, x0, top, x1, bottom] in PDF points, for layout-based extractors
+                "metrics": decision,
+            })
+    return pages
+
+
+def ocr_pages(file_path, pages, tiers=DPI_TIERS, poppler_path=None, progress=None):
+    """
+    Adaptive OCR result for every page (None for text-only pages).
+
+    Only routed pages are rasterized, one page at a time through the job's render
+    cache, so memory stays within the cache budget whatever the page count.
+    """
+    results = []
+    for page in pages:
+        if page["route"] == ROUTE_TEXT:
+            results.append(None)
+            continue
+        regions = page["metrics"]["ocr_regions"] if page["route"] == ROUTE_TEXT_AND_REGIONS else None
+        results.append(ocr_page_adaptive(file_path, page["page"], regions=regions, tiers=tiers,
+                                         poppler_path=poppler_path, progress=progress))
+    return results
+
+
+def extract_pages(file_path, poppler_path=None, dpi=None, cache=None, progress=None, digest=None):
+    """
+    Extract every page of a PDF, running OCR only where the router asks for it.
+
+    Returns one dict per page with the text layer, the OCR text, the chosen route
+    and ``source`` recording which path produced the page's text; OCR-ed pages
+    also carry the DPI and confidence of the accepted OCR tier under ``ocr``.
+    ``dpi`` pins OCR to a single resolution instead of the adaptive tiers. With an
+    ``ExtractionCache`` the text and OCR layers are reused for identical files.
+    ``progress`` receives "text", "render" and "ocr" stage events (see progress.py).
+    Pass the file's SHA-256 as ``digest`` when it is already known (e.g. hashed
+    while it was uploaded) to save reading the file again.
+    """
+    tiers = (dpi,) if dpi else DPI_TIERS
+    if cache and digest is None:
+        digest = file_digest(file_path)
+
+    pages = cache.get(digest, "text", TEXT_LAYER_VERSION) if cache else None
+    if pages is None:
+        with stage(progress, file_path, "text") as measures:
+            pages = read_text_layer(file_path)
+            measures["pages"] = len(pages)
+            if isinstance(file_path, (str, os.PathLike)):
+                measures["bytes"] = os.path.getsize(file_path)
+        if cache:
+            cache.put(digest, "text", TEXT_LAYER_VERSION, pages)
+
+    ocr_version = f"{OCR_LAYER_VERSION}-{'/'.join(map(str, tiers))}dpi-{CONFIDENCE_THRESHOLD:g}"
+    ocr_results = cache.get(digest, "ocr", ocr_version) if cache else None
+    if ocr_results is None:
+        ocr_results = ocr_pages(file_path, pages, tiers, poppler_path, progress)
+        if cache:
+            cache.put(digest, "ocr", ocr_version, ocr_results)
+
+    results = []
+    for page, ocr in zip(pages, ocr_results):
+        ocr_text = ocr["text"] if ocr else ""
+        if page["route"] == ROUTE_OCR:
+            source = "ocr"
+        elif page["route"] == ROUTE_TEXT_AND_REGIONS and ocr_text.strip():
+            source = "text+ocr"
+        else:
+            source = "text"
+        results.append(dict(page, ocr_text=ocr_text, source=source, ocr=ocr))
+    return results
+
+
+def split_text(pages):
+    """Join routed pages back into (text layer, OCR text) strings."""
+    text = "".join(page["text"] for page in pages)
+    image_text = "".join(page["ocr_text"] for page in pages)
+    return text, image_text
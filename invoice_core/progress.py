@@ -0,0 +1,84 @@
+"""
+Per-file stage events for front ends that show live progress.
+
+The pipeline reports each stage of a file as it starts and finishes:
+
+- ``text``: reading the pdfplumber text layer and routing the pages,
+- ``render``: rasterizing a page for OCR (once per DPI tier tried),
+- ``ocr``: preprocessing and Tesseract,
+- ``llm``: the GPT request,
+- ``deliver``: posting the result to the webhook.
+
+``progress`` is any callable taking an event dict, typically the ``put`` of a
+queue the GUI polls or a ``metrics.Metrics`` recorder. Stages that run in worker processes need a queue that
+crosses process boundaries, such as ``multiprocessing.Manager().Queue()``.
+Every function accepts ``progress=None`` and then reports nothing.
+
+Finished events also carry the stage's CPU time and whatever the stage measured
+(``pages``, ``bytes``, ``prompt_tokens``, ``retries``, ...): ``stage`` yields a
+dict the block fills in.
+"""
+import os
+import time
+from contextlib import contextmanager
+
+STAGES = ("text", "render", "ocr", "llm", "deliver")
+
+
+def file_label(file_path):
+    """Key identifying a file in events: its path, or the name of an uploaded file."""
+    if isinstance(file_path, (str, os.PathLike)):
+        return os.fspath(file_path)
+    return getattr(file_path, "name", repr(file_path))
+
+
+def make_event(file_path, stage_name, status, seconds=None, **measures):
+    event = {
+        "file": file_label(file_path),
+        "stage": stage_name,
+        "status": status,  # "start", "done" or "failed"; "fields" for header fields streamed early
+        "seconds": None if seconds is None else round(seconds, 3),
+        "time": time.time(),
+    }
+    event.update(measures)
+    return event
+
+
+@contextmanager
+def stage(progress, file_path, stage_name):
+    """Report the start and end of ``stage_name`` for a file around a block; yields its measures dict."""
+    measures = {}
+    if progress is None:
+        yield measures
+        return
+    progress(make_event(file_path, stage_name, "start"))
+    started = time.perf_counter()
+    cpu_started = time.thread_time()
+    try:
+        yield measures
+    except BaseException:
+        progress(make_event(file_path, stage_name, "failed", time.perf_counter() - started,
+                            cpu_seconds=round(time.thread_time() - cpu_started, 3), **measures))
+        raise
+    progress(make_event(file_path, stage_name, "done", time.perf_counter() - started,
+                        cpu_seconds=round(time.thread_time() - cpu_started, 3), **measures))
+
+
+class StageBreakdown:
+    """Seconds spent per stage for each file, accumulated from events."""
+
+    def __init__(self):
+        self.files = {}
+
+    def add(self, event):
+        stages = self.files.setdefault(event["file"], {})
+        if event["status"] != "start" and event["seconds"] is not None:
+            stages[event["stage"]] = stages.get(event["stage"], 0.0) + event["seconds"]
+        return stages
+
+    def totals(self):
+        totals = dict.fromkeys(STAGES, 0.0)
+        for stages in self.files.values():
+            for name, seconds in stages.items():
+                totals[name] = totals.get(name, 0.0) + seconds
+        return {name: round(seconds, 3) for name, seconds in totals.items()}
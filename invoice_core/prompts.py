@@ -0,0 +1,43 @@
+"""
+Prompt assembly: the static part first, the invoice text last.
+
+Provider-side prompt caching (OpenAI reuses the longest prefix of 1024 tokens or
+more already seen, in 128-token steps, and bills it at half price) only helps
+requests that start with the same text. The GPT prompts used to put the invoice
+text right after their first sentence, so no two invoices shared a prefix. Every
+request is now
+
+1. a system message with the role sentence and the flow's whole instruction
+   block (field rules, notes, answer format), identical for every invoice,
+2. a user message with the invoice text (and whatever else varies).
+
+Function-call definitions (``tools``) come before the messages on the wire and
+are part of the prefix too.
+
+``prompt_key`` hashes a flow's static parts together with its version and the
+model. The extraction cache is keyed on it, so editing an instruction retires
+the answers cached for the old text even when nobody remembers to bump a
+version.
+"""
+import hashlib
+import json
+
+MODEL = "gpt-4"
+SYSTEM_MESSAGE = "You are a helpful assistant for processing invoices."
+
+
+def build_messages(instructions, text):
+    return [
+        {"role": "system", "content": f"{SYSTEM_MESSAGE}\n\n{instructions.strip()}"},
+        {"role": "user", "content": text},
+    ]
+
+
+def prompt_key(version, statics, model=MODEL):
+    """``<version>-<hash>`` of every static part (instructions, tool definitions) a flow can send."""
+    digest = hashlib.sha256(model.encode("utf-8"))
+    digest.update(SYSTEM_MESSAGE.encode("utf-8"))
+    for static in statics:
+        digest.update(b"\0")
+        digest.update((static if isinstance(static, str) else json.dumps(static, sort_keys=True)).encode("utf-8"))
+    return f"{version}-{digest.hexdigest()[:12]}"
@@ -0,0 +1,158 @@
+"""
+Page rasterization for the OCR stage.
+
+``convert_from_path`` without a page range returns every page as a full
+resolution PIL image at once; a 40-page statement at 300 dpi needs gigabytes.
+``iter_page_images`` instead renders a small window of pages at a time through
+pdf2image's ``first_page``/``last_page`` and yields them one by one, so peak
+memory is bounded by the window size rather than the document length.
+
+``render_pages`` is the service the OCR stages use. It memoizes rendered pages
+per document and DPI in a ``RenderCache`` that lives for the whole job (the
+worker process), within a memory budget, so no page is rasterized twice and a
+retry in the same session reuses earlier renders.
+"""
+import os
+import tempfile
+import threading
+from collections import OrderedDict
+
+from pdf2image import convert_from_path
+from PIL import Image
+
+RENDER_WINDOW = int(os.getenv("INVOICE_RENDER_WINDOW", "1"))
+RENDER_FILE_BACKED = os.getenv("INVOICE_RENDER_FILE_BACKED", "0") == "1"
+RENDER_CACHE_BYTES = int(os.getenv("INVOICE_RENDER_CACHE_MB", "256")) * 1024 * 1024
+
+
+def _windows(page_numbers, window):
+    """Group sorted 1-based page numbers into consecutive runs of at most ``window`` pages."""
+    run = []
+    for number in sorted(set(page_numbers)):
+        if run and (number != run[-1] + 1 or len(run) >= window):
+            yield run
+            run = []
+        run.append(number)
+    if run:
+        yield run
+
+
+def _missing_page(file_path, run, rendered):
+    return f"Could not render every page of {file_path}: got {rendered} images for pages {run[0]}-{run[-1]}"
+
+
+def iter_page_images(file_path, page_numbers, dpi=300, poppler_path=None, window=None, file_backed=None):
+    """
+    Yield ``(page_number, image)`` for the requested pages, a window at a time.
+
+    With ``file_backed`` pdftoppm writes each window to a temporary directory and
+    pages are only decoded when they are yielded.
+    """
+    window = window or RENDER_WINDOW
+    file_backed = RENDER_FILE_BACKED if file_backed is None else file_backed
+    for run in _windows(page_numbers, window):
+        if file_backed:
+            with tempfile.TemporaryDirectory(prefix="invoice-render-") as folder:
+                paths = convert_from_path(
+                    file_path, dpi=dpi, first_page=run[0], last_page=run[-1],
+                    poppler_path=poppler_path, output_folder=folder, paths_only=True,
+                )
+                paths = sorted(paths)
+                if len(paths) < len(run):
+                    raise RuntimeError(_missing_page(file_path, run, len(paths)))
+                for number, path in zip(run, paths):
+                    image = Image.open(path)
+                    image.load()  # reads the pixels and releases the file before the folder goes away
+                    yield number, image
+        else:
+            images = convert_from_path(
+                file_path, dpi=dpi, first_page=run[0], last_page=run[-1], poppler_path=poppler_path
+            )
+            if len(images) < len(run):
+                raise RuntimeError(_missing_page(file_path, run, len(images)))
+            # Pop each page off the list so it can be freed as soon as the caller is done
+            for number in run:
+                yield number, images.pop(0)
+
+
+def image_size(image):
+    """Approximate in-memory size of a decoded PIL image in bytes."""
+    return image.width * image.height * len(image.getbands())
+
+
+class RenderCache:
+    """Least-recently-used store of rendered pages, bounded by ``max_bytes``."""
+
+    def __init__(self, max_bytes=RENDER_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self._images = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            image = self._images.get(key)
+            if image is None:
+                self.misses += 1
+                return None
+            self._images.move_to_end(key)
+            self.hits += 1
+            return image
+
+    def put(self, key, image):
+        size = image_size(image)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._images:
+                self.bytes -= image_size(self._images.pop(key))
+            self._images[key] = image
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                _, evicted = self._images.popitem(last=False)
+                self.bytes -= image_size(evicted)
+
+    def clear(self):
+        with self._lock:
+            self._images.clear()
+            self.bytes = 0
+
+
+def document_key(file_path):
+    """Identity of a PDF on disk for memoization, or None for in-memory uploads."""
+    if not isinstance(file_path, (str, os.PathLike)):
+        return None
+    stat = os.stat(file_path)
+    return os.path.abspath(file_path), stat.st_mtime_ns, stat.st_size
+
+
+_job_cache = RenderCache()
+
+
+def job_render_cache():
+    """The render cache shared by everything in this process for the life of the job."""
+    return _job_cache
+
+
+def render_pages(file_path, page_numbers, dpi=300, poppler_path=None, cache=None):
+    """
+    Yield ``(page_number, image)`` for the requested pages, rendering only the ones
+    not memoized yet. Images may be shared with later callers: crop or convert
+    them, but do not modify or close them.
+    """
+    cache = cache or _job_cache
+    document = document_key(file_path)
+    missing = []
+    for number in sorted(set(page_numbers)):
+        image = cache.get((document, number, dpi)) if document else None
+        if image is None:
+            missing.append(number)
+        else:
+            yield number, image
+
+    for number, image in iter_page_images(file_path, missing, dpi=dpi, poppler_path=poppler_path):
+        if document:
+            cache.put((document, number, dpi), image)
+        yield number, image
@@ -0,0 +1,292 @@
+"""
+Tiered model routing: a fast, cheap model first, GPT-4 only when its answer fails the checks.
+
+``ModelRouter`` runs an extraction with each ``ModelTier`` in turn. A tier is a
+model on a gateway: the fast tier can be a smaller OpenAI model on the shared
+gateway, or a local model behind an OpenAI-compatible endpoint (llama.cpp,
+Ollama, vLLM) on a gateway of its own. A tier's answer is accepted when
+``validate_invoice`` finds nothing wrong with it:
+
+- the required header columns (``*ContactName``, ``*InvoiceNumber``, ...) are
+  filled, and not with the CSV flow's placeholders,
+- the dates parse and the due date is not before the invoice date,
+- the total is a number, the tax is not more than the total, and the line items
+  (quantity x unit price) add up to the total with or without the tax.
+
+Anything else, including a failed request, goes to the next tier. The last tier's
+answer is always kept, though one that still fails the checks is counted as
+``invalid``. A streamed request cancelled by its ``on_field`` check
+(``streaming.py``) is escalated too, since a misread header can look like a
+duplicate or a non-invoice; only the last tier's cancellation is passed on.
+Before each escalation ``on_escalate`` lets the caller undo what the rejected
+answer did, such as ``DuplicateGuard.release``. Template learning
+(``TemplateStore.learn``) and its "llm" path statistics are held back until an
+answer is accepted, so a rejected answer is never learned from and every invoice
+is counted once.
+
+``stats`` has per tier the requests, accepted and escalated answers and the
+latency, ``summary()`` the escalation rate and p50/p95 seconds. Every escalation
+adds 1 to the stage's ``escalations`` measure. An answer from a supplier template
+involves no model and is left out of them (``TemplateStore.stats`` counts it);
+when it fails the checks, the same tier is asked without the template.
+
+The front ends build their router with ``get_router``: routing is on when
+``LLM_FAST_MODEL`` is set (e.g. ``gpt-4o-mini``), and ``LLM_FAST_BASE_URL``
+points the fast tier at a local endpoint.
+"""
+import os
+import threading
+import time
+from collections import deque
+
+from .llm import LLMGateway, OpenAIBackend, StreamCancelled
+from .prompts import MODEL
+from .templates import parse_amount, parse_date
+
+PLACEHOLDERS = ("", "Unknown Invoice Number", "Invalid Date")
+REQUIRED_FIELDS = ("*ContactName", "*InvoiceNumber", "*InvoiceDate", "*DueDate", "*AccountCode", "*TaxType")
+TOTAL_TOLERANCE = 0.05        # currency units, for rounding on each line
+TOTAL_TOLERANCE_SHARE = 0.005
+MAX_SAMPLES = 1000            # latencies kept per tier for the percentiles
+
+
+def _number_list(value):
+    if isinstance(value, list):
+        numbers = [parse_amount(item) for item in value if str(item).strip()]
+    elif str(value or "").strip():
+        numbers = [parse_amount(value)]
+    else:
+        numbers = []
+    return None if None in numbers else numbers
+
+
+def validate_invoice(data, required=REQUIRED_FIELDS):
+    """
+    Reasons not to trust an extracted CSV row or JSON payload; empty when it looks
+    right. Only the ``required`` columns have to be present, the other checks apply
+    to the columns that are.
+    """
+    if not isinstance(data, dict):
+        return ["the answer is not a JSON object"]
+    problems = []
+    for field in required:
+        if str(data.get(field) or "").strip() in PLACEHOLDERS:
+            problems.append(f"{field} is missing")
+
+    dates = {}
+    for field in ("*InvoiceDate", "*DueDate"):
+        value = str(data.get(field) or "").strip()
+        if value not in PLACEHOLDERS:
+            dates[field] = parse_date(value)
+            if dates[field] is None:
+                problems.append(f"{field} {value!r} is not a date")
+    if dates.get("*InvoiceDate") and dates.get("*DueDate") and dates["*DueDate"] < dates["*InvoiceDate"]:
+        problems.append("*DueDate is before *InvoiceDate")
+
+    total = tax = None
+    if str(data.get("Total") or "").strip():
+        total = parse_amount(data["Total"])
+        if total is None:
+            problems.append(f"Total {data['Total']!r} is not a number")
+    if str(data.get("TaxAmount") or "").strip():
+        tax = parse_amount(data["TaxAmount"])
+        if tax is None:
+            problems.append(f"TaxAmount {data['TaxAmount']!r} is not a number")
+    if total is not None and tax is not None and tax > total:
+        problems.append("TaxAmount is more than Total")
+
+    quantities = _number_list(data.get("*Quantity"))
+    units = _number_list(data.get("*UnitAmount"))
+    if quantities is None or units is None:
+        problems.append("the line items have amounts that are not numbers")
+    elif total is not None and units and len(quantities) == len(units):
+        net = sum(quantity * unit for quantity, unit in zip(quantities, units))
+        tolerance = max(TOTAL_TOLERANCE, abs(total) * TOTAL_TOLERANCE_SHARE)
+        if not any(abs(total - amount) <= tolerance for amount in (net, net + (tax or 0))):
+            problems.append(f"the line items add up to {net:.2f}, not to Total {total:.2f}")
+    return problems
+
+
+class ModelTier:
+    """A model on a gateway; passed to the extractors in place of the gateway."""
+
+    def __init__(self, name, llm, model):
+        self.name = name
+        self.llm = llm
+        self.model = model
+
+    def complete(self, messages, model=None, **kwargs):
+        return self.llm.complete(messages, model=self.model, **kwargs)
+
+    async def acomplete(self, messages, model=None, **kwargs):
+        return await self.llm.acomplete(messages, model=self.model, **kwargs)
+
+
+class _HeldTemplates:
+    """
+    A ``TemplateStore`` whose ``learn`` and ``record`` calls wait until the answer
+    they are about is accepted. ``hit`` tells whether a template gave the answer.
+    """
+
+    def __init__(self, store, use_templates=True):
+        self.store = store
+        self.use_templates = use_templates
+        self.hit = False
+        self.held = []
+        self.records = []
+
+    def extract(self, *args, **kwargs):
+        result = self.store.extract(*args, **kwargs) if self.use_templates else None
+        self.hit = result is not None
+        return result
+
+    def record(self, path, seconds):
+        self.records.append((path, seconds))
+
+    def learn(self, *args, **kwargs):
+        self.held.append((args, kwargs))
+
+    def commit(self, llm_seconds=None):
+        """Learn from the answer; ``llm_seconds`` replaces the "llm" path latency (every tier's time)."""
+        for args, kwargs in self.held:
+            self.store.learn(*args, **kwargs)
+        for path, seconds in self.records:
+            self.store.record(path, llm_seconds if path == "llm" and llm_seconds is not None else seconds)
+
+
+class ModelRouter:
+    def __init__(self, tiers, validate=validate_invoice, debug=False):
+        self.tiers = tiers
+        self.validate = validate
+        self.debug = debug
+        self.stats = {tier.name: {"requests": 0, "accepted": 0, "escalated": 0, "failed": 0, "invalid": 0,
+                                  "rejected": 0, "seconds": 0.0} for tier in tiers}
+        self._samples = {tier.name: deque(maxlen=MAX_SAMPLES) for tier in tiers}
+        self._lock = threading.Lock()
+
+    @property
+    def key(self):
+        """Cache version suffix: answers of a routed run are cached apart from single-model ones."""
+        return "routed-" + "-".join(tier.model for tier in self.tiers[:-1])
+
+    def extract(self, extract, templates=None, measures=None, validate=None, on_escalate=None):
+        """
+        ``extract(llm, templates)`` with each tier until an answer passes ``validate``
+        (default: the router's). ``StreamCancelled`` is only passed on from the last
+        tier. ``on_escalate()`` is called before each escalation.
+        """
+        validate = validate or self.validate
+        use_templates = True
+        first_started = time.perf_counter()
+        index = 0
+        while True:
+            tier = self.tiers[index]
+            last = index == len(self.tiers) - 1
+            held = _HeldTemplates(templates, use_templates) if templates is not None else None
+            started = time.perf_counter()
+            try:
+                result = extract(tier, held)
+                problems = validate(result)
+            except StreamCancelled as e:
+                if last:
+                    self._record(tier, started, "rejected")
+                    raise
+                self._record(tier, started, "escalated")
+                problems = [f"the request was cancelled: {e.reason}"]
+            except Exception as e:
+                self._record(tier, started, "failed")
+                if last:
+                    raise
+                problems = [f"the request failed: {e}"]
+            else:
+                if held is not None and held.hit:
+                    # Read off the supplier template: no request was made to this tier
+                    if not problems:
+                        held.commit()
+                        return result
+                    if self.debug:
+                        print(f"Template answer rejected: {'; '.join(problems)}")
+                    if on_escalate is not None:
+                        on_escalate()
+                    use_templates = False
+                    continue
+                if not problems or last:
+                    self._record(tier, started, "invalid" if problems else "accepted")
+                    if held is not None:
+                        held.commit(time.perf_counter() - first_started)
+                    return result
+                self._record(tier, started, "escalated")
+            if measures is not None:
+                measures["escalations"] = measures.get("escalations", 0) + 1
+            if on_escalate is not None:
+                on_escalate()
+            if self.debug:
+                print(f"Escalating from {tier.name}: {'; '.join(problems)}")
+            index += 1
+
+    def _record(self, tier, started, outcome):
+        seconds = time.perf_counter() - started
+        with self._lock:
+            stats = self.stats[tier.name]
+            stats["requests"] += 1
+            stats[outcome] += 1
+            stats["seconds"] += seconds
+            self._samples[tier.name].append(seconds)
+
+    def summary(self):
+        """
+        Per tier: the counts, p50/p95 seconds and the share of its extractions passed
+        on to the next tier (failed requests included; None for the last tier).
+        """
+        summary = {}
+        with self._lock:
+            for index, (name, stats) in enumerate(self.stats.items()):
+                samples = sorted(self._samples[name])
+                passed_on = stats["escalated"] + stats["failed"]
+                summary[name] = dict(
+                    stats,
+                    seconds=round(stats["seconds"], 3),
+                    escalation_rate=round(passed_on / stats["requests"], 3)
+                    if stats["requests"] and index < len(self.tiers) - 1 else None,
+                    p50=round(samples[(len(samples) - 1) // 2], 3) if samples else None,
+                    p95=round(samples[round(0.95 * (len(samples) - 1))], 3) if samples else None,
+                )
+        return summary
+
+    def gauges(self):
+        """``Metrics.prometheus`` extra gauges for the tiers."""
+        summary = self.summary()
+        gauges = {
+            "invoice_llm_tier_requests": ("Extractions sent to each model tier, by outcome.", {}),
+            "invoice_llm_tier_seconds": ("Latency of each model tier.", {}),
+        }
+        for name, stats in summary.items():
+            for outcome in ("accepted", "escalated", "failed", "invalid", "rejected"):
+                gauges["invoice_llm_tier_requests"][1][(("tier", name), ("outcome", outcome))] = stats[outcome]
+            for quantile in ("p50", "p95"):
+                if stats[quantile] is not None:
+                    gauges["invoice_llm_tier_seconds"][1][(("tier", name), ("quantile", quantile))] = stats[quantile]
+        return gauges
+
+
+def routed_version(version, router):
+    return f"{version}-{router.key}" if router is not None else version
+
+
+def get_router(llm, fast_model=None, base_url=None, api_key=None, debug=False):
+    """
+    A router trying ``fast_model`` (default ``LLM_FAST_MODEL``) before GPT-4 on ``llm``,
+    or None when no fast model is configured. With ``base_url`` (default
+    ``LLM_FAST_BASE_URL``) the fast model is served by that OpenAI-compatible endpoint.
+    """
+    fast_model = fast_model or os.getenv("LLM_FAST_MODEL")
+    if not fast_model:
+        return None
+    base_url = base_url or os.getenv("LLM_FAST_BASE_URL")
+    fast_llm = llm
+    if base_url:
+        # Local servers need no real key, but the client insists on one
+        backend = OpenAIBackend(api_key=api_key or os.getenv("LLM_FAST_API_KEY") or "local", base_url=base_url)
+        fast_llm = LLMGateway(backend=backend, max_in_flight=int(os.getenv("LLM_FAST_MAX_IN_FLIGHT", "4")),
+                              max_retries=1)
+    return ModelRouter([ModelTier(fast_model, fast_llm, fast_model), ModelTier(MODEL, llm, MODEL)], debug=debug)
@@ -0,0 +1,150 @@
+"""
+Incremental output for extracted invoices.
+
+``RecordSink`` opens its target before the first invoice is processed and
+appends every record as soon as it completes, flushing after each one, so
+memory stays flat whatever the batch size and a crash loses at most the
+invoice in flight.
+
+- Format: CSV (with a header row) or JSON lines, taken from the file name
+  (``.csv``, ``.jsonl``, optionally followed by ``.gz``) or given explicitly.
+- ``gzip``: each record is flushed as a gzip sync point, so a file cut short by
+  a crash still decompresses up to the last complete record.
+- Rotation (``rotate_rows`` / ``rotate_bytes``): records go to ``<name>.part``
+  and each full segment is renamed atomically to
+  ``<stem>-<timestamp>-<n><ext>``; readers picking up finished segments never
+  see a half-written file. Without rotation the target is appended to in place,
+  or replaced with ``append=False``.
+"""
+import csv
+import gzip
+import io
+import json
+import os
+import time
+
+FORMATS = ("csv", "jsonl")
+
+
+def _split_name(path):
+    """("invoices", ".csv.gz") for "invoices.csv.gz"."""
+    stem, ext = os.path.splitext(path)
+    if ext == ".gz":
+        stem, inner = os.path.splitext(stem)
+        ext = inner + ext
+    return stem, ext
+
+
+class RecordSink:
+    def __init__(self, path, fmt=None, columns=None, compress=None, rotate_rows=0, rotate_bytes=0, fsync=False,
+                 append=True):
+        stem, ext = _split_name(path)
+        self.path = path
+        self.fmt = fmt or ("csv" if ext.startswith(".csv") else "jsonl")
+        if self.fmt not in FORMATS:
+            raise ValueError(f"Unknown format {self.fmt!r}, expected one of {FORMATS}")
+        if self.fmt == "csv" and not columns:
+            raise ValueError("CSV output needs the column names")
+        self.columns = columns
+        self.compress = ext.endswith(".gz") if compress is None else compress
+        self.rotate_rows = rotate_rows
+        self.rotate_bytes = rotate_bytes
+        self.fsync = fsync
+        self.append = append
+        self.segments = []  # finished, renamed segment paths
+        self.rows = 0
+        self._stem, self._ext = stem, ext
+        self._segment_rows = 0
+        self._raw = self._text = self._csv = None
+        self._resumed = False
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._open()
+
+    @property
+    def rotating(self):
+        return bool(self.rotate_rows or self.rotate_bytes)
+
+    def _active_path(self):
+        return self.path + ".part" if self.rotating else self.path
+
+    def _open(self):
+        path = self._active_path()
+        new_file = not self.append or not os.path.exists(path) or os.path.getsize(path) == 0
+        # Appending to a .gz adds a new gzip member, which gzip readers handle transparently
+        self._raw = open(path, "ab" if self.append else "wb")
+        binary = gzip.GzipFile(fileobj=self._raw, mode="ab") if self.compress else self._raw
+        self._binary = binary
+        self._text = io.TextIOWrapper(binary, encoding="utf-8", newline="", write_through=True)
+        if self.fmt == "csv":
+            self._csv = csv.DictWriter(self._text, fieldnames=self.columns, extrasaction="ignore")
+            if new_file:
+                self._csv.writeheader()
+        self._segment_rows = 0
+        self._resumed = not new_file  # a .part left by an interrupted run is kept and finished
+
+    def write(self, record):
+        if self.fmt == "csv":
+            self._csv.writerow(record)
+        else:
+            self._text.write(json.dumps(record, default=str) + "\n")
+        self._flush()
+        self.rows += 1
+        self._segment_rows += 1
+        if (self.rotate_rows and self._segment_rows >= self.rotate_rows) or \
+                (self.rotate_bytes and self._raw.tell() >= self.rotate_bytes):
+            self.rotate()
+
+    def _flush(self):
+        if self.compress:
+            self._binary.flush(gzip.zlib.Z_SYNC_FLUSH)
+        self._raw.flush()
+        if self.fsync:
+            os.fsync(self._raw.fileno())
+
+    def _close_files(self):
+        self._text.close()  # also finishes the gzip member, when compressing
+        self._raw.close()
+
+    def _finish_segment(self):
+        self._close_files()
+        part = self._active_path()
+        if self._segment_rows == 0 and not self._resumed:
+            os.remove(part)
+            return None
+        finished = self._segment_name()
+        os.replace(part, finished)
+        self.segments.append(finished)
+        return finished
+
+    def rotate(self):
+        """Finish the current segment (renaming it into place) and start a new one."""
+        if not self.rotating:
+            return None
+        finished = self._finish_segment()
+        self._open()
+        return finished
+
+    def _segment_name(self):
+        timestamp = time.strftime("%Y%m%d-%H%M%S")
+        number = len(self.segments) + 1
+        name = f"{self._stem}-{timestamp}-{number:04d}{self._ext}"
+        while os.path.exists(name):
+            number += 1
+            name = f"{self._stem}-{timestamp}-{number:04d}{self._ext}"
+        return name
+
+    def close(self):
+        if self._raw is None:
+            return
+        if self.rotating:
+            self._finish_segment()
+        else:
+            self._close_files()
+        self._raw = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
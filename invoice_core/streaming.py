@@ -0,0 +1,108 @@
+"""
+Header fields from a streamed GPT answer, before the answer is complete.
+
+The JSON answer (free text or a ``record_invoice`` call) lists the header fields
+(``*ContactName`` ... ``Total``) before the line-item lists. ``EarlyFields`` is
+the gateway's ``on_text`` callback: it feeds the stream to a
+``structured.FieldParser`` and calls ``on_field(field, value, values)`` as each
+column completes, with the value cleaned as ``structured.clean_value`` does, so
+callers can look the invoice up, validate it or show it while the rest is
+still being generated.
+
+``on_field`` may return a reason to give up on the document; the request is then
+cancelled (``llm.StreamCancelled``) and no more tokens are paid for. ``reject_early``
+builds such a callback from the two stock checks:
+
+- ``not_an_invoice``: neither an invoice number nor an invoice date was found,
+- ``DuplicateGuard``: the supplier and invoice number were already seen from
+  another file in this process (a re-scan or a second copy of the same invoice
+  has a different file hash, so the content cache does not catch it).
+"""
+import threading
+import time
+
+from .llm import StreamCancelled
+from .structured import FieldParser, clean_value, property_name
+
+
+class EarlyFields:
+    def __init__(self, fields, on_field=None):
+        self.parser = FieldParser()
+        self.on_field = on_field
+        self.values = {}
+        self.started = time.perf_counter()
+        self.first_field_seconds = None
+        # Free-text answers use the column names, function calls the schema property names
+        self._columns = {property_name(field): field for field in fields}
+
+    def __call__(self, text):
+        for name, value in self.parser.feed(text):
+            field = self._columns.get(property_name(name))
+            if field is None:
+                continue
+            value, problem = clean_value(field, value)
+            if problem:
+                continue  # left to the complete answer's checks and repairs
+            if self.first_field_seconds is None:
+                self.first_field_seconds = round(time.perf_counter() - self.started, 3)
+            self.values[field] = value
+            reason = self.on_field(field, value, self.values) if self.on_field else None
+            if reason:
+                raise StreamCancelled(reason)
+
+
+def not_an_invoice(values):
+    """A reason when the answer so far has an empty invoice number and date."""
+    if values.get("*InvoiceNumber", "?") == "" and values.get("*InvoiceDate", "?") == "":
+        return "not an invoice: no invoice number or date"
+    return None
+
+
+class DuplicateGuard:
+    """Supplier and invoice number of the documents seen so far, by file."""
+
+    def __init__(self):
+        self._seen = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def key(values):
+        contact = values.get("*ContactName", "").strip().lower()
+        number = values.get("*InvoiceNumber", "").strip().lower()
+        return (contact, number) if contact and number else None
+
+    def claim(self, file, values):
+        """Record ``values`` for ``file``; a reason when another file already has them."""
+        key = self.key(values)
+        if key is None:
+            return None
+        with self._lock:
+            first = self._seen.setdefault(key, file)
+        if first != file:
+            return f"duplicate of {first} (invoice {values['*InvoiceNumber']} from {values['*ContactName']})"
+        return None
+
+    def release(self, file):
+        """Forget ``file`` when its extraction did not go through, so a later copy is processed."""
+        with self._lock:
+            for key in [key for key, owner in self._seen.items() if owner == file]:
+                del self._seen[key]
+
+
+def reject_early(file, guard=None, on_field=None):
+    """
+    An ``on_field`` callback for ``file`` running ``not_an_invoice`` and, with a
+    ``DuplicateGuard``, the duplicate check, after passing each field to ``on_field``.
+    """
+    def check(field, value, values):
+        if on_field is not None:
+            on_field(field, value, values)
+        if field in ("*InvoiceNumber", "*InvoiceDate"):
+            reason = not_an_invoice(values)
+            if reason:
+                return reason
+        if guard is not None and field in ("*ContactName", "*InvoiceNumber"):
+            return guard.claim(file, values)
+        return None
+
+    return check
@@ -0,0 +1,256 @@
+"""
+Structured (function-calling) output for the invoice fields.
+
+Instead of a free-text answer parsed line by line (CSV flow), or with one
+``json.loads`` that loses the whole invoice on a stray character (JSON flow),
+GPT is made to call ``record_invoice``, whose parameters are the JSON schema of
+the requested columns. Its arguments are read with ``FieldParser``, which takes
+the text in chunks and hands back every top-level field as soon as it is
+complete, so a broken value only costs that one field. Each field is then
+checked with ``clean_value``:
+
+- values of the wrong shape are repaired locally where that is unambiguous
+  (numbers sent as numbers, "£1,234.50", a date in another format),
+- fields that are missing, unparseable or still invalid are asked for again in
+  a short follow-up request for just those fields (``REPAIR_INSTRUCTIONS`` and
+  ``repair_prompt``).
+
+Schema property names are the column names without the ``*`` marking required
+columns ("InvoiceNumber" for "*InvoiceNumber").
+"""
+import json
+
+from .templates import parse_amount, parse_date
+
+TOOL_NAME = "record_invoice"
+LIST_FIELDS = ("InventoryItemCode", "Description", "*Quantity", "*UnitAmount")
+NUMBER_LIST_FIELDS = ("*Quantity", "*UnitAmount")
+DATE_FIELDS = ("*InvoiceDate", "*DueDate")
+AMOUNT_FIELDS = ("Total", "TaxAmount")
+MAX_REPAIRS = 1  # follow-up requests per invoice for fields that came back invalid
+
+DESCRIPTIONS = {
+    "*InvoiceDate": "DD/MM/YYYY",
+    "*DueDate": "DD/MM/YYYY",
+    "Total": "number without currency symbol",
+    "TaxAmount": "number without currency symbol",
+    "*Quantity": "one number per product table line",
+    "*UnitAmount": "one unit price per product table line, without currency symbol",
+    "InventoryItemCode": "one item code per product table line",
+    "Description": "one description per product table line",
+}
+
+
+def property_name(field):
+    return field.lstrip("*")
+
+
+def invoice_schema(fields):
+    """JSON schema of an object with the given columns, all required."""
+    properties = {}
+    for field in fields:
+        if field in LIST_FIELDS:
+            schema = {"type": "array", "items": {"type": "string"}}
+        else:
+            schema = {"type": "string"}
+        if field in DESCRIPTIONS:
+            schema["description"] = DESCRIPTIONS[field]
+        properties[property_name(field)] = schema
+    return {
+        "type": "object",
+        "properties": properties,
+        "required": [property_name(field) for field in fields],
+        "additionalProperties": False,
+    }
+
+
+def tool_arguments(fields):
+    """``tools``/``tool_choice`` arguments that make the model call ``record_invoice``."""
+    return {
+        "tools": [{
+            "type": "function",
+            "function": {
+                "name": TOOL_NAME,
+                "description": "Record the fields extracted from the invoice.",
+                "parameters": invoice_schema(fields),
+            },
+        }],
+        "tool_choice": {"type": "function", "function": {"name": TOOL_NAME}},
+    }
+
+
+class FieldParser:
+    """
+    Incremental reader of the top-level members of one JSON object.
+
+    ``feed`` takes the next chunk of text and returns the ``(name, value)`` pairs it
+    completed. A member whose value is not valid JSON goes to ``invalid`` with its
+    raw text instead of failing the object. Text around the object (prose, code
+    fences) is skipped.
+    """
+
+    def __init__(self):
+        self.text = ""
+        self.fields = {}
+        self.invalid = {}
+        self.complete = False
+        self._index = 0
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+        self._key = None
+        self._key_start = None
+        self._value_start = None
+
+    def feed(self, chunk):
+        self.text += chunk
+        finished = []
+        text = self.text
+        while self._index < len(text) and not self.complete:
+            char = text[self._index]
+            if self._depth == 0:
+                if char == "{":
+                    self._depth = 1
+            elif self._in_string:
+                if self._escaped:
+                    self._escaped = False
+                elif char == "\\":
+                    self._escaped = True
+                elif char == '"':
+                    self._in_string = False
+                    if self._depth == 1 and self._key is None and self._key_start is not None:
+                        self._key = _decode_key(text[self._key_start:self._index + 1])
+            elif char == '"':
+                self._in_string = True
+                if self._depth == 1 and self._key is None:
+                    self._key_start = self._index
+            elif char == ":" and self._depth == 1 and self._key is not None and self._value_start is None:
+                self._value_start = self._index + 1
+            elif char in "{[":
+                self._depth += 1
+            elif char in "}]" and self._depth > 1:
+                self._depth -= 1
+            elif char in ",}" and self._depth == 1:
+                member = self._finish_member(text[self._value_start:self._index] if self._value_start else None)
+                if member:
+                    finished.append(member)
+                self.complete = char == "}"
+            self._index += 1
+        return finished
+
+    def close(self):
+        """End of the text: a member cut short (e.g. at ``max_tokens``) is marked invalid."""
+        if not self.complete and self._key is not None:
+            self.invalid[self._key] = self.text[self._value_start:] if self._value_start else ""
+        return self.complete
+
+    def _finish_member(self, raw):
+        key = self._key
+        self._key = self._key_start = self._value_start = None
+        if key is None:
+            return None  # "{}" or a trailing comma
+        try:
+            value = json.loads(raw)
+        except (TypeError, ValueError):
+            self.invalid[key] = (raw or "").strip()
+            return None
+        self.fields[key] = value
+        return key, value
+
+
+def _decode_key(raw):
+    try:
+        return json.loads(raw)
+    except ValueError:
+        return raw.strip('"')
+
+
+def clean_value(field, value):
+    """``(value, None)`` in the payload's shape, or ``(None, reason)`` when ``value`` is unusable."""
+    if field in LIST_FIELDS:
+        if value in (None, ""):
+            return [], None
+        if not isinstance(value, list):
+            value = [value]
+        items = []
+        for item in value:
+            if isinstance(item, (list, dict)):
+                return None, "expected a list of strings"
+            item = "" if item is None else str(item).strip()
+            if field in NUMBER_LIST_FIELDS and item:
+                number = parse_amount(item)
+                if number is None:
+                    return None, f"{item!r} is not a number"
+                item = str(int(number)) if field == "*Quantity" and number == int(number) else f"{number:.2f}"
+            items.append(item)
+        return items, None
+
+    if value is None:
+        return "", None
+    if isinstance(value, (list, dict)):
+        return None, "expected a single string"
+    if isinstance(value, bool):
+        return None, "expected a string"
+    text = str(value).strip()
+    if not text:
+        return "", None
+    if field in DATE_FIELDS:
+        date = parse_date(text)
+        if date is None:
+            return None, f"{text!r} is not a DD/MM/YYYY date"
+        return date.strftime("%d/%m/%Y"), None
+    if field in AMOUNT_FIELDS:
+        number = parse_amount(text)
+        if number is None:
+            return None, f"{text!r} is not a number"
+        return f"{number:.2f}", None
+    return text, None
+
+
+def check_fields(parser, fields):
+    """
+    ``(values, problems)`` for the requested columns: the cleaned values of the
+    fields that are usable and a reason for each field that has to be asked again.
+    """
+    values = {}
+    problems = {}
+    for field in fields:
+        name = property_name(field)
+        if name in parser.invalid:
+            problems[field] = "the answer was not valid JSON"
+        elif name not in parser.fields:
+            problems[field] = "missing from the answer"
+        else:
+            value, reason = clean_value(field, parser.fields[name])
+            if reason:
+                problems[field] = reason
+            else:
+                values[field] = value
+    lists = [field for field in LIST_FIELDS if field in values]
+    if len({len(values[field]) for field in lists}) > 1:
+        # Which list is off cannot be told; ask for all of them again
+        for field in lists:
+            problems[field] = "the line-item lists have different lengths"
+            del values[field]
+    return values, problems
+
+
+def parse_fields(text, fields):
+    """``check_fields`` for a complete answer."""
+    parser = FieldParser()
+    parser.feed(text)
+    parser.close()
+    return check_fields(parser, fields)
+
+
+REPAIR_INSTRUCTIONS = f"""
+        An earlier extraction of the invoice in the next message could not use some fields; they are listed after the invoice text.
+        Extract only these fields again and record them by calling the {TOOL_NAME} function.
+        Leave a field empty if it is not on the invoice.
+        """
+
+
+def repair_prompt(combined_text, problems):
+    """The repair request's message: the invoice text, then the fields to extract again."""
+    wanted = "\n".join(f"- {property_name(field)}: {reason}" for field, reason in problems.items())
+    return f"{combined_text}\n\nFields to extract again:\n{wanted}"
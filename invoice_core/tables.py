@@ -0,0 +1,258 @@
+"""
+Line-item tables read straight off the page geometry.
+
+The product table is found from the positioned words of the text layer
+(``page["words"]``, from pdfplumber's ``extract_words``), so invoices with
+hundreds of lines do not have to go through GPT as flattened text:
+
+1. a header row is a line of label words naming a description/code column and
+   at least one of quantity, unit price or line amount ("Qty", "Unit Price",
+   "Line Total", ...); a label-only line right below it is merged in, for
+   headers that wrap ("Unit" over "Price");
+2. column boundaries are the midpoints between neighbouring header cells, and
+   every body word goes to the column its centre falls in;
+3. a row with a number in a quantity/price/amount column starts a line item,
+   a description-only row continues the previous item's description;
+4. the table ends at a summary line ("Sub Total", "VAT", "Total", ...). When it
+   runs to the bottom of a page it continues on the next one, under that page's
+   repeated header or, without one, under the previous page's columns.
+
+``find_line_items`` returns the items plus the lines they were read from, so
+the caller can leave those lines out of the prompt and only ask GPT for the
+header fields. Scanned pages have no words and produce no table.
+"""
+import re
+
+from .condense import normalize_line
+from .geometry import group_lines
+from .templates import parse_amount
+
+ROLE_CODE = "code"
+ROLE_DESCRIPTION = "description"
+ROLE_QUANTITY = "quantity"
+ROLE_UNIT = "unit"
+ROLE_AMOUNT = "amount"
+ROLE_OTHER = "other"
+NUMERIC_ROLES = (ROLE_QUANTITY, ROLE_UNIT, ROLE_AMOUNT)
+
+# Checked in order on the normalized header cell
+ROLE_PATTERNS = [
+    (ROLE_CODE, r"\b(code|sku|part no|part number|cat no|stock no)\b"),
+    (ROLE_DESCRIPTION, r"\b(description|desc|details|particulars|product|goods description)\b"),
+    (ROLE_QUANTITY, r"\b(qty|quantity|qnty|quant)\b"),
+    (ROLE_OTHER, r"\b(vat|tax|disc|discount)\b"),
+    (ROLE_UNIT, r"\b(unit|price|rate|each|cost)\b"),
+    (ROLE_AMOUNT, r"\b(amount|total|net|value|line)\b"),
+    (ROLE_CODE, r"\b(item|ref|article)\b"),
+]
+SUMMARY_RE = re.compile(
+    r"^(sub ?total|total|net total|goods total|invoice total|vat|tax|balance|amount due|total due|"
+    r"carriage total|grand total|please|bank|payment)\b"
+)
+HEADER_CELL_GAP = 10.0  # points between words of one header cell
+HEADER_WRAP_GAP = 14.0  # points between a header line and its wrapped second line
+MAX_ROW_GAP = 40.0      # points between rows before the table is considered over on this page
+WRAP_ROW_GAP = 15.0     # points between an item and a description-only line that continues it
+
+
+def _line_text(line):
+    return " ".join(word[0] for word in line)
+
+
+def _is_number(text):
+    return bool(text) and bool(re.fullmatch(r"[£$€]?\s*-?[\d,]*\.?\d+\s*(x|ea)?", text.strip(), re.IGNORECASE))
+
+
+def _role(cell_text):
+    text = normalize_line(cell_text)
+    for role, pattern in ROLE_PATTERNS:
+        if re.search(pattern, text):
+            return role
+    return ROLE_OTHER
+
+
+def _cells(line, gap=HEADER_CELL_GAP):
+    cells = []
+    for word in line:
+        if cells and word[1] - cells[-1][-1][3] <= gap:
+            cells[-1].append(word)
+        else:
+            cells.append([word])
+    return cells
+
+
+def _is_wrapped_header(line, below):
+    return bool(below) and not any(re.search(r"\d", word[0]) for word in below) and \
+        below[0][2] - line[0][2] <= HEADER_WRAP_GAP
+
+
+def _header_columns(line, below=None):
+    """
+    ``(columns, wrapped)`` if ``line`` is a table header, else None. ``columns`` is
+    ``[(role, x0, x1)]``; ``wrapped`` tells whether ``below`` was its second line.
+    """
+    if sum(bool(re.search(r"\d", word[0])) for word in line) > len(line) // 4:
+        return None
+    cells = [[cell[0][1], cell[-1][3], [word[0] for word in cell]] for cell in _cells(line)]
+    wrapped = _is_wrapped_header(line, below)
+    if wrapped:
+        # "Unit" over "Price": the second line's words join the cell they overlap
+        for cell in _cells(below):
+            x0, x1 = cell[0][1], cell[-1][3]
+            for header_cell in cells:
+                if x0 <= header_cell[1] and x1 >= header_cell[0]:
+                    header_cell[0], header_cell[1] = min(header_cell[0], x0), max(header_cell[1], x1)
+                    header_cell[2] += [word[0] for word in cell]
+                    break
+            else:
+                cells.append([x0, x1, [word[0] for word in cell]])
+        cells.sort()
+    columns = [(_role(" ".join(texts)), x0, x1) for x0, x1, texts in cells]
+    roles = {role for role, _, _ in columns}
+    numeric = roles & set(NUMERIC_ROLES)
+    # "Order Ref ... Total" is not a product table; a code column alone needs two numeric columns
+    if not numeric or (ROLE_DESCRIPTION not in roles and (ROLE_CODE not in roles or len(numeric) < 2)):
+        if not wrapped:
+            return None
+        # The line below was a body row after all, not part of the header
+        return _header_columns(line)
+    return columns, wrapped
+
+
+def _assign(line, columns):
+    """Cell texts keyed by role for one body line."""
+    bounds = []
+    for index, (role, x0, x1) in enumerate(columns):
+        left = (columns[index - 1][2] + x0) / 2 if index else float("-inf")
+        right = (x1 + columns[index + 1][1]) / 2 if index + 1 < len(columns) else float("inf")
+        bounds.append((role, left, right))
+    cells = {}
+    for word in line:
+        centre = (word[1] + word[3]) / 2
+        for role, left, right in bounds:
+            if left <= centre < right:
+                cells.setdefault(role, []).append(word[0])
+                break
+    return {role: " ".join(texts) for role, texts in cells.items()}
+
+
+def _number_text(text):
+    value = parse_amount(text)
+    if value is None:
+        return ""
+    return str(int(value)) if value == int(value) else f"{value:.2f}"
+
+
+def _new_item(cells, page_number):
+    return {
+        "code": cells.get(ROLE_CODE, "").strip(),
+        "description": cells.get(ROLE_DESCRIPTION, "").strip(),
+        "quantity": cells.get(ROLE_QUANTITY, ""),
+        "unit_amount": cells.get(ROLE_UNIT, ""),
+        "amount": cells.get(ROLE_AMOUNT, ""),
+        "page": page_number,
+    }
+
+
+def _normalize_item(item):
+    quantity = parse_amount(item["quantity"]) if _is_number(item["quantity"]) else None
+    unit = parse_amount(item["unit_amount"]) if _is_number(item["unit_amount"]) else None
+    amount = parse_amount(item["amount"]) if _is_number(item["amount"]) else None
+    if unit is None and amount is not None and quantity:
+        unit = round(amount / quantity, 2)
+    if quantity is None and unit and amount is not None and abs(amount / unit - round(amount / unit)) < 0.01:
+        quantity = round(amount / unit)
+    if quantity is None and amount is not None:
+        quantity = 1
+        unit = amount if unit is None else unit
+    item["quantity"] = _number_text(quantity) if quantity is not None else ""
+    item["unit_amount"] = f"{unit:.2f}" if unit is not None else ""
+    item["amount"] = f"{amount:.2f}" if amount is not None else ""
+    return item
+
+
+def find_line_items(pages):
+    """
+    ``{"items": [...], "columns": [...], "lines": {(page, normalized line), ...}}`` for the
+    product table of routed pages, or None when no table was found.
+    """
+    items = []
+    consumed = set()
+    columns = None
+    table_open = False  # ran to the bottom of the previous page
+    found = False
+    for page in pages:
+        lines = group_lines(page.get("words") or [])
+        start = None
+        continuation = False
+        for index, line in enumerate(lines):
+            below = lines[index + 1] if index + 1 < len(lines) else None
+            header = _header_columns(line, below)
+            if header:
+                columns, wrapped = header
+                consumed.add((page["page"], normalize_line(_line_text(line))))
+                if wrapped:
+                    consumed.add((page["page"], normalize_line(_line_text(below))))
+                start = index + (2 if wrapped else 1)
+                break
+        if start is None:
+            if not table_open:
+                continue
+            start, continuation = 0, True
+        found = True
+
+        last_top = None
+        awaiting_first_row = continuation
+        table_open = False
+        for line in lines[start:]:
+            text = normalize_line(_line_text(line))
+            if SUMMARY_RE.match(text):
+                break
+            top = line[0][2]
+            if last_top is not None and top - last_top > MAX_ROW_GAP:
+                table_open = True  # probably the page footer; the table may go on overleaf
+                break
+            cells = _assign(line, columns)
+            numeric = any(_is_number(cells.get(role, "")) for role in NUMERIC_ROLES)
+            if numeric:
+                items.append(_new_item(cells, page["page"]))
+                awaiting_first_row = False
+            elif awaiting_first_row:
+                continue  # page heading above the continued table
+            elif items and last_top is not None and top - last_top <= WRAP_ROW_GAP:
+                extra = " ".join(value for value in cells.values() if value)
+                items[-1]["description"] = f"{items[-1]['description']} {extra}".strip()
+            else:
+                continue
+            consumed.add((page["page"], text))
+            last_top = top
+        else:
+            table_open = True  # no summary line: the table runs to the end of the page
+
+    if not found or not items:
+        return None
+    return {"items": [_normalize_item(item) for item in items], "columns": columns, "lines": consumed}
+
+
+def without_table_lines(pages, table):
+    """Copies of ``pages`` whose text layer leaves out the lines the table was read from."""
+    if not table:
+        return pages
+    stripped = []
+    for page in pages:
+        lines = [
+            line for line in page["text"].splitlines()
+            if (page["page"], normalize_line(line)) not in table["lines"]
+        ]
+        stripped.append(dict(page, text="\n".join(lines) + ("\n" if lines else "")))
+    return stripped
+
+
+def line_item_fields(items):
+    """The list-valued line-item fields of the JSON payload."""
+    return {
+        "InventoryItemCode": [item["code"] for item in items],
+        "Description": [item["description"] for item in items],
+        "*Quantity": [item["quantity"] for item in items],
+        "*UnitAmount": [item["unit_amount"] for item in items],
+    }
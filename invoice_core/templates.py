@@ -0,0 +1,390 @@
+"""
+Deterministic, layout-based field extraction for suppliers we have seen before.
+
+Each supplier gets a template learned from LLM outputs that were accepted:
+
+- ``anchors``: words that appear on every sample (labels like "Invoice No",
+  "VAT", the supplier's own name and address). A new document matches a
+  template when it contains most of its anchors.
+- ``fields``: per field, a position rule (the label next to the value and
+  whether the value sits to its right or below it) and, for the fields naming
+  the supplier (``IDENTITY_FIELDS``), the constant value every sample had. The
+  rule wins when there is one; invoice numbers, dates and amounts are never
+  taken from a constant.
+
+Suppliers using the same invoicing software share most anchors, so the anchors
+alone do not pick the template: the page must also name the supplier (its
+learned name or email address). Otherwise another supplier's constant fields
+would be copied onto the invoice, and the LLM is used instead.
+
+``TemplateStore.extract`` fills fields from the words' positions
+(``pdfplumber.extract_words``) in milliseconds. It only returns a result when
+the template has enough samples and its confidence (anchor match times the
+share of expected fields that were found and validated) clears the threshold;
+otherwise the caller uses the LLM and feeds the accepted answer back through
+``learn``. Hit rate and latency per path are kept in ``stats``::
+
+    python -m invoice_core.templates stats
+    python -m invoice_core.templates list
+"""
+import argparse
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import datetime
+
+from .cache import DEFAULT_CACHE_DIR
+from .geometry import group_lines
+
+DEFAULT_TEMPLATE_DB = os.getenv("INVOICE_TEMPLATE_DB", os.path.join(DEFAULT_CACHE_DIR, "templates.sqlite3"))
+MIN_SAMPLES = int(os.getenv("TEMPLATE_MIN_SAMPLES", "2"))
+MIN_CONFIDENCE = float(os.getenv("TEMPLATE_MIN_CONFIDENCE", "0.9"))
+MIN_ANCHOR_MATCH = 0.8
+
+AMOUNT_FIELDS = {"Total", "TaxAmount", "*UnitAmount"}
+# The only fields that may be constant for a supplier
+IDENTITY_FIELDS = {"*ContactName", "EmailAddress", "POAddressLine1", "POAddressLine2", "POAddressLine3",
+                   "POAddressLine4", "POCity", "PORegion", "POPostalCode", "POCountry"}
+DATE_FIELDS = {"*InvoiceDate", "*DueDate"}
+DATE_FORMATS = ["%d/%m/%Y", "%d/%m/%y", "%d-%m-%Y", "%d-%b-%y", "%d-%b-%Y", "%d %b %Y", "%d %B %Y",
+                "%Y-%m-%d", "%d.%m.%Y"]
+MAX_WORD_GAP = 20.0   # points between words of the same value
+MAX_LABEL_WORDS = 3
+MAX_VALUE_WORDS = 8
+MAX_LABEL_GAP = 300.0  # points between a label and a value on its right
+
+
+def normalize(text):
+    return re.sub(r"[^a-z0-9@.]+", " ", str(text).lower()).strip()
+
+
+def parse_amount(text):
+    cleaned = re.sub(r"[^\d.\-]", "", str(text).replace(",", ""))
+    try:
+        return round(float(cleaned), 2)
+    except ValueError:
+        return None
+
+
+def parse_date(text):
+    text = str(text).strip().rstrip(".,")
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _is_amount(text):
+    # A number with at most a currency sign or code: parse_amount alone would also take "Total: 99.00"
+    return bool(re.fullmatch(r"[A-Z]{0,3} ?[^\w\s]? ?-?[\d,]*\.?\d+ ?[A-Z]{0,3}", str(text).strip()))
+
+
+def _value_matches(field, candidate, value):
+    if field in AMOUNT_FIELDS:
+        return _is_amount(candidate) and parse_amount(candidate) is not None and parse_amount(candidate) == parse_amount(value)
+    if field in DATE_FIELDS:
+        return parse_date(candidate) is not None and parse_date(candidate) == parse_date(value)
+    return normalize(candidate) == normalize(value) and bool(normalize(value))
+
+
+def _valid(field, value):
+    if field in AMOUNT_FIELDS:
+        return _is_amount(value) and parse_amount(value) is not None
+    if field in DATE_FIELDS:
+        return parse_date(value) is not None
+    if field == "EmailAddress":
+        return bool(re.fullmatch(r"[^@\s]+@[^@\s]+\.[a-zA-Z]{2,}", value))
+    return bool(value.strip())
+
+
+def _runs(line, start, max_words):
+    """Consecutive words from ``start`` on one line, stopping at a wide gap."""
+    run = [line[start]]
+    for word in line[start + 1:]:
+        if len(run) >= max_words or word[1] - run[-1][3] > MAX_WORD_GAP:
+            break
+        run.append(word)
+    return run
+
+
+def _anchor_tokens(pages):
+    """Alphabetic words of the first page: labels and supplier branding, not values."""
+    words = pages[0].get("words", []) if pages else []
+    return {normalize(word[0]) for word in words if re.fullmatch(r"[A-Za-z][A-Za-z&.']{2,}:?", word[0])}
+
+
+def _page_text(pages):
+    """Normalized words of every page, padded so whole phrases can be found with ``in``."""
+    words = [word[0] for page in pages for word in page.get("words", [])]
+    return f" {normalize(' '.join(words))} "
+
+
+def _identities(template):
+    """Texts that name the template's supplier: its learned name and email address, normalized."""
+    identities = {template["supplier"]}
+    for name in ("*ContactName", "EmailAddress"):
+        constant = template["fields"].get(name, {}).get("constant")
+        if constant and normalize(constant):
+            identities.add(normalize(constant))
+    return identities
+
+
+def _identified(template, page_text):
+    return any(f" {identity} " in page_text for identity in _identities(template))
+
+
+def _is_label_word(text):
+    # Labels are words like "Invoice", "No:", "Total" - anything with digits is a value
+    return bool(re.search(r"[A-Za-z]", text)) and not re.search(r"\d", text)
+
+
+def _label_left_of(line, start):
+    """Up to MAX_LABEL_WORDS label words directly left of ``line[start]``, normalized."""
+    label = []
+    position = start - 1
+    # The gap between a label and its value can be wide (right-aligned totals); between label words it is not
+    max_gap = MAX_LABEL_GAP
+    while position >= 0 and len(label) < MAX_LABEL_WORDS:
+        word, right_neighbour = line[position], line[position + 1]
+        if right_neighbour[1] - word[3] > max_gap or not _is_label_word(word[0]):
+            break
+        label.insert(0, word[0])
+        max_gap = MAX_WORD_GAP
+        position -= 1
+    return normalize(" ".join(label)), len(label)
+
+
+def _locate(field, value, pages):
+    """Find the label rule (label text, direction, word count) for a value on the page."""
+    for page in pages:
+        lines = group_lines(page.get("words", []))
+        for line_index, line in enumerate(lines):
+            for start in range(len(line)):
+                run = _runs(line, start, MAX_VALUE_WORDS)
+                for length in range(1, len(run) + 1):
+                    if not _value_matches(field, " ".join(word[0] for word in run[:length]), value):
+                        continue
+                    # Label immediately to the left on the same line
+                    label, label_words = _label_left_of(line, start)
+                    if label:
+                        return {"label": label, "label_words": label_words, "direction": "right",
+                                "words": length, "page": page["page"]}
+                    # Label directly above, overlapping the value horizontally
+                    if line_index > 0:
+                        x0, x1 = run[0][1], run[length - 1][3]
+                        above = [w for w in lines[line_index - 1] if w[1] < x1 and w[3] > x0]
+                        if above and run[0][2] - above[0][4] <= 30 and _is_label_word(above[0][0]):
+                            label = [above[0][0]]
+                            for word in lines[line_index - 1][lines[line_index - 1].index(above[0]) + 1:]:
+                                if len(label) >= MAX_LABEL_WORDS or not _is_label_word(word[0]):
+                                    break
+                                label.append(word[0])
+                            return {"label": normalize(" ".join(label)), "label_words": len(label),
+                                    "direction": "below", "words": length, "page": page["page"]}
+    return None
+
+
+def _apply_rule(rule, pages):
+    page = next((page for page in pages if page["page"] == rule["page"]), None)
+    if page is None:
+        return None
+    lines = group_lines(page.get("words", []))
+    for line_index, line in enumerate(lines):
+        for start in range(len(line)):
+            run = _runs(line, start, rule["label_words"])
+            if normalize(" ".join(word[0] for word in run)) != rule["label"]:
+                continue
+            if rule["direction"] == "right":
+                rest = line[start + len(run):]
+                if rest:
+                    return " ".join(word[0] for word in _runs(rest, 0, rule["words"]))
+            elif line_index + 1 < len(lines):
+                x0, x1 = run[0][1], run[-1][3]
+                below = lines[line_index + 1]
+                overlapping = [i for i, w in enumerate(below) if w[1] < x1 + MAX_WORD_GAP and w[3] > x0 - MAX_WORD_GAP]
+                if overlapping:
+                    return " ".join(word[0] for word in _runs(below, overlapping[0], rule["words"]))
+    return None
+
+
+class TemplateStore:
+    def __init__(self, path=DEFAULT_TEMPLATE_DB, min_samples=MIN_SAMPLES, min_confidence=MIN_CONFIDENCE):
+        self.path = path
+        self.min_samples = min_samples
+        self.min_confidence = min_confidence
+        self._lock = threading.Lock()
+        self._conn = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.path, timeout=30, check_same_thread=False)
+            self._conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS templates (
+                    supplier TEXT PRIMARY KEY,
+                    anchors TEXT NOT NULL,
+                    fields TEXT NOT NULL,
+                    samples INTEGER NOT NULL,
+                    updated_at REAL NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS path_stats (
+                    path TEXT PRIMARY KEY,
+                    documents INTEGER NOT NULL,
+                    seconds REAL NOT NULL
+                );
+                """
+            )
+        return self._conn
+
+    def _templates(self):
+        rows = self._connect().execute("SELECT supplier, anchors, fields, samples FROM templates").fetchall()
+        return [
+            {"supplier": supplier, "anchors": set(json.loads(anchors)), "fields": json.loads(fields), "samples": samples}
+            for supplier, anchors, fields, samples in rows
+        ]
+
+    def match(self, pages):
+        """
+        Best matching template and its anchor match ratio, or (None, 0). Only
+        templates whose supplier is named on the page are considered.
+        """
+        tokens = _anchor_tokens(pages)
+        page_text = _page_text(pages)
+        best, best_score = None, 0.0
+        with self._lock:
+            templates = self._templates()
+        for template in templates:
+            if not template["anchors"] or not _identified(template, page_text):
+                continue
+            score = len(template["anchors"] & tokens) / len(template["anchors"])
+            if score > best_score:
+                best, best_score = template, score
+        if best_score < MIN_ANCHOR_MATCH:
+            return None, 0.0
+        return best, best_score
+
+    def extract(self, pages, fields=None):
+        """
+        Extract fields locally. Returns ``{"supplier", "confidence", "fields"}`` when
+        the template is trusted, otherwise None (use the LLM).
+
+        ``fields`` restricts which fields are expected, e.g. only the header fields a
+        front end needs; by default every field the samples had a value for is expected.
+        """
+        started = time.perf_counter()
+        template, match = self.match(pages)
+        if template is None or template["samples"] < self.min_samples:
+            return None
+
+        expected = [name for name in template["fields"] if fields is None or name in fields]
+        values = {}
+        for name in expected:
+            spec = template["fields"][name]
+            value = _apply_rule(spec["rule"], pages) if "rule" in spec else None
+            if value is not None and _valid(name, value):
+                values[name] = value
+            elif "constant" in spec and name in IDENTITY_FIELDS:
+                values[name] = spec["constant"]
+
+        confidence = match * (len(values) / len(expected) if expected else 0.0)
+        if confidence < self.min_confidence:
+            return None
+        self.record("template", time.perf_counter() - started)
+        return {"supplier": template["supplier"], "confidence": round(confidence, 3), "fields": values}
+
+    def learn(self, pages, data, supplier_field="*ContactName"):
+        """Update (or create) the supplier's template from an accepted extraction."""
+        supplier = normalize(data.get(supplier_field, ""))
+        if not supplier or not pages:
+            return
+        tokens = _anchor_tokens(pages)
+        with self._lock:
+            conn = self._connect()
+            row = conn.execute(
+                "SELECT anchors, fields, samples FROM templates WHERE supplier = ?", (supplier,)
+            ).fetchone()
+            if row:
+                anchors = set(json.loads(row[0])) & tokens
+                fields, samples = json.loads(row[1]), row[2]
+            else:
+                anchors, fields, samples = tokens, {}, 0
+
+            for name, value in data.items():
+                if not isinstance(value, str) or not value.strip():
+                    continue
+                spec = fields.get(name, {})
+                # Constant while every sample so far agrees
+                if name in IDENTITY_FIELDS and (samples == 0 or spec.get("constant") == value):
+                    spec["constant"] = value
+                else:
+                    spec.pop("constant", None)
+                rule = _locate(name, value, pages)
+                if rule:
+                    votes = spec.setdefault("votes", {})
+                    key = json.dumps(rule, sort_keys=True)
+                    votes[key] = votes.get(key, 0) + 1
+                    spec["rule"] = json.loads(max(votes, key=votes.get))
+                # Kept even without a rule: the field is expected, so a miss lowers the confidence
+                fields[name] = spec
+
+            with conn:
+                conn.execute(
+                    "INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?, ?)",
+                    (supplier, json.dumps(sorted(anchors)), json.dumps(fields), samples + 1, time.time()),
+                )
+
+    def record(self, path, seconds):
+        """Count a document handled by ``path`` ("template" or "llm") and its latency."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "INSERT INTO path_stats VALUES (?, 1, ?) "
+                    "ON CONFLICT(path) DO UPDATE SET documents = documents + 1, seconds = seconds + excluded.seconds",
+                    (path, seconds),
+                )
+
+    def stats(self):
+        with self._lock:
+            rows = self._connect().execute("SELECT path, documents, seconds FROM path_stats").fetchall()
+            templates = self._connect().execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+        paths = {
+            path: {"documents": documents, "mean_seconds": round(seconds / documents, 4) if documents else 0.0}
+            for path, documents, seconds in rows
+        }
+        total = sum(path["documents"] for path in paths.values())
+        hits = paths.get("template", {}).get("documents", 0)
+        return {"templates": templates, "hit_rate": round(hits / total, 3) if total else 0.0, "paths": paths}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect learned supplier templates.")
+    parser.add_argument("--db", default=DEFAULT_TEMPLATE_DB)
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("stats", help="hit rate and latency of the template and LLM paths")
+    commands.add_parser("list", help="list templates with their sample counts and fields")
+    forget = commands.add_parser("forget", help="delete a supplier's template")
+    forget.add_argument("supplier")
+    args = parser.parse_args(argv)
+
+    store = TemplateStore(args.db)
+    if args.command == "stats":
+        print(json.dumps(store.stats(), indent=2))
+    elif args.command == "list":
+        for template in store._templates():
+            print(f"{template['supplier']:<40} samples={template['samples']:<4} fields={', '.join(sorted(template['fields']))}")
+    elif args.command == "forget":
+        with store._connect() as conn:
+            conn.execute("DELETE FROM templates WHERE supplier = ?", (normalize(args.supplier),))
+
+
+if __name__ == "__main__":
+    main()
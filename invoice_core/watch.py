@@ -0,0 +1,322 @@
+"""
+Watch-folder ingestion service.
+
+Invoices dropped into a shared folder are processed as they arrive, without a
+batch-wide rerun::
+
+    python -m invoice_core.watch /srv/inbox --output csv --out /srv/invoices.csv
+    python -m invoice_core.watch /srv/inbox --output webhook
+
+- New files are noticed through inotify (the optional ``watchdog`` package),
+  with a directory scan every ``--poll`` seconds as a fallback and safety net.
+- A file is only picked up once its size and modification time have not
+  changed for ``--settle`` seconds, so half-copied PDFs are left alone.
+- Content already processed (same SHA-256, recorded in a SQLite ledger) is not
+  sent to GPT again. A copy of a file still being processed waits in the inbox
+  until the original's result is in the ledger.
+- Files go through the same ``BatchEngine`` as the CLI and are then moved to
+  ``processed/`` or ``failed/`` next to the inbox.
+"""
+import argparse
+import json
+import os
+import queue
+import shutil
+import signal
+import sqlite3
+import sys
+import threading
+import time
+from functools import partial
+
+from .batch import BatchEngine
+from .cache import default_cache, file_digest
+from .cli import OUTPUTS, OutputWriter, Runner
+from .llm import get_gateway
+from .routing import get_router
+from .page_router import extract_pages
+from .templates import TemplateStore
+
+try:
+    from watchdog.events import FileSystemEventHandler
+    from watchdog.observers import Observer
+except ImportError:  # polling only
+    FileSystemEventHandler = object
+    Observer = None
+
+SETTLE_SECONDS = 2.0
+POLL_SECONDS = 5.0
+TICK_SECONDS = 0.5
+
+
+class FolderWatcher:
+    """Yields PDFs in ``folder`` (not its subfolders) once they have stopped changing."""
+
+    def __init__(self, folder, settle=SETTLE_SECONDS, poll_interval=POLL_SECONDS, use_inotify=True):
+        self.folder = os.path.abspath(folder)
+        self.settle = settle
+        self.poll_interval = poll_interval
+        self.use_inotify = use_inotify and Observer is not None
+        self._candidates = {}  # path -> (size, mtime_ns, unchanged since)
+        self._lock = threading.Lock()
+        self._observer = None
+        self._last_scan = 0.0
+
+    def start(self):
+        if self.use_inotify:
+            watcher = self
+
+            class Handler(FileSystemEventHandler):
+                def on_any_event(self, event):
+                    for path in (getattr(event, "src_path", None), getattr(event, "dest_path", None)):
+                        if path and not event.is_directory:
+                            watcher.touch(path)
+
+            self._observer = Observer()
+            self._observer.schedule(Handler(), self.folder, recursive=False)
+            self._observer.start()
+        return self
+
+    def stop(self):
+        if self._observer is not None:
+            self._observer.stop()
+            self._observer.join()
+
+    @staticmethod
+    def _wanted(path):
+        name = os.path.basename(path)
+        return name.lower().endswith(".pdf") and not name.startswith(".")
+
+    def touch(self, path):
+        """Note that ``path`` changed; its settle timer restarts."""
+        if self._wanted(path):
+            with self._lock:
+                self._candidates.pop(os.path.abspath(path), None)
+                self._candidates.setdefault(os.path.abspath(path), None)
+
+    def scan(self):
+        with os.scandir(self.folder) as entries:
+            for entry in entries:
+                if entry.is_file() and self._wanted(entry.path):
+                    with self._lock:
+                        self._candidates.setdefault(entry.path, None)
+        self._last_scan = time.monotonic()
+
+    def ready(self, exclude=()):
+        """Paths that have been stable for ``settle`` seconds, removed from the candidates."""
+        if time.monotonic() - self._last_scan >= self.poll_interval:
+            self.scan()
+        now = time.monotonic()
+        stable = []
+        with self._lock:
+            for path, seen in list(self._candidates.items()):
+                if path in exclude:
+                    continue
+                try:
+                    stat = os.stat(path)
+                except FileNotFoundError:
+                    del self._candidates[path]
+                    continue
+                signature = (stat.st_size, stat.st_mtime_ns)
+                if seen is None or seen[:2] != signature:
+                    self._candidates[path] = signature + (now,)
+                elif stat.st_size > 0 and now - seen[2] >= self.settle:
+                    del self._candidates[path]
+                    stable.append(path)
+        return sorted(stable)
+
+
+class Ledger:
+    """SQLite record of the content already processed, by SHA-256."""
+
+    def __init__(self, path):
+        self._conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS seen (digest TEXT PRIMARY KEY, file TEXT, ok INTEGER, time REAL)"
+            )
+
+    def processed(self, digest):
+        with self._lock:
+            row = self._conn.execute("SELECT ok FROM seen WHERE digest = ?", (digest,)).fetchone()
+        return bool(row and row[0])
+
+    def record(self, digest, file, ok):
+        with self._lock, self._conn:
+            self._conn.execute("INSERT OR REPLACE INTO seen VALUES (?, ?, ?, ?)", (digest, file, int(ok), time.time()))
+
+
+def move_to(path, folder):
+    """Move ``path`` into ``folder`` without overwriting an earlier file of the same name."""
+    os.makedirs(folder, exist_ok=True)
+    base, ext = os.path.splitext(os.path.basename(path))
+    target = os.path.join(folder, base + ext)
+    counter = 1
+    while os.path.exists(target):
+        target = os.path.join(folder, f"{base}-{counter}{ext}")
+        counter += 1
+    shutil.move(path, target)
+    return target
+
+
+class IngestService:
+    def __init__(self, watcher, engine, writer, ledger, processed_dir, failed_dir):
+        self.watcher = watcher
+        self.engine = engine
+        self.writer = writer
+        self.ledger = ledger
+        self.processed_dir = processed_dir
+        self.failed_dir = failed_dir
+        self.stop_event = threading.Event()
+        self._incoming = queue.Queue()
+        self._in_flight = {}  # path -> digest
+        self._lock = threading.Lock()
+        self.counts = {"ok": 0, "failed": 0, "duplicate": 0, "rejected": 0}
+
+    def _feed(self):
+        held = {}  # path -> digest: copies of content still in flight, kept until its result is recorded
+        while not self.stop_event.is_set():
+            with self._lock:
+                busy = set(self._in_flight)
+                digests = set(self._in_flight.values())
+            arrived = [(path, digest) for path, digest in held.items() if digest not in digests]
+            for path in self.watcher.ready(exclude=busy | set(held)):
+                try:
+                    arrived.append((path, file_digest(path)))
+                except OSError as e:
+                    print(f"Cannot read {path}: {e}", file=sys.stderr)
+            for path, digest in arrived:
+                held.pop(path, None)
+                with self._lock:
+                    in_flight = digest in self._in_flight.values()
+                if in_flight:
+                    held[path] = digest
+                    continue
+                if self.ledger.processed(digest):
+                    print(f"Already processed, skipping: {os.path.basename(path)}", file=sys.stderr)
+                    move_to(path, self.processed_dir)
+                    self.counts["duplicate"] += 1
+                    continue
+                with self._lock:
+                    self._in_flight[path] = digest
+                self._incoming.put(path)
+            self.stop_event.wait(TICK_SECONDS)
+
+    def _done(self, path):
+        # Only once the result is in the ledger, so a held copy of the same content is checked against it
+        with self._lock:
+            self._in_flight.pop(path, None)
+
+    def serve(self):
+        """Process files as they arrive until ``stop_event`` is set."""
+        self.watcher.start()
+        feeder = threading.Thread(target=self._feed, name="ingest-feeder", daemon=True)
+        feeder.start()
+        try:
+            for result in self.engine.run([], cancel=self.stop_event, follow=self._incoming):
+                path = result["file"]
+                with self._lock:
+                    digest = self._in_flight.get(path)
+                if result["error"] == "cancelled":
+                    self._done(path)
+                    continue  # stays in the inbox for the next start
+                if result["ok"] and result["result"].get("rejected"):
+                    # Duplicate or not an invoice, seen from the streamed header: left for a person to check
+                    self.counts["rejected"] += 1
+                    print(f"Skipped {os.path.basename(path)}: {result['result']['rejected']}", file=sys.stderr)
+                    if digest:
+                        self.ledger.record(digest, path, False)
+                    move_to(path, self.failed_dir)
+                    self._done(path)
+                    continue
+                if result["ok"]:
+                    self.writer.write(path, result["result"])
+                    self.counts["ok"] += 1
+                    print(f"Processed {os.path.basename(path)}", file=sys.stderr)
+                else:
+                    self.counts["failed"] += 1
+                    print(f"Error processing {path}: {result['error']}", file=sys.stderr)
+                if digest:
+                    self.ledger.record(digest, path, result["ok"])
+                move_to(path, self.processed_dir if result["ok"] else self.failed_dir)
+                self._done(path)
+        finally:
+            self.stop_event.set()
+            feeder.join()
+            self.watcher.stop()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Process invoices dropped into a folder as they arrive.")
+    parser.add_argument("folder")
+    parser.add_argument("--output", choices=OUTPUTS, default="csv")
+    parser.add_argument("--out", help="output file for csv/jsonl, .gz to compress (appended to; default stdout); directory for parquet")
+    parser.add_argument("--rotate-rows", type=int, default=0, help="start a new output file every N records")
+    parser.add_argument("--rotate-mb", type=float, default=0, help="start a new output file every N megabytes")
+    parser.add_argument("--processed-dir", help="default: <folder>/processed")
+    parser.add_argument("--failed-dir", help="default: <folder>/failed")
+    parser.add_argument("--ledger", help="SQLite file of processed content (default: <folder>/.ingest.sqlite3)")
+    parser.add_argument("--settle", type=float, default=SETTLE_SECONDS, help="seconds a file must stay unchanged")
+    parser.add_argument("--poll", type=float, default=POLL_SECONDS, help="seconds between directory scans")
+    parser.add_argument("--no-inotify", action="store_true", help="only poll, e.g. on network shares")
+    parser.add_argument("--workers", type=int, help="extraction/OCR processes (default: CPU count)")
+    parser.add_argument("--poppler-path")
+    parser.add_argument("--webhook-url", help="default: MAKE_WEBHOOK_URL")
+    parser.add_argument("--structured", action="store_true",
+                        help="ask for the fields as a JSON-schema function call; only invalid fields are re-requested")
+    parser.add_argument("--stream", action="store_true",
+                        help="stream GPT answers; stop early for duplicate invoices and non-invoices (JSON outputs)")
+    parser.add_argument("--fast-model", default=os.getenv("LLM_FAST_MODEL"),
+                        help="try this cheaper model first; only answers that fail validation go to GPT-4")
+    parser.add_argument("--fast-base-url", default=os.getenv("LLM_FAST_BASE_URL"),
+                        help="OpenAI-compatible endpoint serving --fast-model, e.g. a local server")
+    args = parser.parse_args(argv)
+
+    try:
+        from dotenv import load_dotenv
+        load_dotenv()
+    except ImportError:
+        pass
+
+    folder = os.path.abspath(args.folder)
+    watcher = FolderWatcher(folder, settle=args.settle, poll_interval=args.poll, use_inotify=not args.no_inotify)
+    print(f"Watching {folder} ({'inotify' if watcher.use_inotify else 'polling'} + scan every {args.poll}s)",
+          file=sys.stderr)
+
+    webhook = None
+    if args.output == "webhook":
+        from .webhook import WebhookDelivery
+        webhook = WebhookDelivery(args.webhook_url or os.getenv("MAKE_WEBHOOK_URL"))
+
+    cache = default_cache()
+    llm = get_gateway(api_key=os.getenv("OPENAI_API_KEY"))
+    runner = Runner(args.output, llm, cache=cache, templates=TemplateStore(), webhook=webhook,
+                    structured=args.structured, stream=args.stream and args.output != "csv",
+                    router=get_router(llm, args.fast_model, args.fast_base_url))
+    engine = BatchEngine(partial(extract_pages, poppler_path=args.poppler_path, cache=cache), runner,
+                         cpu_workers=args.workers, io_workers=llm.max_in_flight, ordered=False)
+    writer = OutputWriter(args.output, args.out, args.rotate_rows, int(args.rotate_mb * 1024 * 1024))
+    service = IngestService(
+        watcher, engine, writer,
+        Ledger(args.ledger or os.path.join(folder, ".ingest.sqlite3")),
+        args.processed_dir or os.path.join(folder, "processed"),
+        args.failed_dir or os.path.join(folder, "failed"),
+    )
+    signal.signal(signal.SIGTERM, lambda *_: service.stop_event.set())
+    try:
+        service.serve()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.close()
+        if webhook is not None:
+            webhook.stop()
+    counts = dict(service.counts)
+    if runner.router is not None:
+        counts["routing"] = runner.router.summary()
+    print(json.dumps(counts), file=sys.stderr)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,332 @@
+"""
+Webhook delivery with a pooled session and a durable SQLite outbox.
+
+Every payload is written to the outbox (``pending``, ``sending``, ``sent`` or
+``dead``) before it is posted, and failed posts are retried with backoff by a
+background thread. A payload already waiting in the outbox is not queued twice.
+
+Query or drive the outbox from the command line::
+
+    python -m invoice_core.webhook status
+    python -m invoice_core.webhook list --state dead
+    python -m invoice_core.webhook retry-dead
+    python -m invoice_core.webhook flush --url https://hook.example/...
+"""
+import argparse
+import hashlib
+import json
+import os
+import random
+import sqlite3
+import threading
+import time
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .cache import DEFAULT_CACHE_DIR
+
+DEFAULT_OUTBOX = os.getenv("WEBHOOK_OUTBOX", os.path.join(DEFAULT_CACHE_DIR, "webhook_outbox.sqlite3"))
+STATES = ("pending", "sending", "sent", "dead")
+RETRYABLE_STATUS = {408, 425, 429}
+# A "sending" row older than this belongs to a worker that died mid-request
+STALE_CLAIM_SECONDS = 600
+
+
+class WebhookDelivery:
+    def __init__(self, url, outbox_path=DEFAULT_OUTBOX, timeout=None, batch_size=None, max_attempts=8,
+                 base_delay=5.0, max_delay=3600.0, pool_size=10, retry_interval=5.0, auto_retry=True):
+        self.url = url
+        self.outbox_path = outbox_path
+        self.timeout = timeout or (5, float(os.getenv("WEBHOOK_TIMEOUT", "30")))
+        self.batch_size = batch_size or int(os.getenv("WEBHOOK_BATCH_SIZE", "1"))
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.retry_interval = retry_interval
+        self.auto_retry = auto_retry
+
+        # Keep-alive connections are reused across posts instead of a new TLS handshake each time
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+        self._lock = threading.RLock()
+        self._conn = None
+        self._stop = threading.Event()
+        self._retry_thread = None
+
+    def _connect(self):
+        if self._conn is None:
+            directory = os.path.dirname(self.outbox_path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self._conn = sqlite3.connect(self.outbox_path, timeout=30, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id INTEGER PRIMARY KEY AUTOINCREMENT,
+                    url TEXT NOT NULL,
+                    payload TEXT NOT NULL,
+                    state TEXT NOT NULL DEFAULT 'pending',
+                    attempts INTEGER NOT NULL DEFAULT 0,
+                    next_attempt_at REAL NOT NULL,
+                    last_error TEXT,
+                    created_at REAL NOT NULL,
+                    updated_at REAL NOT NULL
+                )
+                """
+            )
+            columns = [row[1] for row in self._conn.execute("PRAGMA table_info(outbox)")]
+            if "digest" not in columns:
+                # Outboxes created before payloads were de-duplicated
+                self._conn.execute("ALTER TABLE outbox ADD COLUMN digest TEXT")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_due ON outbox (state, next_attempt_at)")
+            self._conn.execute("CREATE INDEX IF NOT EXISTS outbox_digest ON outbox (digest, state)")
+            self._conn.commit()
+        return self._conn
+
+    def enqueue(self, data):
+        """
+        Persist a payload as pending and return its outbox id. When the same payload
+        is already pending or being sent to this URL, that row's id is returned instead.
+        """
+        now = time.time()
+        payload = json.dumps(data)
+        digest = hashlib.sha256((self.url + "\0" + json.dumps(data, sort_keys=True)).encode("utf-8")).hexdigest()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                row = conn.execute(
+                    "SELECT id FROM outbox WHERE digest = ? AND state IN ('pending', 'sending') ORDER BY id LIMIT 1",
+                    (digest,),
+                ).fetchone()
+                if row:
+                    return row[0]
+                cursor = conn.execute(
+                    "INSERT INTO outbox (url, payload, digest, next_attempt_at, created_at, updated_at) "
+                    "VALUES (?, ?, ?, ?, ?, ?)",
+                    (self.url, payload, digest, now, now, now),
+                )
+        return cursor.lastrowid
+
+    def deliver(self, data):
+        """
+        Queue a payload and post it straight away when batching is off.
+
+        Returns True once the webhook has acknowledged it (or, when batching, once it
+        is queued for the next batch). The same payload already being posted by another
+        thread is waited for, and counts as delivered while that post is still running.
+        False means the post failed; the payload stays in the outbox and is retried in
+        the background unless it was dead-lettered.
+        """
+        self._ensure_retry_thread()
+        item_id = self.enqueue(data)
+        if self.batch_size > 1:
+            self.flush()
+            return self.state_of(item_id) in ("pending", "sending", "sent")
+        if not self._claim(1, [item_id]):
+            return self._wait_for(item_id) in ("sending", "sent")
+        self._send([item_id], claimed=True)
+        return self.state_of(item_id) == "sent"
+
+    def _wait_for(self, item_id):
+        """The state of a row claimed by someone else, once their post is over or has run for a full timeout."""
+        deadline = time.time() + sum(self.timeout)
+        state = self.state_of(item_id)
+        while state == "sending" and time.time() < deadline:
+            time.sleep(0.1)
+            state = self.state_of(item_id)
+        return state
+
+    def _claim(self, limit, ids=None):
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                conn.execute(
+                    "UPDATE outbox SET state = 'pending' WHERE state = 'sending' AND updated_at < ?",
+                    (now - STALE_CLAIM_SECONDS,),
+                )
+                if ids is None:
+                    rows = conn.execute(
+                        "SELECT id FROM outbox WHERE state = 'pending' AND next_attempt_at <= ? AND url = ? "
+                        "ORDER BY id LIMIT ?",
+                        (now, self.url, limit),
+                    ).fetchall()
+                    ids = [row[0] for row in rows]
+                claimed = []
+                for item_id in ids:
+                    updated = conn.execute(
+                        "UPDATE outbox SET state = 'sending', updated_at = ? WHERE id = ? AND state = 'pending'",
+                        (now, item_id),
+                    ).rowcount
+                    if updated:
+                        claimed.append(item_id)
+        return claimed
+
+    def _send(self, ids, claimed=False):
+        if not claimed:
+            ids = self._claim(len(ids), ids)
+        if not ids:
+            return 0
+        with self._lock:
+            rows = self._connect().execute(
+                f"SELECT id, payload, attempts FROM outbox WHERE id IN ({','.join('?' * len(ids))})", ids
+            ).fetchall()
+        payloads = [json.loads(payload) for _, payload, _ in rows]
+        body = payloads if self.batch_size > 1 else payloads[0]
+
+        error, retryable = None, True
+        try:
+            response = self.session.post(self.url, json=body, timeout=self.timeout)
+            if not 200 <= response.status_code < 300:
+                error = f"HTTP {response.status_code}: {response.text[:200]}"
+                retryable = response.status_code >= 500 or response.status_code in RETRYABLE_STATUS
+        except requests.RequestException as e:
+            error = str(e)
+
+        now = time.time()
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                for item_id, _, attempts in rows:
+                    attempts += 1
+                    if error is None:
+                        conn.execute(
+                            "UPDATE outbox SET state = 'sent', attempts = ?, last_error = NULL, updated_at = ? WHERE id = ?",
+                            (attempts, now, item_id),
+                        )
+                    elif not retryable or attempts >= self.max_attempts:
+                        conn.execute(
+                            "UPDATE outbox SET state = 'dead', attempts = ?, last_error = ?, updated_at = ? WHERE id = ?",
+                            (attempts, error, now, item_id),
+                        )
+                    else:
+                        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+                        conn.execute(
+                            "UPDATE outbox SET state = 'pending', attempts = ?, last_error = ?, next_attempt_at = ?, "
+                            "updated_at = ? WHERE id = ?",
+                            (attempts, error, now + delay, now, item_id),
+                        )
+        if error:
+            print(f"Failed to send data to webhook: {error}")
+        return len(rows) if error is None else 0
+
+    def flush(self, force=False):
+        """Post every due pending payload in batches; ``force`` ignores partly filled batches."""
+        sent = 0
+        while True:
+            with self._lock:
+                due = self._connect().execute(
+                    "SELECT COUNT(*) FROM outbox WHERE state = 'pending' AND next_attempt_at <= ? AND url = ?",
+                    (time.time(), self.url),
+                ).fetchone()[0]
+            if not due or (self.batch_size > 1 and due < self.batch_size and not force):
+                return sent
+            ids = self._claim(self.batch_size)
+            if not ids:
+                return sent
+            delivered = self._send(ids, claimed=True)
+            if not delivered:
+                return sent
+            sent += delivered
+
+    def _ensure_retry_thread(self):
+        if not self.auto_retry or (self._retry_thread and self._retry_thread.is_alive()):
+            return
+        with self._lock:
+            if self._retry_thread and self._retry_thread.is_alive():
+                return
+            self._stop.clear()
+            self._retry_thread = threading.Thread(target=self._retry_loop, name="webhook-retry", daemon=True)
+            self._retry_thread.start()
+
+    def _retry_loop(self):
+        last_activity = time.time()
+        while not self._stop.wait(self.retry_interval):
+            try:
+                # Partly filled batches go out once nothing new arrived for a full interval
+                idle = time.time() - last_activity > self.retry_interval
+                if self.flush(force=idle):
+                    last_activity = time.time()
+            except Exception as e:
+                print(f"Error retrying webhook deliveries: {e}")
+
+    def start(self):
+        """Start the background retry thread (also done on the first ``deliver``)."""
+        self._ensure_retry_thread()
+
+    def stop(self, flush=True):
+        self._stop.set()
+        if self._retry_thread:
+            self._retry_thread.join(timeout=self.retry_interval + 1)
+        if flush:
+            self.flush(force=True)
+
+    def state_of(self, item_id):
+        with self._lock:
+            row = self._connect().execute("SELECT state FROM outbox WHERE id = ?", (item_id,)).fetchone()
+        return row[0] if row else None
+
+    def status(self):
+        """Number of outbox rows per delivery state."""
+        with self._lock:
+            rows = self._connect().execute("SELECT state, COUNT(*) FROM outbox GROUP BY state").fetchall()
+        counts = dict.fromkeys(STATES, 0)
+        counts.update(dict(rows))
+        return counts
+
+    def items(self, state=None, limit=100):
+        query = "SELECT id, url, state, attempts, next_attempt_at, last_error, created_at, updated_at FROM outbox"
+        params = []
+        if state:
+            query += " WHERE state = ?"
+            params.append(state)
+        query += " ORDER BY id DESC LIMIT ?"
+        params.append(limit)
+        keys = ("id", "url", "state", "attempts", "next_attempt_at", "last_error", "created_at", "updated_at")
+        with self._lock:
+            return [dict(zip(keys, row)) for row in self._connect().execute(query, params)]
+
+    def retry_dead(self):
+        """Move dead-lettered payloads back to pending for another round of attempts."""
+        with self._lock:
+            conn = self._connect()
+            with conn:
+                return conn.execute(
+                    "UPDATE outbox SET state = 'pending', attempts = 0, next_attempt_at = ? WHERE state = 'dead'",
+                    (time.time(),),
+                ).rowcount
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Inspect and drive the webhook outbox.")
+    parser.add_argument("--outbox", default=DEFAULT_OUTBOX, help="outbox SQLite file")
+    parser.add_argument("--url", default=os.getenv("MAKE_WEBHOOK_URL", ""), help="webhook URL")
+    commands = parser.add_subparsers(dest="command", required=True)
+    commands.add_parser("status", help="count payloads per delivery state")
+    list_parser = commands.add_parser("list", help="list recent payloads")
+    list_parser.add_argument("--state", choices=STATES)
+    list_parser.add_argument("--limit", type=int, default=50)
+    commands.add_parser("retry-dead", help="requeue dead-lettered payloads")
+    commands.add_parser("flush", help="post every due pending payload now")
+    args = parser.parse_args(argv)
+
+    delivery = WebhookDelivery(args.url, outbox_path=args.outbox, auto_retry=False)
+    if args.command == "status":
+        print(json.dumps(delivery.status(), indent=2))
+    elif args.command == "list":
+        for item in delivery.items(state=args.state, limit=args.limit):
+            error = (item["last_error"] or "")[:60]
+            print(f"{item['id']:>6}  {item['state']:<7}  attempts={item['attempts']:<2}  {error}")
+    elif args.command == "retry-dead":
+        print(f"Requeued {delivery.retry_dead()} payloads.")
+    elif args.command == "flush":
+        print(f"Sent {delivery.flush(force=True)} payloads.")
+
+
+if __name__ == "__main__":
+    main()
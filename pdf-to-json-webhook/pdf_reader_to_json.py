@@ -1,23 +1,34 @@
 import os
 import re
-import json
-import requests
-import pytesseract
-from pdf2image import convert_from_path
+import sys
+import queue
+import threading
+import multiprocessing
 import tkinter as tk
 from tkinter import filedialog, messagebox, Listbox, ttk
 from tkinterdnd2 import DND_FILES, TkinterDnD
-import pdfplumber
 from dotenv import load_dotenv
-from openai import OpenAI
 from datetime import datetime
 import calendar
+from functools import partial
+
+# Shared extraction helpers live in invoice_core/ at the repository root
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+from invoice_core.page_router import extract_pages
+from invoice_core.invoices import JSON_PROMPT_VERSION, extract_json, prompt_version
+from invoice_core.batch import BatchEngine
+from invoice_core.cache import default_cache, file_digest
+from invoice_core.llm import StreamCancelled, get_gateway
+from invoice_core.webhook import WebhookDelivery
+from invoice_core.templates import TemplateStore
+from invoice_core.progress import STAGES, StageBreakdown, file_label, make_event, stage
+from invoice_core.streaming import DuplicateGuard, reject_early
+from invoice_core.routing import get_router, routed_version
 
 # Load environment variables from a .env file
 load_dotenv()
-client = OpenAI()
 
-client.api_key = os.getenv("OPENAI_API_KEY")
+llm = get_gateway(api_key=os.getenv("OPENAI_API_KEY"))
 
 # Define the path to Poppler binaries
 # Path to Poppler on macOS
@@ -25,11 +36,33 @@ POPPLER_PATH = "/opt/homebrew/bin"
 
 WEBHOOK_URL = os.getenv("MAKE_WEBHOOK_URL")
 
+WEBHOOK = WebhookDelivery(WEBHOOK_URL)
+
+# Re-dropped PDFs reuse their cached text/OCR layers and AI response (keyed by PROMPT_VERSION)
+CACHE = default_cache()
+
+# Only learned from here: templates do not cover the line items the JSON payload needs
+TEMPLATES = TemplateStore()
+
+# Print the prompt text and GPT answers for every file (INVOICE_VERBOSE=1); off by default
+VERBOSE = os.getenv("INVOICE_VERBOSE") == "1"
+
+# Schema-checked function calls, re-asking only for invalid fields (INVOICE_STRUCTURED=1)
+STRUCTURED = os.getenv("INVOICE_STRUCTURED") == "1"
+
+# With LLM_FAST_MODEL set, GPT-4 only gets the answers the cheaper model gets wrong
+ROUTER = get_router(llm, debug=VERBOSE)
+PROMPT_VERSION = routed_version(prompt_version(JSON_PROMPT_VERSION, STRUCTURED), ROUTER)
+
+# Stream answers and drop repeats and non-invoices before the line items (INVOICE_STREAM=1)
+STREAM = os.getenv("INVOICE_STREAM") == "1"
+DUPLICATES = DuplicateGuard()
+
 class InvoiceProcessorApp:
     def __init__(self, root):
         self.root = root
         self.root.title("Invoice Processor with Drag-and-Drop")
-        self.root.geometry("700x500")
+        self.root.geometry("800x800")
 
         self.files = []
 
@@ -65,6 +98,37 @@ class InvoiceProcessorApp:
         self.process_button = tk.Button(root, text="Process Files", command=self.process_files)
         self.process_button.pack(pady=10)
 
+        controls = tk.Frame(root)
+        controls.pack()
+        self.pause_button = tk.Button(controls, text="Pause", command=self.toggle_pause, state=tk.DISABLED)
+        self.pause_button.pack(side=tk.LEFT, padx=5)
+        self.cancel_button = tk.Button(controls, text="Cancel", command=self.cancel_processing, state=tk.DISABLED)
+        self.cancel_button.pack(side=tk.LEFT, padx=5)
+
+        # Per-file stage breakdown, in seconds
+        self.stage_tree = ttk.Treeview(root, columns=("status",) + STAGES, height=8)
+        self.stage_tree.heading("#0", text="File")
+        self.stage_tree.column("#0", width=200)
+        self.stage_tree.heading("status", text="Status")
+        self.stage_tree.column("status", width=90)
+        for name in STAGES:
+            self.stage_tree.heading(name, text=name)
+            self.stage_tree.column(name, width=60, anchor=tk.E)
+        self.stage_tree.pack(pady=5, fill=tk.X)
+
+        # Stage events from the workers, drained on the Tk main thread with after()
+        self.events = multiprocessing.Manager().Queue()
+        self.pause_event = threading.Event()
+        self.cancel_event = threading.Event()
+        self.breakdown = StageBreakdown()
+        self.worker = None
+        self.root.protocol("WM_DELETE_WINDOW", self.on_close)
+
+        # The pools live as long as the window, so retried files reuse their page renders
+        self.engine = BatchEngine(partial(extract_pages, poppler_path=POPPLER_PATH, cache=CACHE,
+                                          progress=self.events.put),
+                                  self.process_file, io_workers=llm.max_in_flight, ordered=False, keep_pools=True)
+
     def select_files(self):
         file_paths = filedialog.askopenfilenames(filetypes=[("PDF files", "*.pdf")])
         for file_path in file_paths:
@@ -87,54 +151,122 @@ class InvoiceProcessorApp:
         if not self.files:
             messagebox.showwarning("No Files Selected", "Please select or drop PDF files to process.")
             return
+        if self.worker is not None:
+            return
 
         total_files = len(self.files)
         self.progress_bar["maximum"] = total_files
         self.progress_bar["value"] = 0
+        self.breakdown = StageBreakdown()
+        self.stage_tree.delete(*self.stage_tree.get_children())
+        for file in self.files:
+            self.stage_tree.insert("", tk.END, iid=file_label(file), text=os.path.basename(file),
+                                   values=("queued",) + ("",) * len(STAGES))
 
-        for file in list(self.files):  # Iterate over a copy of the file list
-            extracted_data = self.extract_data_from_pdf(file)
-            if extracted_data:
-                success = self.send_to_webhook(extracted_data)
-                if success:
-                    self.processed_listbox.insert(tk.END, os.path.basename(file))
-                else:
-                    self.failed_listbox.insert(tk.END, os.path.basename(file))
-            else:
-                self.failed_listbox.insert(tk.END, os.path.basename(file))
+        self.pause_event.clear()
+        self.cancel_event.clear()
+        self.process_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.NORMAL, text="Pause")
+        self.cancel_button.config(state=tk.NORMAL)
 
-            # Update progress bar and remove processed file from the list
-            self.files.remove(file)
-            self.file_listbox.delete(0)  # Remove the first item in the listbox
-            self.progress_bar["value"] += 1
-            self.root.update_idletasks()  # Refresh the UI dynamically
+        self.worker = threading.Thread(target=self.run_batch, args=(list(self.files),), daemon=True)
+        self.worker.start()
+        self.root.after(100, self.poll_events)
 
-        if not self.failed_listbox.size():
-            messagebox.showinfo("Success", "All files processed successfully!")
+    def run_batch(self, files):
+        """Worker thread: drive the batch engine and forward its results to the GUI."""
+        try:
+            for result in self.engine.run(files, pause=self.pause_event, cancel=self.cancel_event):
+                self.events.put({"result": result})
+        except Exception as e:
+            print(f"Batch failed: {e}")
+        self.events.put({"finished": True})
+
+    def poll_events(self):
+        """Drain the event queue on the Tk main thread, then check again shortly."""
+        finished = False
+        while True:
+            try:
+                event = self.events.get_nowait()
+            except queue.Empty:
+                break
+            if "stage" in event:
+                self.on_stage_event(event)
+            elif "result" in event:
+                self.on_result(event["result"])
+            elif event.get("finished"):
+                finished = True
+        if finished:
+            self.on_batch_finished()
         else:
-            messagebox.showwarning("Partial Success", "Some files failed to process. Check the failed files list.")
+            self.root.after(100, self.poll_events)
 
-        # To store names of files that failed to send
-        failed_files = []
+    def on_stage_event(self, event):
+        stages = self.breakdown.add(event)
+        if not self.stage_tree.exists(event["file"]):
+            return
+        if event["status"] == "fields":
+            status = f"llm: {event['invoice']}"
+        else:
+            status = event["stage"] if event["status"] == "start" else self.stage_tree.set(event["file"], "status")
+        self.stage_tree.item(event["file"], values=(status,) + tuple(
+            f"{stages[name]:.2f}" if name in stages else "" for name in STAGES
+        ))
+
+    def on_result(self, result):
+        file = result["file"]
+        if result["ok"]:
+            self.processed_listbox.insert(tk.END, os.path.basename(file))
+            status = "done"
+        else:
+            if result["error"]:
+                print(f"Error processing {file}: {result['error']}")
+            status = result["error"] if result["error"] == "cancelled" else "failed"
+            self.failed_listbox.insert(tk.END, os.path.basename(file))
+        if self.stage_tree.exists(file_label(file)):
+            self.stage_tree.set(file_label(file), "status", status)
+
+        # Update progress bar and remove processed file from the list
+        index = self.files.index(file)
+        self.files.pop(index)
+        self.file_listbox.delete(index)
+        self.progress_bar["value"] += 1
+
+    def on_batch_finished(self):
+        self.worker = None
+        self.process_button.config(state=tk.NORMAL)
+        self.pause_button.config(state=tk.DISABLED, text="Pause")
+        self.cancel_button.config(state=tk.DISABLED)
+        print("Seconds per stage:", self.breakdown.totals())
+        if ROUTER is not None:
+            print("Model tiers:", ROUTER.summary())
+
+        if self.cancel_event.is_set():
+            messagebox.showinfo("Cancelled", "Processing was cancelled. Check the failed files list.")
+        elif not self.failed_listbox.size():
+            messagebox.showinfo("Success", "All files processed and sent successfully!")
+        else:
+            messagebox.showwarning("Partial Success", "Some files failed to process. Check the failed files list.")
 
-        for file in self.files:
-            extracted_data = self.extract_data_from_pdf(file)
-            if extracted_data:
-                success = self.send_to_webhook(extracted_data)
-                if not success:
-                    # Add the file name to the failure list
-                    failed_files.append(os.path.basename(file))
-
-        # Show a single message after processing all files
-        if not failed_files:
-            messagebox.showinfo("Success", "All extracted data were sent successfully!")
-            self.clear_files()
+    def toggle_pause(self):
+        if self.pause_event.is_set():
+            self.pause_event.clear()
+            self.pause_button.config(text="Pause")
         else:
-            failed_files_str = "\n".join(failed_files)
-            messagebox.showerror(
-                "Error",
-                f"Some files failed to send:\n{failed_files_str}\nCheck the logs for more details."
-            )
+            # Files already in a stage finish; no new file is started until resumed
+            self.pause_event.set()
+            self.pause_button.config(text="Resume")
+
+    def cancel_processing(self):
+        self.cancel_event.set()
+        self.pause_event.clear()
+        self.cancel_button.config(state=tk.DISABLED)
+        self.pause_button.config(state=tk.DISABLED)
+
+    def on_close(self):
+        # Queued files are dropped; the worker thread is a daemon and ends with the process
+        self.cancel_event.set()
+        self.root.destroy()
 
     def clear_files(self):
         """Clear the selected files and reset the listbox."""
@@ -143,155 +275,63 @@ class InvoiceProcessorApp:
          # Reset the listbox
         self.file_listbox.delete(0, tk.END)
 
-    def extract_data_from_pdf(self, file_path):
-        data = {
-            "*ContactName": "",
-            "EmailAddress": "",
-            "POAddressLine1": "", "POAddressLine2": "", "POAddressLine3": "", "POAddressLine4": "",
-            "POCity": "", "PORegion": "", "POPostalCode": "", "POCountry": "",
-            "*InvoiceNumber": "",
-            "*InvoiceDate": "",
-            "*DueDate": "",
-            "Total": "",
-            "InventoryItemCode": "",
-            "Description": "",
-            "*Quantity": "1",
-            "*UnitAmount": "",
-            "*AccountCode": "540",
-            "*TaxType": "20% (VAT on Expenses)",
-            "TaxAmount": "",
-            "TrackingName1": "Website",
-            "TrackingOption1": "",
-            "TrackingName2": "",
-            "TrackingOption2": "",
-            "Currency": "GBP"
-        }
-
-        with pdfplumber.open(file_path) as pdf:
-            text = ""
-            for page in pdf.pages:
-                text += page.extract_text() or ""
-
-        # Extract text from images using OCR
-        image_text = ""
-        try:
-            images = convert_from_path(file_path, dpi=300, poppler_path=POPPLER_PATH)
-            for image in images:
-                image_text += pytesseract.image_to_string(image)
-        except Exception as e:
-            print(f"Error converting PDF to images or using OCR: {e}")
-            return None
-
-        combined_text = text + "\n" + image_text
-
-        # Debug: Log combined text for troubleshooting
-        print("Extracted Text from PDF and Images:\n", combined_text)
-
-        prompt = f"""
-        You are an intelligent assistant designed to extract structured data from invoices. Below is the invoice text:
-
-        {combined_text}
-
-        Your task:
-        - Extract key details from the invoice text and return the data in a **valid JSON** format.
-        - Use context from the invoice (e.g., headings, labels, and patterns) to identify each field correctly.
-        - Follow these instructions for each field:
-
-        1. **ContactName**: Extract the **company name** based on prominent branding, header, or logo text. (e.g., DUCK ISLAND). Avoid using names like "Catercall Ltd," "CATERCALL LTD," or "Catercall LTD". Avoid using supplier names or addresses found in "Ship To" or "Billing Address" unless the invoice explicitly identifies them as the issuing company.
-        2. **EmailAddress**: Extract the first valid email address (e.g., custserv@nisbets.co.uk). If no email is present, leave it as an empty string.
-        3. **POAddressLine1-4**: Extract up to 4 address lines under the "Ship To" or "Delivery Address" section. Avoid addresses associated with the issuer (e.g., Catercall Ltd) unless explicitly indicated as the shipping address. Ensure the lines are in the correct order. If there are fewer than 4 lines, leave the remaining lines as empty strings.
-        4. **POCity**: Extract the city from the shipping address.
-        5. **PORegion**: Extract the region, county, or state from the shipping address, if provided. Leave blank if missing.
-        6. **POPostalCode**: Extract the postal code from the shipping address. Ensure correct formatting (e.g., SM4 4LU).
-        7. **POCountry**: Extract the country from the shipping address, if explicitly mentioned. Leave blank if missing.
-        8. **InvoiceNumber**: Extract the invoice number (e.g., 30114156) from headings like "Invoice No" or "Invoice Number."
-        9. **InvoiceDate**: Extract the invoice date (e.g., 13/11/2024) and ensure it is in DD/MM/YYYY format.
-        10. **DueDate**: Calculate the due date based on payment terms (e.g., "30 days from the invoice date") and display it in DD/MM/YYYY format. If payment terms are missing, assume a default of 30 days.
-        11. **Total**: Extract the total invoice amount (e.g., 55.82) without the currency symbol. If the currency is explicitly mentioned, add it as a separate "Currency" field, defaulting to "GBP" if absent.
-        12. **InventoryItemCode**: Extract all item codes (e.g., "C/HW5000(2)") listed in the product table.
-        13. **Description**: Extract all product descriptions (e.g., "Classic Hand Wash 5L packed in 2") listed in the product table.
-        14. **Quantity**: Extract all quantities (e.g., "1") from the product table.
-        15. **UnitAmount**: Extract all unit prices (e.g., "33.57") for items in the product table.
-        16. **AccountCode**: Default to "540" unless another account code is explicitly mentioned.
-        17. **TaxType**: Extract the tax type (e.g., "20% (VAT on Expenses)"). Default to "20% (VAT on Expenses)" if not specified.
-        18. **TaxAmount**: Extract the total tax amount (e.g., 9.30) without the currency symbol.
-        19. **TrackingName1**: Extract any tracking names or labels (e.g., "Order Reference").
-        20. **TrackingOption1**: Extract any tracking option values (e.g., "H150690") and infer its associated tracking category based on the following rules:
-            - If the value starts with "C", label it as **"Caterspeed"**.
-            - If the value starts with "H", label it as **"Hotel Buyer"**.
-            - If the value starts with "R", label it as **"Restaurant Supply Store"**.
-            - For all other cases, default the label to **"The Restaurant Store"**.
-        21. **TrackingName2** and **TrackingOption2**: Extract any additional tracking details, if available. Leave blank if none exist.
-        22. **Currency**: Extract the currency (e.g., GBP). Default to "GBP" if not explicitly mentioned.
-
-        ### Important Notes:
-        - Ensure all extracted data matches the context and structure of the invoice.
-        - Avoid using "Catercall Ltd," "CATERCALL LTD," "Catercall LTD," or similar variations for **ContactName**.
-        - For **POAddressLine1-4**, avoid using addresses associated with Catercall Ltd or its variations unless explicitly indicated as the "Ship To" address.
-        - Format your response as valid JSON with proper key-value pairs for all fields. Missing or unavailable fields should have an empty string ("") as their value.
-        - Apply the rules for **TrackingOption1** to provide meaningful labels based on the given tracking option value.
-        - Format all numerical values (e.g., Total, TaxAmount, UnitAmount) as pure numbers without currency symbols.
-        - If data for certain fields exists in multiple places (e.g., addresses), prioritize the most relevant section (e.g., "Ship To" for shipping details).
-
-        ### Example JSON Output:
-        {{
-            "*ContactName": "Duck Island Limited",
-            "EmailAddress": "sales@duckisland.co.uk",
-            "POAddressLine1": "The Townhouse",
-            "POAddressLine2": "High Street",
-            "POAddressLine3": "Sutton Coldfield",
-            "POAddressLine4": "Suburban Inns Operations Ltd",
-            "POCity": "Sutton Coldfield",
-            "PORegion": "",
-            "POPostalCode": "B72 1UD",
-            "POCountry": "",
-            "*InvoiceNumber": "0000027558",
-            "*InvoiceDate": "12/11/2024",
-            "*DueDate": "12/12/2024",
-            "Total": "55.82",
-            "InventoryItemCode": ["C/HW5000(2)", "Car"],
-            "Description": ["Classic Hand Wash 5L packed in 2", "Carriage as"],
-            "*Quantity": ["1", "1"],
-            "*UnitAmount": ["33.57", "12.95"],
-            "*AccountCode": "540",
-            "*TaxType": "20% (VAT on Expenses)",
-            "TaxAmount": "9.30",
-            "TrackingName1": "Order Reference",
-            "TrackingOption1": "Hotel Buyer",
-            "TrackingName2": "",
-            "TrackingOption2": "",
-            "Currency": "GBP"
-        }}
-
-        Please ensure your response is in valid JSON format with no additional explanations or text.
-        """
-
+    def process_file(self, file_path, pages):
+        """I/O stage of the batch engine: GPT extraction followed by webhook delivery."""
+        with stage(self.events.put, file_path, "llm") as measures:
+            extracted_data = self.extract_data_from_pdf(file_path, pages, measures)
+        if not extracted_data:
+            return False
+        with stage(self.events.put, file_path, "deliver"):
+            return self.send_to_webhook(extracted_data)
+
+    def extract_data_from_pdf(self, file_path, pages=None, measures=None):
+        digest = file_digest(file_path) if CACHE else None
+        if CACHE:
+            cached = CACHE.get(digest, "llm", PROMPT_VERSION)
+            if cached is not None:
+                print(f"Using cached AI response for {os.path.basename(file_path)}")
+                return cached
+
+        if pages is None:
+            try:
+                pages = extract_pages(file_path, poppler_path=POPPLER_PATH, cache=CACHE)
+            except Exception as e:
+                print(f"Error converting PDF to images or using OCR: {e}")
+                return None
+        if VERBOSE:
+            print("Page sources:", ", ".join(f"{page['page']}={page['source']}" for page in pages))
+
+        def show_invoice_number(field, value, values):
+            if field == "*InvoiceNumber":
+                self.events.put(make_event(file_path, "llm", "fields", invoice=value))
+
+        # Prompt and parsing are shared with the command-line runner (invoice_core/invoices.py)
         try:
-            response = client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "You are a helpful assistant for processing invoices."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=1000
-            )
-            ai_response = response.choices[0].message.content.strip()
-            print("AI Response JSON:\n", ai_response)
-            extracted_data = json.loads(ai_response)
+            extract = partial(extract_json, pages, debug=VERBOSE, measures=measures, structured=STRUCTURED,
+                              stream=STREAM, on_field=reject_early(file_path, DUPLICATES, show_invoice_number))
+            if ROUTER is None:
+                extracted_data = extract(llm, TEMPLATES)
+            else:
+                extracted_data = ROUTER.extract(extract, TEMPLATES, measures,
+                                                on_escalate=partial(DUPLICATES.release, file_path))
+            if CACHE:
+                CACHE.put(digest, "llm", PROMPT_VERSION, extracted_data)
             return extracted_data
+        except StreamCancelled as e:
+            print(f"Skipped {os.path.basename(file_path)}: {e.reason}")
+            return None
         except Exception as e:
+            DUPLICATES.release(file_path)
             print("Error with OpenAI API:", e)
             return None
 
     def send_to_webhook(self, data):
         try:
-            response = requests.post(WEBHOOK_URL, json=data)
-            if response.status_code == 200:
+            if WEBHOOK.deliver(data):
                 print("Data sent successfully to webhook!")
                 return True
-            else:
-                print(f"Failed to send data to webhook. Status code: {response.status_code}, Response: {response.text}")
-                return False
+            print("Failed to send data to webhook. It is kept in the outbox and will be retried.")
+            return False
         except Exception as e:
             print(f"Error sending data to webhook: {e}")
             return False